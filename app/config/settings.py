@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import json
 import os
 from pathlib import Path
 from dotenv import load_dotenv
@@ -84,12 +85,55 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. DB_ENGINE=postgresql switches to PostgreSQL, with a psycopg connection
+# pool per worker process unless POSTGRES_POOL=false, in which case connections persist for
+# CONN_MAX_AGE seconds instead (Django does not allow both)
+if os.getenv('DB_ENGINE', 'sqlite3') == 'postgresql':
+    POSTGRES_POOL = os.getenv('POSTGRES_POOL', 'true').lower() == 'true'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'navi'),
+            'USER': os.getenv('POSTGRES_USER', 'navi'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': 0 if POSTGRES_POOL else int(os.getenv('POSTGRES_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.getenv('POSTGRES_POOL_MAX_SIZE', 20)),
+                    'timeout': float(os.getenv('POSTGRES_POOL_TIMEOUT', 10)),
+                },
+            } if POSTGRES_POOL else {},
+        }
+    }
+else:
+    # WAL lets readers run alongside the single writer, busy_timeout makes writers wait for
+    # the lock instead of failing with "database is locked", and IMMEDIATE transactions take
+    # the write lock up front so two of them cannot deadlock upgrading from a read.
+    # SQLITE_TUNED=false falls back to SQLite's defaults
+    SQLITE_TUNED = os.getenv('SQLITE_TUNED', 'true').lower() == 'true'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            # A file rather than the in-memory default, where concurrent writers fail with
+            # "database table is locked" at once instead of waiting on busy_timeout
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+            'OPTIONS': {
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA busy_timeout=20000;'
+                    'PRAGMA temp_store=MEMORY;'
+                    'PRAGMA cache_size=-20000;'
+                ),
+            } if SQLITE_TUNED else {},
+        }
     }
-}
 
 
 # Password validation
@@ -166,6 +210,179 @@ DJOSER = {
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 
+# Completion providers (core/providers). Adapters are imported the first time they are used
+COMPLETION_PROVIDERS = {
+    'openai': {'BACKEND': 'core.providers.openai.OpenAIProvider'},
+    'anthropic': {
+        'BACKEND': 'core.providers.anthropic.AnthropicProvider',
+        # Marks the system prompt and the latest turns as prompt cache breakpoints
+        'OPTIONS': {'prompt_cache': os.getenv('ANTHROPIC_PROMPT_CACHE', 'true').lower() == 'true'},
+    },
+}
+
+# In-process provider that streams canned tokens without network I/O, for tests and load
+# tests. Off unless FAKE_PROVIDER_ENABLED=true, so it is neither listed nor routed to; the
+# test suite and loadtest_streams --provider fake register it themselves
+FAKE_COMPLETION_PROVIDER = {
+    'BACKEND': 'core.providers.fake.FakeProvider',
+    'OPTIONS': {
+        'tokens': int(os.getenv('FAKE_PROVIDER_TOKENS', 20)),
+        'token_delay': float(os.getenv('FAKE_PROVIDER_TOKEN_DELAY', 0.05)),
+    },
+}
+if os.getenv('FAKE_PROVIDER_ENABLED', 'false').lower() == 'true':
+    COMPLETION_PROVIDERS['fake'] = FAKE_COMPLETION_PROVIDER
+
+# History sent with each completion (core/context.py) is capped at MAX_HISTORY_TOKENS or the
+# model's context window, whichever is smaller. SUMMARIZE folds the older turns into a summary,
+# with provider calls queued under RATE_LIMITS at SUMMARY_PRIORITY like batch jobs.
+# STABLE_PREFIX keeps the start of the history in place between turns for prompt caching
+CONTEXT_BUILDER = {
+    'MAX_HISTORY_TOKENS': int(os.getenv('CONTEXT_MAX_HISTORY_TOKENS', 8000)),
+    'FETCH_BATCH_SIZE': 50,
+    'SUMMARIZE': os.getenv('CONTEXT_SUMMARIZE', 'false').lower() == 'true',
+    'SUMMARY_MIN_TOKENS': 1000,
+    'SUMMARY_MAX_TOKENS': 4000,
+    'SUMMARY_PRIORITY': -5,
+    'SUMMARY_MAX_WAIT': 600.0,
+    'STABLE_PREFIX': os.getenv('CONTEXT_STABLE_PREFIX', 'true').lower() == 'true',
+    'TRIM_TO': float(os.getenv('CONTEXT_TRIM_TO', 0.5)),
+}
+
+# Completion pipeline (core/completions.py). With CHECKPOINT the partial reply is stored
+# every CHECKPOINT_INTERVAL seconds while it streams, so it survives a dropped connection.
+# SINGLE_FLIGHT lets identical concurrent requests share one provider stream
+COMPLETIONS = {
+    'CHECKPOINT': os.getenv('COMPLETION_CHECKPOINT', 'false').lower() == 'true',
+    'CHECKPOINT_INTERVAL': float(os.getenv('COMPLETION_CHECKPOINT_INTERVAL', 1.0)),
+    'SINGLE_FLIGHT': os.getenv('COMPLETION_SINGLE_FLIGHT', 'true').lower() == 'true',
+}
+
+# Under ASGI (config/asgi.py) the sync code of all requests and completion streams runs on
+# one pool of MAX_WORKERS threads (core/asgi.py) instead of a thread per open request
+SYNC_THREADS = {
+    'MAX_WORKERS': int(os.getenv('SYNC_THREADS_MAX_WORKERS', 8)),
+}
+
+# Chat messages are inserted in batches by a writer thread (core/persistence.py), once
+# BATCH_SIZE are queued or after FLUSH_INTERVAL seconds. ENABLED=false saves them inline
+WRITE_BEHIND = {
+    'ENABLED': os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() == 'true',
+    'BATCH_SIZE': int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 100)),
+    'FLUSH_INTERVAL': float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 0.05)),
+}
+
+# Full-text search over chat history (core/search.py). Queries matching more than
+# RANK_WINDOW messages rank only the newest RANK_WINDOW of them
+SEARCH = {
+    'RANK_WINDOW': int(os.getenv('SEARCH_RANK_WINDOW', 5000)),
+    'CONFIG': os.getenv('SEARCH_CONFIG', 'english'),
+}
+
+# Batch completion jobs (core/batches.py). Items run CONCURRENCY at a time per job (up to
+# MAX_CONCURRENCY) and PROVIDER_CONCURRENCY per provider, below interactive completions in
+# the rate limit queues. Output files are written to OUTPUT_DIR
+BATCHES = {
+    'OUTPUT_DIR': os.getenv('BATCH_OUTPUT_DIR', str(BASE_DIR / 'batches')),
+    'MAX_ITEMS': int(os.getenv('BATCH_MAX_ITEMS', 50000)),
+    'DEFAULT_CONCURRENCY': int(os.getenv('BATCH_CONCURRENCY', 4)),
+    'MAX_CONCURRENCY': int(os.getenv('BATCH_MAX_CONCURRENCY', 32)),
+    'PROVIDER_CONCURRENCY': int(os.getenv('BATCH_PROVIDER_CONCURRENCY', 16)),
+    'POLL_INTERVAL': float(os.getenv('BATCH_POLL_INTERVAL', 30)),
+}
+
+# Server-sent event framing of completion streams (core/sse.py). Provider chunks are
+# buffered until FLUSH_BYTES of content or FLUSH_INTERVAL seconds, 0 bytes disables it
+SSE_STREAMS = {
+    'FLUSH_BYTES': int(os.getenv('SSE_FLUSH_BYTES', 256)),
+    'FLUSH_INTERVAL': float(os.getenv('SSE_FLUSH_INTERVAL', 0.05)),
+}
+
+# Provider rate limits (core/scheduler.py) as JSON keyed by provider or provider:model, e.g.
+# {"openai": {"RPM": 500, "TPM": 30000}, "anthropic:claude-3-5-sonnet-20241022": {"RPM": 50, "CONCURRENCY": 20}}
+# Completions over the limits queue for up to MAX_WAIT seconds. CacheRateLimitBackend
+# shares the buckets between workers through the default cache. A CONCURRENCY slot is
+# freed after LEASE_TTL seconds even if its worker died before releasing it
+RATE_LIMITS = {
+    'BACKEND': os.getenv('RATE_LIMIT_BACKEND', 'core.scheduler.MemoryRateLimitBackend'),
+    'LIMITS': json.loads(os.getenv('RATE_LIMITS', '{}')),
+    'MAX_WAIT': float(os.getenv('RATE_LIMIT_MAX_WAIT', 60)),
+    'LEASE_TTL': float(os.getenv('RATE_LIMIT_LEASE_TTL', 600)),
+}
+
+# Retries, hedging and failover of provider streams (core/resilience.py). FAILOVER is JSON
+# mapping a provider or provider:model to the models tried once it keeps failing, e.g.
+# {"anthropic:claude-3-5-sonnet-20241022": ["openai:gpt-4o"]}
+RESILIENCE = {
+    'MAX_RETRIES': int(os.getenv('PROVIDER_MAX_RETRIES', 2)),
+    'HEDGE': os.getenv('PROVIDER_HEDGE', 'false').lower() == 'true',
+    'HEDGE_PERCENTILE': int(os.getenv('PROVIDER_HEDGE_PERCENTILE', 95)),
+    'FAILOVER': json.loads(os.getenv('PROVIDER_FAILOVER', '{}')),
+}
+
+# Replies to identical completion requests are served from memory (core/responses.py).
+# SEMANTIC also matches near-identical requests and needs numpy
+RESPONSE_CACHE = {
+    'ENABLED': os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true',
+    'TTL': int(os.getenv('RESPONSE_CACHE_TTL', 3600)),
+    'MAX_ENTRIES': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+    'MAX_BYTES': int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+    'SEMANTIC': os.getenv('RESPONSE_CACHE_SEMANTIC', 'false').lower() == 'true',
+    'SEMANTIC_THRESHOLD': float(os.getenv('RESPONSE_CACHE_SEMANTIC_THRESHOLD', 0.95)),
+}
+
+# Completion streams run detached from the response and are buffered for Last-Event-ID
+# replay (core/streams.py). CacheStreamBuffer shares the buffers through a Django cache.
+# A stream nobody reads for DISCONNECT_GRACE seconds is cancelled along with its provider call;
+# STREAM_DISCONNECT_GRACE=none (or empty) never cancels them
+STREAM_DISCONNECT_GRACE = os.getenv('STREAM_DISCONNECT_GRACE', '2.0').strip()
+STREAM_BUFFERS = {
+    'BACKEND': os.getenv('STREAM_BUFFER_BACKEND', 'core.streams.MemoryStreamBuffer'),
+    'MAX_EVENTS': int(os.getenv('STREAM_BUFFER_MAX_EVENTS', 1000)),
+    'TTL': int(os.getenv('STREAM_BUFFER_TTL', 300)),
+    'DISCONNECT_GRACE': (
+        None if STREAM_DISCONNECT_GRACE.lower() in ('', 'none') else float(STREAM_DISCONNECT_GRACE)
+    ),
+}
+
+# Automatic model selection for /api/providers/auto/models/auto/complete (core/selector.py).
+# CANDIDATES is a comma-separated list of provider/model_id; with CACHE_ALIAS set the rolling
+# stats are saved to that cache and survive restarts
+MODEL_SELECTOR = {
+    'CANDIDATES': [name for name in os.getenv(
+        'MODEL_SELECTOR_CANDIDATES', 'openai/gpt-4o-mini,openai/gpt-4o,anthropic/claude-3-5-sonnet-20241022'
+    ).split(',') if name],
+    'EXPLORE_RATE': float(os.getenv('MODEL_SELECTOR_EXPLORE_RATE', 0.05)),
+    'CACHE_ALIAS': os.getenv('MODEL_SELECTOR_CACHE_ALIAS') or None,
+}
+
+# Completion latency histograms served at /metrics (core/metrics.py). TRACING also exports
+# each request's stages as an OpenTelemetry trace and needs opentelemetry-api
+METRICS = {
+    'TRACING': os.getenv('METRICS_TRACING', 'false').lower() == 'true',
+    'LOG_SAMPLE_RATE': float(os.getenv('METRICS_LOG_SAMPLE_RATE', 0.01)),
+}
+
+# Shared provider SDK clients (core/clients.py), built once per process
+PROVIDER_CLIENTS = {
+    'MAX_CONNECTIONS': int(os.getenv('PROVIDER_MAX_CONNECTIONS', 100)),
+    'MAX_KEEPALIVE_CONNECTIONS': int(os.getenv('PROVIDER_MAX_KEEPALIVE_CONNECTIONS', 20)),
+    'KEEPALIVE_EXPIRY': float(os.getenv('PROVIDER_KEEPALIVE_EXPIRY', 30)),
+    'CONNECT_TIMEOUT': float(os.getenv('PROVIDER_CONNECT_TIMEOUT', 5)),
+    'READ_TIMEOUT': float(os.getenv('PROVIDER_READ_TIMEOUT', 60)),
+    'WRITE_TIMEOUT': float(os.getenv('PROVIDER_WRITE_TIMEOUT', 10)),
+    'POOL_TIMEOUT': float(os.getenv('PROVIDER_POOL_TIMEOUT', 10)),
+    'HTTP2': os.getenv('PROVIDER_HTTP2', 'true').lower() == 'true',
+}
+
+# Cached /api/providers/<provider>/models responses (core/catalog.py). Entries are fresh for TTL
+# seconds and served stale for up to STALE_TTL more while they refresh in the background
+MODEL_CATALOG = {
+    'CACHE_ALIAS': 'default',
+    'TTL': int(os.getenv('MODEL_CATALOG_TTL', 300)),
+    'STALE_TTL': int(os.getenv('MODEL_CATALOG_STALE_TTL', 3600)),
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -1,8 +1,12 @@
 from django.contrib import admin
 
-from .models import User, ChatRoom, Message
+from .models import BatchJob, Comparison, User, ChatRoom, ChatRoomUsage, DailyModelUsage, Message
 
 # Register your models here.
 admin.site.register(User)
 admin.site.register(ChatRoom)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(DailyModelUsage)
+admin.site.register(ChatRoomUsage)
+admin.site.register(BatchJob)
+admin.site.register(Comparison)
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from .search import install_search_index
+
+        # The full-text search index is not a model, see core.search
+        post_migrate.connect(install_search_index, sender=self)
@@ -0,0 +1,85 @@
+"""
+ASGI handler that runs the sync code of every request on one shared, bounded thread pool.
+
+Django's ASGIHandler gives each request its own ThreadSensitiveContext. The first sync
+call made in it (the request_started receivers already make one) starts a thread that is
+kept until the response has been sent, so every open completion stream would hold a thread
+for its whole length. Here requests run in one shared context instead, whose executor has
+MAX_WORKERS threads: open streams cost no threads, and the ORM calls of views and of the
+completion streams (core.streams) queue for the pool.
+
+"Thread sensitive" then means "on one of the pool's threads". Every sync call still runs
+on a thread with its own database connection, but two calls of one request may run on
+different threads, so a transaction can not span them.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from asgiref.sync import SyncToAsync, ThreadSensitiveContext
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+
+DEFAULT_SYNC_THREAD_OPTIONS = {
+    # Threads shared by the sync code of all requests and completion streams
+    'MAX_WORKERS': 8,
+}
+
+
+class SharedSyncThreads:
+    def __init__(self, options=None):
+        self._options = options
+        self._lock = threading.Lock()
+        self._context = None
+        self._executor = None
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_SYNC_THREAD_OPTIONS, **getattr(settings, 'SYNC_THREADS', {})}
+        return self._options
+
+    @property
+    def executor(self):
+        self._setup()
+        return self._executor
+
+    def _setup(self):
+        if self._context is None:
+            with self._lock:
+                if self._context is None:
+                    executor = ThreadPoolExecutor(self.options['MAX_WORKERS'], thread_name_prefix='navi-sync')
+                    context = ThreadSensitiveContext()
+                    # asgiref looks up a context's executor here and only creates one when it is missing
+                    SyncToAsync.context_to_thread_executor[context] = executor
+                    self._executor, self._context = executor, context
+
+    def enter(self):
+        """
+        Makes the thread-sensitive sync_to_async calls of the current context (and of the
+        tasks it starts) run on the pool. Returns a token for exit().
+        """
+        self._setup()
+        return SyncToAsync.thread_sensitive_context.set(self._context)
+
+    def exit(self, token):
+        SyncToAsync.thread_sensitive_context.reset(token)
+
+
+shared_sync_threads = SharedSyncThreads()
+
+
+class SharedThreadASGIHandler(ASGIHandler):
+    async def __call__(self, scope, receive, send):
+        # ASGIHandler's own ThreadSensitiveContext keeps an outer one when there is one
+        token = shared_sync_threads.enter()
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            shared_sync_threads.exit(token)
+
+
+def get_asgi_application():
+    """django.core.asgi.get_asgi_application() with SharedThreadASGIHandler"""
+    django.setup(set_prefix=False)
+    return SharedThreadASGIHandler()
@@ -0,0 +1,52 @@
+"""
+A long-lived event loop thread that lets synchronous (WSGI) code drive the async
+completion pipeline.
+
+Provider adapters only expose async streams. Sync views hand their async generators to
+``background_loop.iterate()``, which advances them on one shared loop, so every WSGI
+request reuses the same pooled async provider clients.
+"""
+import asyncio
+import threading
+
+
+async def _next(agen):
+    return await agen.__anext__()
+
+
+class BackgroundLoop:
+    def __init__(self, name='navi-background-loop'):
+        self.name = name
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def run(self, coro):
+        """Runs a coroutine on the loop and blocks until it returns"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def iterate(self, agen):
+        """
+        Wraps an async generator in a sync one. Closing the sync generator (e.g. when
+        the WSGI server closes the response) closes the async generator on the loop.
+        """
+        try:
+            while True:
+                try:
+                    yield self.run(_next(agen))
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(agen.aclose())
+
+
+background_loop = BackgroundLoop()
@@ -0,0 +1,408 @@
+"""
+Batch completion jobs for offline workloads such as evals.
+
+A job is a JSONL upload of prompts completed by one model, without a chatroom or an HTTP
+request per prompt. ``batch_runner.create()`` stores one BatchItem per line, and
+``batch_runner.start()`` runs the pending items on the shared background loop
+(core.background) through a bounded pool of workers: ``concurrency`` per job, and at most
+PROVIDER_CONCURRENCY calls per provider over all the jobs of the process. Every call waits
+for its turn under the provider's rate limits (core.scheduler) at a low PRIORITY, so
+interactive completions go first, and is retried and failed over like any other
+(core.resilience).
+
+Each finished item is checkpointed in its row, then appended to the job's output file as
+one JSON line. A job whose worker died (its heartbeat is older than LEASE seconds) is
+picked up again with ``batch_runner.resume()``: the output file is rewritten from the
+finished items and only the pending ones run.
+
+Jobs in ``provider`` mode are submitted to the provider's own batch API instead, which is
+cheaper for large runs but may take hours. The provider's batch id is checkpointed on the
+job, so a resumed job goes back to polling it. Providers without a batch API (the fake
+provider, for one) run such jobs in the local pool.
+
+Each line of an upload is an object with the prompt in ``prompt`` or ``message``, or a
+``title`` and ``body`` (the shape of a requests.jsonl backlog), an optional
+``system_prompt``, and its id in ``custom_id``, ``request_id`` or ``id``. Lines without
+an id are numbered from 0.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import deque
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .background import background_loop
+from .models import BatchItem, BatchJob
+from .providers import providers
+from .resilience import resilient_streams
+from .scheduler import scheduler
+from .tokens import count_message_tokens, count_tokens
+from .usage import record_usage
+
+logger = logging.getLogger('api')
+
+DEFAULT_BATCH_OPTIONS = {
+    # Directory of the JSONL output files, one per job; BASE_DIR/batches when unset
+    'OUTPUT_DIR': None,
+    'MAX_ITEMS': 50000,
+    'DEFAULT_CONCURRENCY': 4,
+    'MAX_CONCURRENCY': 32,
+    # Calls in flight per provider over all the jobs running in this process
+    'PROVIDER_CONCURRENCY': 16,
+    # Place of each call in the rate limit queue and how long it may wait there (core.scheduler)
+    'PRIORITY': -5,
+    'MAX_WAIT': 600.0,
+    # Seconds between heartbeats of a running job, and without one before it counts as interrupted
+    'HEARTBEAT_INTERVAL': 10.0,
+    'LEASE': 60.0,
+    # Seconds between status checks of a provider batch
+    'POLL_INTERVAL': 30.0,
+}
+
+ID_FIELDS = ('custom_id', 'request_id', 'id')
+
+
+class InvalidBatch(ValueError):
+    pass
+
+
+def parse_items(lines, max_items=None):
+    """Unsaved BatchItems, without their job, from the JSONL ``lines`` (bytes or str)"""
+    items, seen = [], set()
+    for number, line in enumerate(lines, 1):
+        try:
+            line = line.decode('utf-8') if isinstance(line, bytes) else line
+            data = json.loads(line) if line.strip() else None
+        except UnicodeDecodeError:
+            raise InvalidBatch(f'Line {number}: not UTF-8')
+        except json.JSONDecodeError as e:
+            raise InvalidBatch(f'Line {number}: invalid JSON ({e.msg})')
+        if data is None:
+            continue
+        if not isinstance(data, dict):
+            raise InvalidBatch(f'Line {number}: expected a JSON object')
+
+        prompt = data.get('prompt') or data.get('message')
+        if prompt is None and data.get('body'):
+            prompt = '\n\n'.join(str(data[key]) for key in ('title', 'body') if data.get(key))
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise InvalidBatch(f'Line {number}: no prompt, expected "prompt", "message" or "body"')
+        custom_id = str(next((data[key] for key in ID_FIELDS if data.get(key) not in (None, '')), len(items)))
+        if len(custom_id) > 255:
+            raise InvalidBatch(f'Line {number}: id longer than 255 characters')
+        if custom_id in seen:
+            raise InvalidBatch(f'Line {number}: duplicate id {custom_id!r}')
+        seen.add(custom_id)
+
+        items.append(BatchItem(
+            index=len(items),
+            custom_id=custom_id,
+            prompt=prompt,
+            system_prompt=str(data.get('system_prompt') or ''),
+        ))
+        if max_items and len(items) > max_items:
+            raise InvalidBatch(f'More than {max_items} prompts')
+    if not items:
+        raise InvalidBatch('No prompts in the upload')
+    return items
+
+
+def output_line(item):
+    line = {'custom_id': item.custom_id, 'index': item.index, 'status': item.status}
+    if item.status == BatchItem.COMPLETE:
+        line.update(content=item.content, input_tokens=item.input_tokens, output_tokens=item.output_tokens)
+    else:
+        line['error'] = item.error
+    return json.dumps(line) + '\n'
+
+
+def provider_custom_id(item):
+    """Ids sent to provider batch APIs, which only accept a few characters"""
+    return f'item-{item.index}'
+
+
+class BatchRunner:
+    def __init__(self, options=None):
+        self._explicit_options = options
+        self._options = options
+        self._futures = {}
+        self._tasks = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_BATCH_OPTIONS, **getattr(settings, 'BATCHES', {})}
+        return self._options
+
+    def output_path(self, job_id):
+        directory = self.options['OUTPUT_DIR'] or os.path.join(settings.BASE_DIR, 'batches')
+        return os.path.join(directory, f'{job_id}.jsonl')
+
+    def create(self, lines, provider, model_id, system_prompt='', concurrency=None, mode=BatchJob.LOCAL):
+        """Stores a queued job and its items. Raises InvalidBatch for a malformed upload"""
+        items = parse_items(lines, self.options['MAX_ITEMS'])
+        concurrency = min(concurrency or self.options['DEFAULT_CONCURRENCY'], self.options['MAX_CONCURRENCY'])
+        with transaction.atomic():
+            job = BatchJob.objects.create(
+                provider=provider.lower(),
+                model_id=model_id,
+                system_prompt=system_prompt,
+                mode=mode,
+                concurrency=concurrency,
+                total_items=len(items),
+            )
+            for item in items:
+                item.job = job
+            BatchItem.objects.bulk_create(items, batch_size=1000)
+        return job
+
+    def start(self, job_id):
+        """
+        Runs a queued job on the background loop, unless it already runs in this process.
+        Returns a concurrent.futures.Future of the run.
+        """
+        job_id = str(job_id)
+        with self._lock:
+            self._futures = {key: future for key, future in self._futures.items() if not future.done()}
+            future = self._futures.get(job_id)
+            if future is None:
+                future = self._futures[job_id] = asyncio.run_coroutine_threadsafe(self.run(job_id), background_loop.loop)
+        return future
+
+    def wait(self, job_id, timeout=None):
+        """Blocks until the job's run in this process (if any) is over"""
+        future = self._futures.get(str(job_id))
+        if future is not None:
+            future.result(timeout)
+
+    def resume(self, job_id, retry_failed=False):
+        """
+        Queues an unfinished, interrupted or cancelled job again and starts it; with
+        ``retry_failed`` its failed items run again as well. Returns False while the job's
+        heartbeat shows it is still running somewhere.
+        """
+        stale = timezone.now() - timedelta(seconds=self.options['LEASE'])
+        with transaction.atomic():
+            resumed = (
+                BatchJob.objects
+                .filter(id=job_id)
+                .filter(Q(heartbeat_at__isnull=True) | Q(heartbeat_at__lt=stale))
+                .update(status=BatchJob.QUEUED, error='', finished_at=None, heartbeat_at=None)
+            )
+            if not resumed:
+                return False
+            if retry_failed:
+                failed = (
+                    BatchItem.objects
+                    .filter(job_id=job_id, status=BatchItem.FAILED)
+                    .update(status=BatchItem.PENDING, error='', finished_at=None)
+                )
+                if failed:
+                    # A new provider batch is needed for the retried items
+                    BatchJob.objects.filter(id=job_id).update(
+                        failed_items=F('failed_items') - failed, provider_batch_id='',
+                    )
+        self.start(job_id)
+        return True
+
+    def cancel(self, job_id):
+        """Stops a queued or running job; its pending items stay pending and can be resumed"""
+        cancelled = (
+            BatchJob.objects
+            .filter(id=job_id, status__in=[BatchJob.QUEUED, BatchJob.RUNNING])
+            .update(status=BatchJob.CANCELLED, finished_at=timezone.now())
+        )
+        task = self._tasks.get(str(job_id))
+        if task is not None:
+            background_loop.loop.call_soon_threadsafe(task.cancel)
+        return bool(cancelled)
+
+    async def run(self, job_id):
+        now = timezone.now()
+        claimed = await BatchJob.objects.filter(id=job_id, status=BatchJob.QUEUED).aupdate(
+            status=BatchJob.RUNNING, heartbeat_at=now,
+        )
+        if not claimed:
+            return
+        await BatchJob.objects.filter(id=job_id, started_at__isnull=True).aupdate(started_at=now)
+        job = await BatchJob.objects.aget(id=job_id)
+
+        self._tasks[job_id] = asyncio.current_task()
+        heartbeat = asyncio.create_task(self.heartbeat(job_id, asyncio.current_task()))
+        status, error = BatchJob.COMPLETED, ''
+        try:
+            adapter = providers.get(job.provider)
+            output = await sync_to_async(self.open_output)(job)
+            try:
+                if job.mode == BatchJob.PROVIDER and adapter.batch_api:
+                    await self.run_provider_batch(job, adapter, output)
+                else:
+                    if job.mode == BatchJob.PROVIDER:
+                        logger.info('%s has no batch API, running batch job %s locally', adapter.name, job_id)
+                    await self.run_local(job, adapter, output)
+            finally:
+                output.close()
+        except asyncio.CancelledError:
+            status = BatchJob.CANCELLED
+            if job.provider_batch_id:
+                try:
+                    await adapter.cancel_batch(job.provider_batch_id)
+                except Exception as e:
+                    logger.warning('Could not cancel %s batch %s: %s', job.provider, job.provider_batch_id, e)
+        except Exception as e:
+            logger.warning('Batch job %s failed: %s', job_id, e)
+            status, error = BatchJob.FAILED, str(e)
+        finally:
+            heartbeat.cancel()
+            self._tasks.pop(job_id, None)
+            await BatchJob.objects.filter(id=job_id).aupdate(
+                status=status, error=error, finished_at=timezone.now(), heartbeat_at=None,
+            )
+
+    async def heartbeat(self, job_id, task):
+        """Renews the job's lease, and stops the run once the job was cancelled elsewhere"""
+        while True:
+            await asyncio.sleep(self.options['HEARTBEAT_INTERVAL'])
+            renewed = await BatchJob.objects.filter(id=job_id, status=BatchJob.RUNNING).aupdate(
+                heartbeat_at=timezone.now(),
+            )
+            if not renewed:
+                task.cancel()
+                return
+
+    def open_output(self, job):
+        """Rewrites the output file from the checkpointed items and opens it for appending"""
+        path = self.output_path(job.id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        finished = (
+            BatchItem.objects
+            .filter(job_id=job.id)
+            .exclude(status=BatchItem.PENDING)
+            .order_by('finished_at', 'index')
+        )
+        with open(path, 'w', encoding='utf-8') as output:
+            output.writelines(output_line(item) for item in finished.iterator(chunk_size=1000))
+        return open(path, 'a', encoding='utf-8')
+
+    async def pending_items(self, job):
+        """The job's pending items in order, as a deque the workers take them from"""
+        items = BatchItem.objects.filter(job_id=job.id, status=BatchItem.PENDING).order_by('index')
+        return deque([item async for item in items.only('id', 'index', 'custom_id', 'prompt', 'system_prompt')])
+
+    def provider_slots(self, provider):
+        if provider not in self._slots:
+            self._slots[provider] = asyncio.Semaphore(self.options['PROVIDER_CONCURRENCY'])
+        return self._slots[provider]
+
+    async def run_local(self, job, adapter, output):
+        pending = await self.pending_items(job)
+
+        async def worker():
+            while pending:
+                item = pending.popleft()
+                async with self.provider_slots(adapter.name):
+                    await self.complete(job, adapter, item)
+                await sync_to_async(self.checkpoint)(job, item, output)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(job.concurrency, len(pending)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def complete(self, job, adapter, item):
+        """Streams one item's completion into the item; failures are the item's, not the job's"""
+        system_prompt = item.system_prompt or job.system_prompt
+        history = [{'role': 'user', 'content': item.prompt}]
+        estimate = count_tokens(system_prompt) + count_message_tokens(item.prompt) + adapter.max_tokens
+        ticket = scheduler.ticket(adapter.name, job.model_id, estimate, self.options['PRIORITY'],
+                                  self.options['MAX_WAIT'])
+        parts = []
+        try:
+            if ticket is not None:
+                async for _ in scheduler.wait(ticket):
+                    pass
+            async for chunk in resilient_streams.stream(adapter, job.model_id, history, system_prompt):
+                parts.append(chunk.content)
+                if chunk.input_tokens is not None:
+                    item.input_tokens = chunk.input_tokens
+                if chunk.output_tokens is not None:
+                    item.output_tokens = chunk.output_tokens
+            item.status, item.content = BatchItem.COMPLETE, ''.join(parts)
+        except Exception as e:
+            logger.info('Batch job %s item %s failed: %s', job.id, item.custom_id, e)
+            item.status, item.error = BatchItem.FAILED, str(e) or type(e).__name__
+        finally:
+            used = (item.input_tokens or 0) + (item.output_tokens or 0) if item.input_tokens is not None else None
+            await scheduler.release(ticket, used)
+
+    def checkpoint(self, job, item, output):
+        """Stores the finished item and the job's counters, then appends it to the output"""
+        item.finished_at = timezone.now()
+        counter = 'completed_items' if item.status == BatchItem.COMPLETE else 'failed_items'
+        input_tokens, output_tokens = item.input_tokens or 0, item.output_tokens or 0
+        with transaction.atomic():
+            BatchItem.objects.filter(id=item.id).update(
+                status=item.status,
+                content=item.content,
+                error=item.error,
+                input_tokens=item.input_tokens,
+                output_tokens=item.output_tokens,
+                finished_at=item.finished_at,
+            )
+            BatchJob.objects.filter(id=job.id).update(**{
+                counter: F(counter) + 1,
+                'input_tokens': F('input_tokens') + input_tokens,
+                'output_tokens': F('output_tokens') + output_tokens,
+            })
+            if item.status == BatchItem.COMPLETE:
+                record_usage(None, job.provider, job.model_id, input_tokens, output_tokens)
+        output.write(output_line(item))
+        output.flush()
+
+    async def run_provider_batch(self, job, adapter, output):
+        pending = {provider_custom_id(item): item for item in await self.pending_items(job)}
+        if not pending:
+            return
+        if not job.provider_batch_id:
+            requests = [
+                (custom_id, [{'role': 'user', 'content': item.prompt}], item.system_prompt or job.system_prompt)
+                for custom_id, item in pending.items()
+            ]
+            job.provider_batch_id = await adapter.submit_batch(job.model_id, requests)
+            await BatchJob.objects.filter(id=job.id).aupdate(provider_batch_id=job.provider_batch_id)
+
+        while not await adapter.batch_finished(job.provider_batch_id):
+            await asyncio.sleep(self.options['POLL_INTERVAL'])
+
+        async for custom_id, result in adapter.batch_results(job.provider_batch_id):
+            item = pending.pop(custom_id, None)
+            if item is None:
+                continue
+            if 'error' in result:
+                item.status, item.error = BatchItem.FAILED, result['error']
+            else:
+                item.status, item.content = BatchItem.COMPLETE, result['content']
+                item.input_tokens, item.output_tokens = result['input_tokens'], result['output_tokens']
+            await sync_to_async(self.checkpoint)(job, item, output)
+        for item in pending.values():
+            item.status, item.error = BatchItem.FAILED, 'No result in the provider batch'
+            await sync_to_async(self.checkpoint)(job, item, output)
+
+    def reset(self):
+        self._options = self._explicit_options
+        self._slots = {}
+
+
+batch_runner = BatchRunner()
@@ -0,0 +1,117 @@
+"""
+Cached model catalog behind /api/providers/<provider>/models.
+
+Model lists barely change, so they are kept in Django's cache framework instead of being
+fetched on every page load. Entries are fresh for ``TTL`` seconds; after that they are
+still served for up to ``STALE_TTL`` seconds while a background thread refreshes them
+(stale-while-revalidate). Only a missing or fully expired entry blocks on the provider.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .providers import ProviderNotFound, providers
+
+logger = logging.getLogger('api')
+
+DEFAULT_CATALOG_OPTIONS = {
+    'CACHE_ALIAS': 'default',
+    'TTL': 300,
+    'STALE_TTL': 3600,
+}
+
+
+class ModelCatalog:
+    """
+    Looks up model ids per provider through the cache.
+
+    ``get()`` returns a dict with the ``models`` list, an ``etag`` derived from it and the
+    ``max_age`` clients may cache it for. Fetch errors propagate and are never cached.
+    Models come from each provider adapter's ``list_models()`` unless ``fetchers`` maps
+    provider names to callables.
+    """
+    def __init__(self, fetchers=None, options=None):
+        self.fetchers = fetchers
+        self._options = options
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_CATALOG_OPTIONS, **getattr(settings, 'MODEL_CATALOG', {})}
+        return self._options
+
+    @property
+    def cache(self):
+        return caches[self.options['CACHE_ALIAS']]
+
+    def cache_key(self, provider):
+        return f'model-catalog:{provider}'
+
+    def fetcher(self, provider):
+        if self.fetchers is None:
+            return providers.get(provider).list_models
+        if provider not in self.fetchers:
+            raise ProviderNotFound(f'Provider not found: {provider}')
+        return self.fetchers[provider]
+
+    def get(self, provider):
+        fetch = self.fetcher(provider)
+
+        entry = self.cache.get(self.cache_key(provider))
+        if entry is None:
+            entry = self.refresh(provider, fetch)
+        else:
+            age = time.time() - entry['fetched_at']
+            if age >= self.options['TTL']:
+                self.refresh_in_background(provider)
+
+        max_age = max(0, int(self.options['TTL'] - (time.time() - entry['fetched_at'])))
+        return {**entry, 'max_age': max_age}
+
+    def cached(self, provider):
+        """The cached entry, stale or not, without ever fetching; None when there is none"""
+        return self.cache.get(self.cache_key(provider))
+
+    def refresh(self, provider, fetch=None):
+        models = (fetch or self.fetcher(provider))()
+        entry = {
+            'models': models,
+            'etag': hashlib.sha1(json.dumps(models).encode()).hexdigest(),
+            'fetched_at': time.time(),
+        }
+        self.cache.set(
+            self.cache_key(provider), entry,
+            timeout=self.options['TTL'] + self.options['STALE_TTL']
+        )
+        return entry
+
+    def refresh_in_background(self, provider):
+        """Starts at most one refresh per provider and process; a failed refresh keeps the stale entry."""
+        with self._lock:
+            if provider in self._refreshing:
+                return
+            self._refreshing.add(provider)
+
+        def run():
+            try:
+                self.refresh(provider)
+            except Exception:
+                logger.exception('Background refresh of the %s model catalog failed', provider)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(provider)
+
+        threading.Thread(target=run, name=f'model-catalog-{provider}', daemon=True).start()
+
+    def invalidate(self, provider):
+        self.cache.delete(self.cache_key(provider))
+
+
+model_catalog = ModelCatalog()
@@ -0,0 +1,163 @@
+"""
+Long-lived provider SDK clients.
+
+Building an ``OpenAI()``/``Anthropic()`` client creates a fresh httpx client, so doing it
+per request throws away the connection pool and pays for a new TLS handshake every time.
+``provider_clients`` builds each client once per process and hands the same instance to
+every request. Async clients are bound to the event loop that created their connections,
+so those are kept per loop.
+
+The SDKs themselves are imported on first use, which keeps them out of process start-up.
+"""
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_CLIENT_OPTIONS = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30.0,
+    'CONNECT_TIMEOUT': 5.0,
+    'READ_TIMEOUT': 60.0,
+    'WRITE_TIMEOUT': 10.0,
+    'POOL_TIMEOUT': 10.0,
+    'HTTP2': True,
+}
+
+SDK_CLASSES = {
+    ('openai', False): ('openai.OpenAI', 'OPENAI_API_KEY'),
+    ('openai', True): ('openai.AsyncOpenAI', 'OPENAI_API_KEY'),
+    ('anthropic', False): ('anthropic.Anthropic', 'ANTHROPIC_API_KEY'),
+    ('anthropic', True): ('anthropic.AsyncAnthropic', 'ANTHROPIC_API_KEY'),
+}
+
+
+class ProviderClientRegistry:
+    """
+    Process-wide cache of provider SDK clients sharing tuned httpx connection pools.
+
+    Options come from ``settings.PROVIDER_CLIENTS`` (see DEFAULT_CLIENT_OPTIONS) unless
+    passed in explicitly. HTTP/2 is only enabled when the ``h2`` package is importable.
+    """
+    def __init__(self, options=None):
+        self._explicit_options = options
+        self._options = options
+        self._lock = threading.Lock()
+        self._sync_clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._request_counts = {}
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_CLIENT_OPTIONS, **getattr(settings, 'PROVIDER_CLIENTS', {})}
+        return self._options
+
+    @property
+    def http2(self):
+        return bool(self.options['HTTP2']) and importlib.util.find_spec('h2') is not None
+
+    def openai(self):
+        return self._get('openai', is_async=False)
+
+    def anthropic(self):
+        return self._get('anthropic', is_async=False)
+
+    def async_openai(self):
+        return self._get('openai', is_async=True)
+
+    def async_anthropic(self):
+        return self._get('anthropic', is_async=True)
+
+    def _get(self, provider, is_async):
+        if is_async:
+            clients = self._async_clients.setdefault(asyncio.get_running_loop(), {})
+        else:
+            clients = self._sync_clients
+        client = clients.get(provider)
+        if client is None:
+            with self._lock:
+                client = clients.get(provider)
+                if client is None:
+                    client = clients[provider] = self._build(provider, is_async)
+        return client
+
+    def _build(self, provider, is_async):
+        sdk_path, api_key_name = SDK_CLASSES[(provider, is_async)]
+        sdk_class = import_string(sdk_path)
+        options = self.options
+        key = f"{provider}{'-async' if is_async else ''}"
+
+        def count_request(request):
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+
+        async def async_count_request(request):
+            count_request(request)
+
+        http_client_class = httpx.AsyncClient if is_async else httpx.Client
+        http_client = http_client_class(
+            http2=self.http2,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=options['MAX_CONNECTIONS'],
+                max_keepalive_connections=options['MAX_KEEPALIVE_CONNECTIONS'],
+                keepalive_expiry=options['KEEPALIVE_EXPIRY'],
+            ),
+            timeout=httpx.Timeout(
+                connect=options['CONNECT_TIMEOUT'],
+                read=options['READ_TIMEOUT'],
+                write=options['WRITE_TIMEOUT'],
+                pool=options['POOL_TIMEOUT'],
+            ),
+            event_hooks={'request': [async_count_request if is_async else count_request]},
+        )
+        # Async clients serve the completion streams, which core.resilience retries itself
+        retries = {'max_retries': 0} if is_async else {}
+        return sdk_class(api_key=os.getenv(api_key_name), http_client=http_client, **retries)
+
+    def stats(self):
+        """
+        Pool utilization per client: open, idle and busy connections plus requests sent.
+        Async clients are reported for every live event loop, summed per provider.
+        """
+        stats = {}
+        entries = [(provider, client) for provider, client in list(self._sync_clients.items())]
+        for clients in list(self._async_clients.values()):
+            entries += [(f'{provider}-async', client) for provider, client in list(clients.items())]
+
+        for key, client in entries:
+            pool = client._client._transport._pool
+            connections = pool.connections
+            idle = sum(1 for connection in connections if connection.is_idle())
+            entry = stats.setdefault(key, {
+                'connections': 0,
+                'idle': 0,
+                'active': 0,
+                'max_connections': self.options['MAX_CONNECTIONS'],
+                'max_keepalive_connections': self.options['MAX_KEEPALIVE_CONNECTIONS'],
+                'http2': self.http2,
+                'requests': self._request_counts.get(key, 0),
+            })
+            entry['connections'] += len(connections)
+            entry['idle'] += idle
+            entry['active'] += len(connections) - idle
+        return stats
+
+    def reset(self):
+        """Drops every cached client, e.g. after the API keys or base URLs change."""
+        with self._lock:
+            for client in self._sync_clients.values():
+                client.close()
+            self._sync_clients = {}
+            self._async_clients = weakref.WeakKeyDictionary()
+            self._request_counts = {}
+            self._options = self._explicit_options
+
+
+provider_clients = ProviderClientRegistry()
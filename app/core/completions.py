@@ -0,0 +1,218 @@
+"""
+The completion pipeline shared by CompletionView (WSGI) and AsyncCompletionView (ASGI).
+
+``stream_completion`` builds the bounded, normalized history (core.context), forwards the
+provider adapter's chunks to the client as server-sent events, coalesced into frames by
+core.sse, and queues the assistant reply, with the token usage the provider reported,
+for writing (core.persistence) once the provider is done. The reply is collected as a
+list of parts and joined once.
+
+Identical requests can be answered from core.responses instead of the provider, and
+identical requests in flight at the same time share one provider stream
+(core.singleflight). Requests sent with ``cache: false`` always get a call of their own.
+Every provider call waits for its turn under the provider's rate limits (core.scheduler),
+and the client is sent its queue position meanwhile. Failed calls are retried or failed
+over to another model before the first token (core.resilience).
+
+Each request records a core.metrics Timeline of its stages, from history load to
+persistence, exported as Prometheus histograms and fed to the model stats the ``auto``
+route selects models by (core.selector).
+
+In checkpoint mode the partial reply is also upserted every CHECKPOINT_INTERVAL seconds
+with status ``streaming``, so a reconnecting client can pick up the stored content
+instead of asking the provider again, and marked ``aborted`` if the stream fails. A
+stream cancelled because the client went away (core.streams) stores the part of the
+reply streamed so far as ``aborted`` in either mode.
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from .context import context_builder
+from .counters import amessage_changed, amessages_added
+from .metrics import Timeline
+from .models import Message
+from .persistence import message_writer
+from .resilience import resilient_streams
+from .responses import request_key, response_cache
+from .scheduler import scheduler
+from .selector import model_selector
+from .singleflight import single_flight
+from .serializers import MessageSerializer
+from .sse import coalesce, encode_event
+from .tokens import count_tokens
+from .usage import arecord_usage
+
+logger = logging.getLogger('api')
+
+DEFAULT_COMPLETION_OPTIONS = {
+    # Store the partial reply while it streams, as a Message with status 'streaming'
+    'CHECKPOINT': False,
+    # Seconds between checkpoint writes
+    'CHECKPOINT_INTERVAL': 1.0,
+    # Let identical concurrent requests share one provider stream (core.singleflight)
+    'SINGLE_FLIGHT': True,
+}
+
+
+def completion_options():
+    return {**DEFAULT_COMPLETION_OPTIONS, **getattr(settings, 'COMPLETIONS', {})}
+
+
+async def checkpoint(chatroom, message, parts, status=Message.STREAMING):
+    """
+    Upserts the partial assistant reply. Its token count is left for the final save, or
+    for the context builder to backfill if the stream never finishes. The chatroom's
+    preview follows the first checkpoint and the last one, not every one in between.
+    """
+    content = ''.join(parts)
+    if message is None:
+        message = await Message.objects.acreate(chatroom=chatroom, role='assistant', content=content, status=status)
+        await amessages_added([message])
+        return message
+    message.content, message.status, message.token_count = content, status, None
+    await Message.objects.filter(id=message.id).aupdate(content=content, status=status, token_count=None)
+    if status != Message.STREAMING:
+        await amessage_changed(message)
+    return message
+
+
+async def stream_completion(adapter, model_id, chatroom, system_prompt, use_cache=True, priority=0, max_wait=None,
+                            timeline=None, target=None):
+    """
+    Yields the SSE frames of one completion. ``target`` is added to every event, to tell
+    apart streams multiplexed into one connection (core.fanout).
+    """
+    options = completion_options()
+    tag = {'target': target} if target else {}
+    timeline = timeline or Timeline()
+    timeline.provider, timeline.model_id = adapter.name, model_id
+    message = ticket = opened = None
+    parts = []
+    input_tokens = output_tokens = cache_read_tokens = cache_write_tokens = None
+    outcome = 'aborted'
+    try:
+        with timeline.span('history_load'):
+            # The prompt may still be queued for writing
+            await message_writer.aflush(chatroom.id)
+            context = await context_builder.build(adapter, model_id, chatroom, system_prompt)
+
+        # A cached reply is replayed through the same frames as a live one
+        cache_key = cached = chunks = None
+        leader = True
+        shared = use_cache and options['SINGLE_FLIGHT']
+        if use_cache and response_cache.enabled:
+            cache_key, cached = response_cache.lookup(adapter, model_id, context)
+        if cached is not None:
+            chunks = response_cache.replay(cached)
+        elif shared:
+            cache_key = cache_key or request_key(adapter, model_id, context)
+            chunks = single_flight.join(cache_key)
+            leader = chunks is None
+
+        if chunks is None:
+            # Opening a provider stream of our own has to fit the provider's rate limits
+            estimate = context.tokens + count_tokens(context.system_prompt) + adapter.max_tokens
+            ticket = scheduler.ticket(adapter.name, model_id, estimate, priority, max_wait)
+            if ticket is not None:
+                queued = time.perf_counter()
+                async for position in scheduler.wait(ticket):
+                    yield encode_event({'type': 'queued', 'position': position, **tag})
+                timeline.add_span('queue_wait', queued)
+
+            opened = time.perf_counter()
+
+            def open_stream():
+                return resilient_streams.stream(adapter, model_id, context.history, context.system_prompt)
+
+            if shared:
+                chunks, leader = single_flight.stream(cache_key, open_stream)
+                if not leader:
+                    await scheduler.release(ticket, tokens=0)
+            else:
+                chunks = open_stream()
+
+        # Forward the chunks to the frontend as they come in, a batch per frame
+        checkpoint_at = 0
+        async for batch in coalesce(chunks):
+            if opened is not None:
+                timeline.add_span('provider_connect', opened)
+                opened = None
+            for chunk in batch:
+                if chunk.input_tokens is not None:
+                    input_tokens = chunk.input_tokens
+                if chunk.output_tokens is not None:
+                    output_tokens = chunk.output_tokens
+                if chunk.cache_read_tokens is not None:
+                    cache_read_tokens = chunk.cache_read_tokens
+                if chunk.cache_write_tokens is not None:
+                    cache_write_tokens = chunk.cache_write_tokens
+            content = ''.join([chunk.content for chunk in batch])
+            if content:
+                timeline.mark('first_token')
+                if timeline.sampled:
+                    logger.debug('%s %s: %d chunks, %d chars', adapter.name, model_id, len(batch), len(content))
+                parts.append(content)
+                yield encode_event({'content': content, 'type': 'chunk', **tag})
+                if options['CHECKPOINT'] and time.monotonic() >= checkpoint_at:
+                    message = await checkpoint(chatroom, message, parts)
+                    checkpoint_at = time.monotonic() + options['CHECKPOINT_INTERVAL']
+
+        if 'first_token' in timeline.marks:
+            timeline.mark('last_token')
+            timeline.add_span('stream', timeline.marks['first_token'], timeline.marks['last_token'])
+        persisting = time.perf_counter()
+
+        # Save the complete message after streaming
+        fields = {
+            'content': ''.join(parts),
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'cache_read_tokens': cache_read_tokens,
+            'cache_write_tokens': cache_write_tokens,
+            'status': Message.COMPLETE,
+            'source': Message.CACHE if cached is not None else Message.PROVIDER if leader else Message.SHARED,
+        }
+        if message is None:
+            message = await message_writer.aadd(Message(chatroom=chatroom, role='assistant', **fields))
+        else:
+            for name, value in fields.items():
+                setattr(message, name, value)
+            await message.asave(update_fields=[*fields, 'token_count'])
+            await amessage_changed(message, input_tokens, output_tokens)
+        # Provider usage is accounted to the request that made the call
+        if cached is None and leader:
+            await arecord_usage(chatroom.id, adapter.name, model_id, input_tokens, output_tokens)
+            if cache_key is not None and response_cache.enabled:
+                response_cache.store(cache_key, adapter, model_id, context, message.content, input_tokens, output_tokens)
+        timeline.add_span('persist', persisting)
+        outcome = 'cached' if cached is not None else 'complete' if leader else 'shared'
+
+        # Send final message with complete content
+        yield encode_event({'type': 'done', 'message': MessageSerializer(message).data, **tag})
+        # The stream only ends once the reply is written, the client already has it
+        await message_writer.aflush(chatroom.id)
+
+        if await context_builder.needs_summary(chatroom, context):
+            context_builder.schedule_summary(adapter, model_id, chatroom, context.oldest_included_at)
+
+    except (GeneratorExit, asyncio.CancelledError):
+        # The client went away or cancelled the stream; keep the part of the reply it got
+        if outcome == 'aborted' and (message is not None or parts):
+            await checkpoint(chatroom, message, parts, status=Message.ABORTED)
+        raise
+
+    except Exception as e:
+        outcome = 'error'
+        logger.warning('%s streaming error: %s', adapter.name, e)
+        if message is not None:
+            await checkpoint(chatroom, message, parts, status=Message.ABORTED)
+        yield encode_event({'error': str(e), **tag})
+
+    finally:
+        used = (input_tokens or 0) + (output_tokens or 0) if input_tokens is not None else None
+        await scheduler.release(ticket, used)
+        timeline.finish(outcome, output_tokens)
+        model_selector.observe(timeline)
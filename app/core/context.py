@@ -0,0 +1,237 @@
+"""
+Bounded context windows for completions.
+
+Instead of sending the whole chatroom history on every turn, ``ContextBuilder`` walks the
+history newest-first in small pages and stops as soon as the model's token budget is
+spent, so both the request size and the rows read stay flat however long a chat gets.
+
+Token counts are cached on ``Message.token_count`` when a message is written; rows from
+before that column existed are counted once here and backfilled. Optionally, the turns
+that fall out of the window are folded into ``ChatRoom.summary`` by the same model and
+sent along with the system prompt. Those summary calls take the same path as completions:
+they queue under the provider's rate limits (core.scheduler), go through retries and
+failover (core.resilience) and are recorded in the chatroom's usage (core.usage).
+
+Providers cache prompt prefixes, so a window that slides forward a turn at a time would
+change the prefix, and miss the cache, on every request. With STABLE_PREFIX the start of
+the window is kept in ``ChatRoom.context_start`` instead: the history grows from there
+until it no longer fits, and is then cut down to TRIM_TO of the budget in one go, so the
+prefix only changes once every few turns.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db.models import Sum
+
+from .models import ChatRoom, Message
+from .pagination import keyset_filter
+from .resilience import resilient_streams
+from .scheduler import scheduler
+from .tokens import count_message_tokens, count_tokens
+from .usage import arecord_usage
+
+logger = logging.getLogger('api')
+
+DEFAULT_CONTEXT_OPTIONS = {
+    # Upper bound on history tokens per request, whatever the model's window
+    'MAX_HISTORY_TOKENS': 8000,
+    # Messages read per query while walking back through the history
+    'FETCH_BATCH_SIZE': 50,
+    # Summarize turns that no longer fit into ChatRoom.summary after a completion
+    'SUMMARIZE': False,
+    # Dropped, not yet summarized tokens it takes to trigger a new summary
+    'SUMMARY_MIN_TOKENS': 1000,
+    # Most transcript tokens handed to the model in one summarization call
+    'SUMMARY_MAX_TOKENS': 4000,
+    # Place of summary calls in the rate limit queue and how long they may wait there
+    'SUMMARY_PRIORITY': -5,
+    'SUMMARY_MAX_WAIT': 600.0,
+    # Keep the start of the window in place between turns, for the providers' prompt caches
+    'STABLE_PREFIX': True,
+    # Fraction of the budget a history that outgrew it is cut down to
+    'TRIM_TO': 0.5,
+}
+
+NEWEST_FIRST = ('-created_at', '-id')
+
+SUMMARY_PROMPT = (
+    'Summarize the conversation below so the summary can stand in for the original messages. '
+    'Keep facts, decisions, names and open questions. Be concise.'
+)
+
+
+@dataclass
+class Context:
+    history: list = field(default_factory=list)
+    system_prompt: str = ''
+    tokens: int = 0
+    # True when older messages were left out of ``history``
+    truncated: bool = False
+    oldest_included_at: object = None
+
+
+class ContextBuilder:
+    def __init__(self, options=None):
+        # Overrides on top of the defaults and settings.CONTEXT_BUILDER, so callers only
+        # pass the options they care about
+        self._overrides = options or {}
+        self._options = None
+        self._summarizing = {}
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {
+                **DEFAULT_CONTEXT_OPTIONS, **getattr(settings, 'CONTEXT_BUILDER', {}), **self._overrides,
+            }
+        return self._options
+
+    def budget(self, adapter, model_id, system_prompt=''):
+        """History tokens available once the system prompt and the reply are accounted for"""
+        window = adapter.context_window(model_id) - adapter.max_tokens
+        return max(0, min(window, self.options['MAX_HISTORY_TOKENS']) - count_tokens(system_prompt))
+
+    async def build(self, adapter, model_id, chatroom, system_prompt=''):
+        budget = self.budget(adapter, model_id, system_prompt)
+        if chatroom.summary:
+            budget -= count_tokens(chatroom.summary)
+        stable = self.options['STABLE_PREFIX']
+        start = chatroom.context_start if stable else None
+
+        batch_size = self.options['FETCH_BATCH_SIZE']
+        queryset = (
+            Message.objects.filter(chatroom=chatroom)
+            .order_by(*NEWEST_FIRST)
+            .values_list('id', 'role', 'content', 'token_count', 'created_at')
+        )
+        selected, backfill = [], []
+        used, truncated, overflow, before = 0, False, False, None
+
+        while True:
+            page = queryset.filter(keyset_filter(NEWEST_FIRST, before)) if before else queryset
+            rows = [row async for row in page[:batch_size]]
+            for message_id, role, content, token_count, created_at in rows:
+                if token_count is None:
+                    token_count = count_message_tokens(content)
+                    backfill.append(Message(id=message_id, token_count=token_count))
+                if start is not None and created_at < start and selected:
+                    truncated = True
+                    break
+                # The newest message (the prompt) is always sent, even if it alone is over budget
+                if selected and used + token_count > budget:
+                    truncated = overflow = True
+                    break
+                selected.append((role, content, created_at, token_count))
+                used += token_count
+            if truncated or len(rows) < batch_size:
+                break
+            before = (rows[-1][4], rows[-1][0])
+
+        if overflow and stable:
+            # Cut down further now, so the next turns have room to grow into
+            while len(selected) > 1 and used > budget * self.options['TRIM_TO']:
+                used -= selected.pop()[3]
+
+        selected.reverse()
+        # A trimmed history has to start on a user turn
+        while truncated and len(selected) > 1 and selected[0][0] != 'user':
+            used -= selected.pop(0)[3]
+
+        if overflow and stable and selected[0][2] != chatroom.context_start:
+            chatroom.context_start = selected[0][2]
+            await ChatRoom.objects.filter(id=chatroom.id).aupdate(context_start=chatroom.context_start)
+
+        if backfill:
+            await Message.objects.abulk_update(backfill, ['token_count'])
+
+        if truncated and chatroom.summary:
+            system_prompt = f'{system_prompt}\n\nSummary of the earlier conversation:\n{chatroom.summary}'.strip()
+
+        return Context(
+            history=[{'role': role, 'content': content} for role, content, _, _ in selected],
+            system_prompt=system_prompt,
+            tokens=used,
+            truncated=truncated,
+            oldest_included_at=selected[0][2] if selected else None,
+        )
+
+    async def needs_summary(self, chatroom, context):
+        """
+        True once enough dropped turns have piled up since the last summary. Summarizing on
+        every turn would cost a provider call per message as the window slides forward.
+        """
+        if not (self.options['SUMMARIZE'] and context.truncated):
+            return False
+        gap = Message.objects.filter(chatroom=chatroom, created_at__lt=context.oldest_included_at)
+        if chatroom.summary_until:
+            gap = gap.filter(created_at__gte=chatroom.summary_until)
+        unsummarized = (await gap.aaggregate(tokens=Sum('token_count')))['tokens'] or 0
+        return unsummarized >= self.options['SUMMARY_MIN_TOKENS']
+
+    def schedule_summary(self, adapter, model_id, chatroom, until):
+        """Runs ``summarize`` in the background, at most once per chatroom at a time"""
+        if chatroom.id in self._summarizing:
+            return
+
+        async def run():
+            try:
+                await self.summarize(adapter, model_id, chatroom, until)
+            except Exception:
+                logger.exception('Summarizing chatroom %s failed', chatroom.id)
+            finally:
+                self._summarizing.pop(chatroom.id, None)
+
+        self._summarizing[chatroom.id] = asyncio.ensure_future(run())
+
+    async def summarize(self, adapter, model_id, chatroom, until):
+        """
+        Folds the messages between ``chatroom.summary_until`` and ``until`` into the stored
+        summary. At most SUMMARY_MAX_TOKENS of the newest such messages are read; anything
+        older than that is only represented through the previous summary.
+        """
+        queryset = Message.objects.filter(chatroom=chatroom, created_at__lt=until).order_by('-created_at')
+        if chatroom.summary_until:
+            queryset = queryset.filter(created_at__gte=chatroom.summary_until)
+
+        lines, used = [], 0
+        async for role, content, token_count in queryset.values_list('role', 'content', 'token_count'):
+            token_count = token_count or count_message_tokens(content)
+            if lines and used + token_count > self.options['SUMMARY_MAX_TOKENS']:
+                break
+            lines.append(f'{role}: {content}')
+            used += token_count
+        lines.reverse()
+
+        transcript = '\n\n'.join(lines)
+        if chatroom.summary:
+            transcript = f'Earlier summary:\n{chatroom.summary}\n\n{transcript}'
+        history = [{'role': 'user', 'content': transcript}]
+
+        estimate = count_tokens(SUMMARY_PROMPT) + count_message_tokens(transcript) + adapter.max_tokens
+        ticket = scheduler.ticket(adapter.name, model_id, estimate, self.options['SUMMARY_PRIORITY'],
+                                  self.options['SUMMARY_MAX_WAIT'])
+        parts = []
+        input_tokens = output_tokens = None
+        try:
+            if ticket is not None:
+                async for _ in scheduler.wait(ticket):
+                    pass
+            async for chunk in resilient_streams.stream(adapter, model_id, history, SUMMARY_PROMPT):
+                parts.append(chunk.content)
+                if chunk.input_tokens is not None:
+                    input_tokens = chunk.input_tokens
+                if chunk.output_tokens is not None:
+                    output_tokens = chunk.output_tokens
+        finally:
+            used = (input_tokens or 0) + (output_tokens or 0) if input_tokens is not None else None
+            await scheduler.release(ticket, used)
+        await arecord_usage(chatroom.id, adapter.name, model_id, input_tokens, output_tokens)
+
+        chatroom.summary = ''.join(parts).strip()
+        chatroom.summary_until = until
+        await ChatRoom.objects.filter(id=chatroom.id).aupdate(summary=chatroom.summary, summary_until=until)
+
+
+context_builder = ContextBuilder()
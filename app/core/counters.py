@@ -0,0 +1,67 @@
+"""
+Denormalized chatroom fields for the chatroom list.
+
+ChatRoom carries its message count, the time and a preview of its last message and the
+provider token totals of its replies, so the sidebar reads one row per chatroom instead
+of fetching every chatroom's messages. Whatever writes messages (core.persistence, the
+checkpoints of core.completions) reports them here, in the same transaction as the write
+where there is one. Counters are F-expression increments and the last message only ever
+moves forward, so concurrent writers neither lose an update nor put an older message back.
+"""
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from .models import ChatRoom
+
+PREVIEW_LENGTH = 100
+
+
+def preview(content):
+    return ' '.join(content[:PREVIEW_LENGTH * 2].split())[:PREVIEW_LENGTH]
+
+
+def last_message(message):
+    """Update kwargs pointing the last message fields at ``message``, unless a later one is there"""
+    later = Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.created_at)
+    return {
+        'last_message_at': Case(When(later, then=Value(message.created_at)), default=F('last_message_at')),
+        'last_message_preview': Case(
+            When(later, then=Value(preview(message.content))), default=F('last_message_preview'),
+        ),
+    }
+
+
+def messages_added(messages):
+    """Counts newly inserted ``messages`` into their chatrooms and bumps their updated_at"""
+    now = timezone.now()
+    chatrooms = defaultdict(list)
+    for message in messages:
+        chatrooms[message.chatroom_id].append(message)
+    for chatroom_id, added in chatrooms.items():
+        ChatRoom.objects.filter(id=chatroom_id).update(
+            message_count=F('message_count') + len(added),
+            input_tokens=F('input_tokens') + sum(message.input_tokens or 0 for message in added),
+            output_tokens=F('output_tokens') + sum(message.output_tokens or 0 for message in added),
+            updated_at=now,
+            **last_message(max(added, key=lambda message: message.created_at)),
+        )
+
+
+def message_changed(message, input_tokens=0, output_tokens=0):
+    """
+    Refreshes the preview after a stored message's content changed, adding the tokens it
+    was given since it was counted.
+    """
+    ChatRoom.objects.filter(id=message.chatroom_id).update(
+        input_tokens=F('input_tokens') + (input_tokens or 0),
+        output_tokens=F('output_tokens') + (output_tokens or 0),
+        updated_at=timezone.now(),
+        **last_message(message),
+    )
+
+
+amessages_added = sync_to_async(messages_added)
+amessage_changed = sync_to_async(message_changed)
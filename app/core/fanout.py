@@ -0,0 +1,134 @@
+"""
+Fan-out of one prompt to several models at once, to compare their answers.
+
+``create_comparison()`` stores a Comparison with a ComparisonTarget and a chatroom of its
+own per target model, the prompt queued as each chatroom's first message.
+``stream_comparison()`` then runs the completion pipeline (core.completions) for every
+target concurrently and multiplexes their frames into one stream as they come in, each
+tagged with its ``target`` (``provider/model_id``). Targets queue for rate limits, retry
+and fail over on their own, and one failing does not hold up the others.
+
+When a target is done, its time to first token and total time (both from the request) are
+stored on its ComparisonTarget and sent in a ``timing`` frame; the completion histograms
+of core.metrics record them as for any completion. The stream ends with a ``summary``
+frame listing every target, fastest first.
+"""
+import asyncio
+import logging
+import math
+import time
+
+from django.db import transaction
+
+from .completions import stream_completion
+from .models import ChatRoom, Comparison, ComparisonTarget, Message
+from .persistence import message_writer
+from .providers import providers
+from .serializers import ComparisonTargetSerializer
+from .sse import encode_event
+
+logger = logging.getLogger('api')
+
+
+def parse_targets(values):
+    """
+    Splits every ``provider/model_id`` (model ids may contain slashes). Raises ValueError,
+    or ProviderNotFound for a provider that is not configured.
+    """
+    targets = []
+    for value in values:
+        provider, _, model_id = value.partition('/')
+        if not provider or not model_id:
+            raise ValueError(f'Expected provider/model_id, got {value!r}')
+        targets.append((providers.get(provider).name, model_id))
+    return targets
+
+
+def create_comparison(message, system_prompt, targets):
+    """
+    Stores the comparison of ``targets``, a list of ``(provider, model_id)``, and queues
+    the prompt in each target's chatroom. Returns the comparison and its targets.
+    """
+    with transaction.atomic():
+        comparison = Comparison.objects.create(message=message, system_prompt=system_prompt)
+        chatrooms = ChatRoom.objects.bulk_create([
+            ChatRoom(title=message[:50], provider=provider, model_id=model_id, system_prompt=system_prompt)
+            for provider, model_id in targets
+        ])
+        rows = ComparisonTarget.objects.bulk_create([
+            ComparisonTarget(comparison=comparison, chatroom=chatroom, position=position,
+                             provider=chatroom.provider, model_id=chatroom.model_id)
+            for position, chatroom in enumerate(chatrooms)
+        ])
+    for chatroom in chatrooms:
+        message_writer.add(Message(chatroom=chatroom, role='user', content=message))
+    return comparison, rows
+
+
+def fastest_first(target):
+    return target.status != ComparisonTarget.COMPLETE, target.time_to_first_token or math.inf
+
+
+async def record_timing(target, timeline):
+    first = timeline.marks.get('first_token')
+    complete = timeline.outcome in ('complete', 'cached', 'shared')
+    target.status = ComparisonTarget.COMPLETE if complete else ComparisonTarget.ERROR
+    target.time_to_first_token = first - timeline.started if first is not None else None
+    target.total_time = (timeline.finished or time.perf_counter()) - timeline.started
+    target.output_tokens = timeline.output_tokens
+    await ComparisonTarget.objects.filter(id=target.id).aupdate(
+        status=target.status,
+        time_to_first_token=target.time_to_first_token,
+        total_time=target.total_time,
+        output_tokens=target.output_tokens,
+    )
+
+
+async def stream_comparison(comparison, targets, timelines, use_cache=True, priority=0, max_wait=None):
+    """
+    Yields the multiplexed SSE frames of every target's completion; ``timelines`` holds
+    one core.metrics Timeline per target, started when the request came in.
+    """
+    queue = asyncio.Queue()
+
+    async def run(target, timeline):
+        try:
+            async for frame in stream_completion(
+                providers.get(target.provider), target.model_id, target.chatroom, comparison.system_prompt,
+                use_cache=use_cache, priority=priority, max_wait=max_wait, timeline=timeline, target=target.label,
+            ):
+                await queue.put(frame)
+        except Exception as e:
+            # Only this target failed, the others go on
+            logger.warning('Comparison target %s failed: %s', target.label, e)
+            await queue.put(encode_event({'error': str(e), 'target': target.label}))
+        finally:
+            # Anything that is not a frame marks the end of a target
+            queue.put_nowait((target, timeline))
+
+    tasks = [asyncio.create_task(run(target, timeline)) for target, timeline in zip(targets, timelines)]
+    try:
+        yield encode_event({
+            'type': 'comparison',
+            'comparison_id': str(comparison.id),
+            'targets': [{'target': target.label, 'chatroom_id': str(target.chatroom_id)} for target in targets],
+        })
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if isinstance(item, bytes):
+                yield item
+                continue
+            target, timeline = item
+            remaining -= 1
+            await record_timing(target, timeline)
+            yield encode_event({'type': 'timing', **ComparisonTargetSerializer(target).data})
+        yield encode_event({
+            'type': 'summary',
+            'comparison_id': str(comparison.id),
+            'targets': ComparisonTargetSerializer(sorted(targets, key=fastest_first), many=True).data,
+        })
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,165 @@
+"""
+Shared plumbing for the benchmark management commands.
+
+Benchmarks run against a throwaway database (a temporary file on SQLite) so they never
+touch the development database, and drive the ASGI application in-process so no server
+needs to be running.
+"""
+import asyncio
+import json
+import os
+import resource
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from core.clients import provider_clients
+from core.counters import messages_added
+from core.models import Message
+from core.tokens import count_message_tokens
+
+
+@contextmanager
+def scratch_database(verbosity=0):
+    """
+    Creates a migrated test database for the duration of the block: a temporary SQLite
+    file, or the usual ``test_<name>`` database on PostgreSQL.
+    """
+    connection = connections['default']
+    path = None
+    if connection.vendor == 'sqlite':
+        handle, path = tempfile.mkstemp(suffix='.sqlite3', prefix='navi-bench-')
+        os.close(handle)
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = path
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield path or connection.settings_dict['NAME']
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if path and os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def fake_provider():
+    """
+    Settings override registering the fake provider (settings.FAKE_COMPLETION_PROVIDER),
+    which is off by default. Use it as a context manager or call enable() and disable().
+    """
+    return override_settings(
+        COMPLETION_PROVIDERS={**settings.COMPLETION_PROVIDERS, 'fake': settings.FAKE_COMPLETION_PROVIDER},
+    )
+
+
+@contextmanager
+def stub_provider_env(server):
+    """Points both provider SDKs (and the shared client registry) at a StubProviderServer."""
+    overrides = {
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': server.openai_base_url,
+        'ANTHROPIC_API_KEY': 'stub',
+        'ANTHROPIC_BASE_URL': server.anthropic_base_url,
+    }
+    previous = {key: os.environ.get(key) for key in overrides}
+    os.environ.update(overrides)
+    provider_clients.reset()
+    try:
+        yield
+    finally:
+        provider_clients.reset()
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def seed_messages(chatroom, count, content='benchmark message', start=None, batch_size=1000, token_counts=True):
+    """
+    Bulk inserts ``count`` alternating user/assistant messages one second apart, ending
+    now, and counts them into the chatroom. bulk_create skips Message.save(), so
+    ``token_counts=False`` leaves them unset.
+    """
+    start = start or timezone.now() - timedelta(seconds=count)
+    for offset in range(0, count, batch_size):
+        messages = []
+        for index in range(offset, min(count, offset + batch_size)):
+            text = f'{content} {index}'
+            messages.append(Message(
+                chatroom=chatroom,
+                role='user' if index % 2 == 0 else 'assistant',
+                content=text,
+                created_at=start + timedelta(seconds=index),
+                token_count=count_message_tokens(text) if token_counts else None,
+            ))
+        Message.objects.bulk_create(messages)
+        messages_added(messages)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def asgi_request(app, method, path, body=None, headers=(), on_start=None, on_body=None, disconnect=None):
+    """
+    Sends one HTTP request straight into an ASGI application.
+
+    ``on_start(status)`` is called when the response starts and ``on_body(chunk)`` for every
+    body chunk, which lets callers observe streams while they are still open. The client
+    hangs up once the ``disconnect`` future, if given, is done.
+    Returns ``(status, body_bytes)``.
+    """
+    payload = json.dumps(body).encode() if body is not None else b''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [
+            (b'host', b'localhost'),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+            *headers,
+        ],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 8000),
+    }
+    request_sent = False
+    never = disconnect or asyncio.get_running_loop().create_future()
+    response = {'status': None, 'body': []}
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': payload, 'more_body': False}
+        # The client stays connected until the application is done with the request
+        await never
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            if on_start:
+                on_start(message['status'])
+        elif message['type'] == 'http.response.body':
+            chunk = message.get('body', b'')
+            if chunk:
+                response['body'].append(chunk)
+                if on_body:
+                    on_body(chunk)
+
+    await app(scope, receive, send)
+    return response['status'], b''.join(response['body'])
@@ -0,0 +1,67 @@
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from core.context import ContextBuilder
+from core.management.benchmark import scratch_database, seed_messages
+from core.models import ChatRoom
+from core.providers import providers
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the request size and DB cost of sending the full chat history against the '
+        'bounded context builder as chats grow. Runs against a scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', default='10,100,1000,5000',
+                            help='Comma separated chat lengths to measure')
+        parser.add_argument('--words', type=int, default=60, help='Words per seeded message')
+        parser.add_argument('--provider', default='anthropic')
+        parser.add_argument('--model', default='claude-3-5-sonnet-20241022')
+        parser.add_argument('--max-history-tokens', type=int, default=8000)
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement, the best is kept')
+
+    def handle(self, *args, **options):
+        adapter = providers.get(options['provider'])
+        builder = ContextBuilder({'MAX_HISTORY_TOKENS': options['max_history_tokens'], 'SUMMARIZE': False})
+        content = ' '.join(['word'] * options['words'])
+
+        with scratch_database():
+            self.stdout.write(f"{'messages':>9} | {'full: sent':>10} {'KB':>8} {'ms':>8} | "
+                              f"{'bounded: sent':>13} {'KB':>6} {'ms':>6} {'queries':>7}")
+            for count in [int(value) for value in options['messages'].split(',')]:
+                chatroom = ChatRoom.objects.create(title=f'{count} messages', provider=options['provider'],
+                                                   model_id=options['model'])
+                seed_messages(chatroom, count, content=content)
+
+                def full_history():
+                    return [{'role': msg.role, 'content': msg.content} for msg in chatroom.messages.all()]
+
+                def bounded_history():
+                    return async_to_sync(builder.build)(adapter, options['model'], chatroom).history
+
+                full, full_ms = self.best_of(full_history, options['repeat'])
+                with CaptureQueriesContext(connection) as queries:
+                    bounded = bounded_history()
+                bounded, bounded_ms = self.best_of(bounded_history, options['repeat'])
+
+                self.stdout.write(
+                    f'{count:>9} | {len(full):>10} {len(json.dumps(full)) / 1024:>8.1f} {full_ms:>8.2f} | '
+                    f'{len(bounded):>13} {len(json.dumps(bounded)) / 1024:>6.1f} {bounded_ms:>6.2f} '
+                    f'{len(queries):>7}'
+                )
+
+    def best_of(self, func, repeat):
+        best, result = None, None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
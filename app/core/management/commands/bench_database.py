@@ -0,0 +1,111 @@
+import multiprocessing
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.utils.module_loading import import_string
+
+from core.management.benchmark import scratch_database, stub_provider_env
+from core.stubserver import StubProviderServer
+
+
+def database_modes():
+    """The connection settings compared on the configured database engine"""
+    configured = dict(settings.DATABASES['default'].get('OPTIONS', {}))
+    if connections['default'].vendor == 'sqlite':
+        return {'default': {}, 'tuned': configured}
+    direct = {key: value for key, value in configured.items() if key != 'pool'}
+    return {'direct': direct, 'pooled': {**direct, 'pool': configured.get('pool') or True}}
+
+
+def start_worker(checkpoint):
+    if checkpoint:
+        settings.COMPLETIONS = {**settings.COMPLETIONS, 'CHECKPOINT': True, 'CHECKPOINT_INTERVAL': 0.05}
+
+
+def run_streams(count):
+    """Runs ``count`` completions at once through CompletionView, returns (seconds, errors) per completion"""
+    def one_stream(index):
+        started = time.perf_counter()
+        response = Client(HTTP_HOST='localhost', raise_request_exception=False).post(
+            '/api/providers/openai/models/stub-model/complete', {'message': f'database benchmark {index}'},
+            content_type='application/json',
+        )
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        failed = response.status_code != 200 or b'"error"' in body or b'"type":"done"' not in body
+        return time.perf_counter() - started, failed
+
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        return list(pool.map(one_stream, range(count)))
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs N completions in parallel, spread over worker processes like a multi-worker '
+        'deployment, against a local stub provider, and reports throughput, latency and failed '
+        'writes. On SQLite it compares the default journal against the tuned WAL settings, on '
+        'PostgreSQL direct connections against the psycopg pool. Runs against a scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--completions', default='10,50,200',
+                            help='Comma separated numbers of parallel completions to run')
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes sharing the completions')
+        parser.add_argument('--tokens', type=int, default=20, help='Tokens per stubbed completion')
+        parser.add_argument('--token-delay', type=float, default=0.01,
+                            help='Seconds the stub provider waits between tokens')
+        parser.add_argument('--checkpoint', action='store_true',
+                            help='Also checkpoint partial replies every 50ms, for more concurrent writes')
+
+    def handle(self, *args, **options):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError('bench_database forks its worker processes, which this platform does not support')
+        levels = [int(level) for level in options['completions'].split(',')]
+        # Imported once here so the forked workers do not each pay for it in their first request
+        import_string('openai.AsyncOpenAI')
+
+        with scratch_database(), \
+                StubProviderServer(tokens=options['tokens'], token_delay=options['token_delay']) as server, \
+                stub_provider_env(server):
+            vendor = connections['default'].vendor
+            self.stdout.write(f"engine={vendor} workers={options['workers']} tokens={options['tokens']} "
+                              f"token_delay={options['token_delay']}s checkpoint={options['checkpoint']}")
+            self.stdout.write(f"{'mode':>8} {'parallel':>9} | {'done':>6} {'failed':>7} {'wall s':>7} "
+                              f"{'per s':>7} {'p50 ms':>8} {'p95 ms':>8}")
+            for mode, mode_options in database_modes().items():
+                for level in levels:
+                    results, wall = self.run(mode_options, level, options)
+                    latencies = sorted(seconds for seconds, failed in results)
+                    failed = sum(failed for _, failed in results)
+                    self.stdout.write(
+                        f'{mode:>8} {level:>9} | {len(results) - failed:>6} {failed:>7} {wall:>7.2f} '
+                        f'{len(results) / wall:>7.1f} {statistics.median(latencies) * 1000:>8.0f} '
+                        f'{latencies[int(len(latencies) * 0.95) - 1] * 1000:>8.0f}'
+                    )
+
+    def run(self, mode_options, level, options):
+        connection = connections['default']
+        connection.close()
+        connection.settings_dict['OPTIONS'] = mode_options
+        if connection.vendor == 'sqlite':
+            # journal_mode sticks to the database file, switch it back for the default mode
+            with connection.cursor() as cursor:
+                if 'journal_mode' not in mode_options.get('init_command', ''):
+                    cursor.execute('PRAGMA journal_mode=DELETE')
+        # Forked workers must not share the parent's connections
+        connections.close_all()
+        close_pool = getattr(connections['default'], 'close_pool', None)
+        if close_pool is not None:
+            close_pool()
+        workers = min(options['workers'], level)
+        shares = [level // workers + (index < level % workers) for index in range(workers)]
+        context = multiprocessing.get_context('fork')
+        started = time.perf_counter()
+        with context.Pool(workers, initializer=start_worker, initargs=(options['checkpoint'],)) as pool:
+            results = [result for share in pool.map(run_streams, shares) for result in share]
+        return results, time.perf_counter() - started
@@ -0,0 +1,75 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIClient
+
+from core.management.benchmark import scratch_database, seed_messages
+from core.models import ChatRoom
+from core.pagination import encode_cursor, keyset_filter
+
+NEWEST_FIRST = ('-created_at', '-id')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares OFFSET against keyset pagination of a chatroom\'s messages as it grows, '
+        'at the newest, middle and oldest page. Runs against a scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', default='10000,100000,1000000',
+                            help='Comma separated chat lengths to measure, seeded incrementally')
+        parser.add_argument('--limit', type=int, default=100, help='Page size')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement, the best is kept')
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+
+        with scratch_database():
+            chatroom = ChatRoom.objects.create(title='pagination', provider='openai', model_id='gpt-4o')
+            messages = chatroom.messages.order_by(*NEWEST_FIRST)
+            client = APIClient(HTTP_HOST='localhost')
+            seeded = 0
+
+            self.stdout.write(f"{'messages':>9} {'page':>7} | {'offset ms':>9} {'keyset ms':>9} | "
+                              f"{'api ms':>7} {'since ms':>8}")
+            for count in [int(value) for value in options['messages'].split(',')]:
+                if count > seeded:
+                    # Older messages go in front of the existing ones, the newest page stays put
+                    oldest = messages.last()
+                    start = oldest.created_at - timedelta(seconds=count - seeded) if oldest else None
+                    seed_messages(chatroom, count - seeded, start=start)
+                    seeded = count
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE')
+
+                for label, depth in (('newest', 0), ('middle', count // 2), ('oldest', count - limit)):
+                    offset_ms = self.best_of(lambda: list(messages[depth:depth + limit]), options['repeat'])
+                    cursor = None
+                    if depth:
+                        cursor = messages.values_list('created_at', 'id')[depth - 1]
+                    page = messages.filter(keyset_filter(NEWEST_FIRST, cursor)) if cursor else messages
+                    keyset_ms = self.best_of(lambda: list(page[:limit]), options['repeat'])
+
+                    url = f'/api/chatrooms/{chatroom.id}/messages?limit={limit}'
+                    if cursor:
+                        url += f'&before={encode_cursor(cursor)}'
+                    api_ms = self.best_of(lambda: client.get(url), options['repeat'])
+
+                    since = encode_cursor(messages.values_list('created_at', 'id')[0])
+                    since_url = f'/api/chatrooms/{chatroom.id}/messages?since={since}'
+                    since_ms = self.best_of(lambda: client.get(since_url), options['repeat'])
+
+                    self.stdout.write(f'{count:>9} {label:>7} | {offset_ms:>9.2f} {keyset_ms:>9.2f} | '
+                                      f'{api_ms:>7.2f} {since_ms:>8.2f}')
+
+    def best_of(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
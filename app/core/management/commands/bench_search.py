@@ -0,0 +1,122 @@
+import itertools
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core.management.benchmark import scratch_database
+from core.models import ChatRoom, Message
+from core.search import Search, search_backend
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'pa', 'dri', 'gon', 'bel', 'tor', 'shu', 'qua']
+
+
+def vocabulary(size, rng):
+    """``size`` distinct made up words, their frequency in the text falls off like Zipf's law by position"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    words = sorted(words, key=lambda word: rng.random())
+    return words, list(itertools.accumulate(1 / rank for rank in range(1, size + 1)))
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds chat history with Zipf distributed words, indexed for search as it is '
+        'inserted, and times searches for rare, common and very common words, phrases, '
+        'alternatives and chatroom titles: the first page, the next one and the same through '
+        'the API. Runs against a scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000, help='Messages to seed')
+        parser.add_argument('--chatrooms', type=int, default=1000, help='Chatrooms the messages are spread over')
+        parser.add_argument('--words', type=int, default=30, help='Words per message')
+        parser.add_argument('--vocabulary', type=int, default=20000, help='Distinct words')
+        parser.add_argument('--limit', type=int, default=20, help='Page size')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement, the median is kept')
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        words, weights = vocabulary(options['vocabulary'], rng)
+
+        with scratch_database():
+            backend = search_backend()
+            self.stdout.write(f'engine={connection.vendor} messages={options["messages"]} '
+                              f'rank_window={backend.options["RANK_WINDOW"]}')
+            chatrooms = self.seed(options, rng, words, weights)
+
+            queries = [
+                ('rare word', words[9999], {}),
+                ('uncommon word', words[999], {}),
+                ('common word', words[99], {}),
+                ('very common word', words[4], {}),
+                ('two words', f'{words[99]} {words[199]}', {}),
+                ('phrase', f'"{words[9]} {words[19]}"', {}),
+                ('alternatives', f'{words[999]} or {words[1999]}', {}),
+                ('exclusion', f'{words[99]} -{words[0]}', {}),
+                ('in a chatroom', words[99], {'chatroom_id': chatrooms[0].id}),
+                ('chatroom title', words[49], {'kind': 'chatrooms'}),
+            ]
+            client = APIClient(HTTP_HOST='localhost')
+            self.stdout.write(f"{'query':>17} {'matches':>8} | {'page ms':>8} {'next ms':>8} {'api ms':>7}")
+            for label, text, params in queries:
+                search = Search(text, params.get('kind', 'messages'), params.get('chatroom_id'))
+                matches = backend.count(search.model, text, params.get('chatroom_id'))
+                page_ms = self.median_of(lambda: search.page(limit=options['limit']), options['repeat'])
+                _, cursor = search.page(limit=options['limit'])
+                next_ms = '-'
+                if cursor:
+                    next_ms = f"{self.median_of(lambda: search.page(cursor, options['limit']), options['repeat']):.2f}"
+                api_params = {'q': text, 'limit': options['limit'], 'type': params.get('kind', 'messages')}
+                if 'chatroom_id' in params:
+                    api_params['chatroom_id'] = params['chatroom_id']
+                api_ms = self.median_of(lambda: client.get('/api/search', api_params), options['repeat'])
+                self.stdout.write(f'{label:>17} {matches:>8} | {page_ms:>8.2f} {next_ms:>8} {api_ms:>7.2f}')
+
+    def seed(self, options, rng, words, weights, batch_size=5000):
+        count, started = options['messages'], time.perf_counter()
+        chatrooms = ChatRoom.objects.bulk_create([
+            ChatRoom(title=' '.join(rng.choices(words, cum_weights=weights, k=3)), provider='openai', model_id='gpt-4o')
+            for _ in range(options['chatrooms'])
+        ])
+        start = timezone.now() - timedelta(seconds=count)
+        for offset in range(0, count, batch_size):
+            Message.objects.bulk_create([
+                Message(
+                    chatroom=chatrooms[index % len(chatrooms)],
+                    role='user' if index % 2 == 0 else 'assistant',
+                    content=' '.join(rng.choices(words, cum_weights=weights, k=options['words'])),
+                    created_at=start + timedelta(seconds=index),
+                    token_count=options['words'],
+                )
+                for index in range(offset, min(count, offset + batch_size))
+            ])
+        seconds = time.perf_counter() - started
+        self.stdout.write(f'seeded and indexed {count} messages in {seconds:.1f}s ({count / seconds:.0f}/s)')
+
+        # One more message at a time, the way chat messages are written
+        single = []
+        for _ in range(100):
+            message = Message(chatroom=chatrooms[0], role='user', token_count=options['words'],
+                              content=' '.join(rng.choices(words, cum_weights=weights, k=options['words'])))
+            started = time.perf_counter()
+            message.save(force_insert=True)
+            single.append((time.perf_counter() - started) * 1000)
+        self.stdout.write(f'single message insert with indexing: {statistics.median(single):.2f} ms median')
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        return chatrooms
+
+    def median_of(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
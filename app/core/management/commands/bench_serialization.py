@@ -0,0 +1,75 @@
+import io
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from core.management.benchmark import scratch_database, seed_messages
+from core.models import ChatRoom
+from core.renderers import ORJSONParser, ORJSONRenderer, _orjson
+from core.serializers import MessageSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares listing a chatroom\'s messages through MessageSerializer and DRF\'s JSONRenderer '
+        'against the .values() fast path and the orjson renderer (core.renderers), split into '
+        'query, serialization and rendering time, plus parsing the result back. Runs against a '
+        'scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000, help='Messages serialized at once')
+        parser.add_argument('--words', type=int, default=40, help='Words per seeded message')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement, the best is kept')
+
+    def handle(self, *args, **options):
+        if _orjson() is None:
+            self.stderr.write('orjson is not installed, the orjson rows measure the DRF fallback')
+
+        with scratch_database():
+            chatroom = ChatRoom.objects.create(title='serialization', provider='openai', model_id='gpt-4o')
+            seed_messages(chatroom, options['messages'], content=' '.join(['word'] * options['words']))
+            messages = chatroom.messages.order_by('created_at', 'id')
+
+            paths = {
+                'serializer': (
+                    lambda: list(messages.all()),
+                    lambda rows: MessageSerializer(rows, many=True).data,
+                ),
+                'values': (
+                    lambda: list(MessageSerializer.values(messages)),
+                    MessageSerializer.from_values,
+                ),
+            }
+            renderers = {'drf': JSONRenderer(), 'orjson': ORJSONRenderer()}
+            parsers = {'drf': JSONParser(), 'orjson': ORJSONParser()}
+
+            self.stdout.write(f"{'path':>10} {'renderer':>8} | {'query ms':>8} {'serialize ms':>12} "
+                              f"{'render ms':>9} {'total ms':>8} | {'parse ms':>8} {'KB':>7}")
+            bodies = []
+            for path, (query, serialize) in paths.items():
+                for name, renderer in renderers.items():
+                    query_ms, rows = self.best_of(query, options['repeat'])
+                    serialize_ms, data = self.best_of(lambda: serialize(rows), options['repeat'])
+                    render_ms, body = self.best_of(lambda: renderer.render(data), options['repeat'])
+                    parse_ms, _ = self.best_of(lambda: parsers[name].parse(io.BytesIO(body)), options['repeat'])
+                    bodies.append(body)
+                    self.stdout.write(
+                        f'{path:>10} {name:>8} | {query_ms:>8.1f} {serialize_ms:>12.1f} {render_ms:>9.1f} '
+                        f'{query_ms + serialize_ms + render_ms:>8.1f} | {parse_ms:>8.1f} {len(body) / 1024:>7.0f}'
+                    )
+
+            if any(json.loads(body) != json.loads(bodies[0]) for body in bodies):
+                self.stderr.write('The paths rendered different JSON')
+
+    def best_of(self, func, repeat):
+        best = result = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
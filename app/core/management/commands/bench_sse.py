@@ -0,0 +1,73 @@
+import asyncio
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.providers.fake import FakeProvider
+from core.sse import coalesce, encode_event
+
+
+async def per_chunk_frames(chunks):
+    """The framing before coalescing: one json.dumps and one frame per provider chunk"""
+    async for chunk in chunks:
+        if chunk.content:
+            yield f"data: {json.dumps({'content': chunk.content, 'type': 'chunk'})}\n\n".encode()
+
+
+async def coalesced_frames(chunks, max_bytes, max_delay):
+    async for batch in coalesce(chunks, max_bytes, max_delay):
+        content = ''.join([chunk.content for chunk in batch])
+        if content:
+            yield encode_event({'content': content, 'type': 'chunk'})
+
+
+class Command(BaseCommand):
+    help = (
+        'Microbenchmark of SSE framing: frames, frames/sec and CPU per stream with one frame per '
+        'provider chunk against the coalescing stage in core.sse. Every frame is written to '
+        '/dev/null to account for the write syscall a real response pays.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=200, help='Concurrent streams')
+        parser.add_argument('--tokens', type=int, default=500, help='Provider chunks per stream')
+        parser.add_argument('--token-delay', default='0,0.005',
+                            help='Comma separated delays between provider chunks, in seconds')
+        parser.add_argument('--flush-bytes', type=int, default=256)
+        parser.add_argument('--flush-interval', type=float, default=0.05)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'delay':>6} {'framing':>10} | {'frames':>8} {'frames/s':>10} {'KB':>8} "
+                          f"{'wall s':>7} {'CPU ms/stream':>13}")
+        for delay in [float(value) for value in options['token_delay'].split(',')]:
+            adapter = FakeProvider('fake', tokens=options['tokens'], token_delay=delay)
+            stages = {
+                'per-chunk': lambda chunks: per_chunk_frames(chunks),
+                'coalesced': lambda chunks: coalesced_frames(chunks, options['flush_bytes'], options['flush_interval']),
+            }
+            for label, stage in stages.items():
+                frames, size, wall, cpu = asyncio.run(self.run(adapter, stage, options['streams']))
+                self.stdout.write(
+                    f'{delay:>6} {label:>10} | {frames:>8} {frames / wall:>10.0f} {size / 1024:>8.0f} '
+                    f'{wall:>7.2f} {cpu * 1000 / options["streams"]:>13.2f}'
+                )
+
+    async def run(self, adapter, stage, streams):
+        sink = os.open(os.devnull, os.O_WRONLY)
+        counts = {'frames': 0, 'bytes': 0}
+
+        async def consume():
+            async for frame in stage(adapter.stream('fake-lorem', [])):
+                os.write(sink, frame)
+                counts['frames'] += 1
+                counts['bytes'] += len(frame)
+
+        try:
+            wall, cpu = time.perf_counter(), time.process_time()
+            await asyncio.gather(*[consume() for _ in range(streams)])
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        finally:
+            os.close(sink)
+        return counts['frames'], counts['bytes'], wall, cpu
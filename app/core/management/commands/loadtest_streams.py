@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from core.asgi import get_asgi_application
+from core.management.benchmark import asgi_request, fake_provider, peak_rss_mb, scratch_database, stub_provider_env
+from core.providers import providers
+from core.stubserver import StubProviderServer
+
+# Threads a run may start on top of those of the lowest concurrency level
+THREAD_ALLOWANCE = 4
+
+
+class StreamStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.peak_open = 0
+        self.peak_threads = threading.active_count()
+        self.chunks = 0
+        self.completed = 0
+        self.errors = 0
+
+    def opened(self, status=200):
+        with self.lock:
+            if status != 200:
+                self.errors += 1
+            self.open += 1
+            self.peak_open = max(self.peak_open, self.open)
+
+    def received(self, body):
+        with self.lock:
+            self.chunks += body.count(b'"type":"chunk"')
+            self.completed += body.count(b'"type":"done"')
+            self.errors += body.count(b'"error"')
+
+    def closed(self):
+        with self.lock:
+            self.open -= 1
+
+    def sample_threads(self):
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+
+
+class Command(BaseCommand):
+    help = (
+        'Opens N concurrent completion streams against a local stub provider and reports how many '
+        'the server held open at once, and in asgi mode fails if the thread count grows with them. '
+        'Runs against a scratch database. Upstream concurrency is capped by the shared client pool, '
+        'raise PROVIDER_MAX_CONNECTIONS to go past it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', default='100,500,1000',
+                            help='Comma separated list of concurrency levels to run')
+        parser.add_argument('--mode', choices=['asgi', 'wsgi'], default='asgi',
+                            help='asgi drives AsyncCompletionView on one event loop, '
+                                 'wsgi drives CompletionView from a thread pool')
+        parser.add_argument('--threads', type=int, default=16, help='Worker threads for --mode wsgi')
+        parser.add_argument('--provider', choices=['openai', 'anthropic', 'fake'], default='openai',
+                            help='openai and anthropic stream from a local stub server through the real '
+                                 'SDKs, fake streams in-process')
+        parser.add_argument('--tokens', type=int, default=20, help='Tokens per stubbed completion')
+        parser.add_argument('--token-delay', type=float, default=0.05,
+                            help='Seconds the stub provider waits between tokens')
+
+    def handle(self, *args, **options):
+        if options['provider'] == 'fake':
+            with fake_provider():
+                providers.reset()
+                adapter = providers.get('fake')
+                adapter.tokens = options['tokens']
+                adapter.token_delay = options['token_delay']
+                try:
+                    self.run(options)
+                finally:
+                    providers.reset()
+        else:
+            self.run(options)
+
+    def run(self, options):
+        levels = [int(level) for level in options['streams'].split(',')]
+        with scratch_database():
+            self.stdout.write(
+                f"mode={options['mode']} provider={options['provider']} tokens={options['tokens']} "
+                f"token_delay={options['token_delay']}s"
+            )
+            self.stdout.write(f"{'streams':>8} {'peak open':>10} {'threads':>8} {'done':>6} {'errors':>7} "
+                              f"{'wall s':>8} {'frames/s':>10} {'rss MB':>8}")
+            threads = {}
+            for level in levels:
+                if options['mode'] == 'asgi':
+                    stats, elapsed = asyncio.run(self.run_asgi(level, options))
+                else:
+                    stats, elapsed = self.run_wsgi(level, options)
+                threads[level] = stats.peak_threads
+                self.stdout.write(
+                    f'{level:>8} {stats.peak_open:>10} {stats.peak_threads:>8} {stats.completed:>6} '
+                    f'{stats.errors:>7} {elapsed:>8.2f} {stats.chunks / elapsed:>10.0f} {peak_rss_mb():>8.0f}'
+                )
+
+        if options['mode'] == 'asgi':
+            self.check_threads(threads)
+
+    def check_threads(self, threads):
+        """
+        Open ASGI streams must not hold threads: the peak thread count may not grow with the
+        number of streams beyond a few short-lived ones (DNS lookups, the loop's executor).
+        """
+        lowest = min(threads)
+        grown = {level: count for level, count in threads.items() if count > threads[lowest] + THREAD_ALLOWANCE}
+        if grown:
+            raise CommandError(
+                f'Thread count grew with concurrency: {threads[lowest]} threads at {lowest} streams, '
+                + ', '.join(f'{count} at {level}' for level, count in sorted(grown.items()))
+            )
+
+    def completion_path(self, options):
+        return f"/api/providers/{options['provider']}/models/stub-model/complete"
+
+    async def run_asgi(self, level, options):
+        application = get_asgi_application()
+        stats = StreamStats()
+        path = self.completion_path(options) + '/async'
+
+        async def sample_threads():
+            while True:
+                stats.sample_threads()
+                await asyncio.sleep(0.01)
+
+        async def one_stream(index):
+            await asgi_request(
+                application, 'POST', path, {'message': f'load test prompt {index}'},
+                on_start=stats.opened,
+                on_body=stats.received,
+            )
+            stats.closed()
+
+        server = StubProviderServer(tokens=options['tokens'], token_delay=options['token_delay'])
+        async with server:
+            with stub_provider_env(server):
+                sampler = asyncio.create_task(sample_threads())
+                started = time.perf_counter()
+                await asyncio.gather(*(one_stream(index) for index in range(level)))
+                elapsed = time.perf_counter() - started
+                sampler.cancel()
+        return stats, elapsed
+
+    def run_wsgi(self, level, options):
+        stats = StreamStats()
+        path = self.completion_path(options)
+
+        def one_stream(index):
+            response = Client(HTTP_HOST='localhost').post(path, {'message': f'load test prompt {index}'}, content_type='application/json')
+            stats.opened(response.status_code)
+            stats.sample_threads()
+            if not response.streaming:
+                stats.closed()
+                return
+            for chunk in response.streaming_content:
+                stats.received(chunk.encode() if isinstance(chunk, str) else chunk)
+            response.close()
+            stats.closed()
+
+        with StubProviderServer(tokens=options['tokens'], token_delay=options['token_delay']) as server:
+            with stub_provider_env(server):
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                    list(pool.map(one_stream, range(level)))
+                elapsed = time.perf_counter() - started
+        return stats, elapsed
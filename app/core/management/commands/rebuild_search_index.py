@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from core.search import search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the full-text search index of messages and chatroom titles from their '
+        'tables. Needed after a VACUUM on SQLite, which may renumber the rows the index '
+        'refers to, or after changing SEARCH CONFIG on PostgreSQL.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to rebuild the index of')
+
+    def handle(self, *args, **options):
+        search_backend(options['database']).rebuild()
+        self.stdout.write('Search index rebuilt')
@@ -0,0 +1,92 @@
+import time
+from concurrent import futures
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.batches import InvalidBatch, batch_runner
+from core.management.benchmark import stub_provider_env
+from core.models import BatchJob
+from core.stubserver import StubProviderServer
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs a batch completion job from a JSONL file of prompts in the foreground, printing '
+        'its progress, or resumes interrupted jobs with --resume. With --stub the providers are '
+        'pointed at a local stub server, to try a job or measure throughput without API calls.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='?', help='JSONL file of prompts, see core.batches')
+        parser.add_argument('--provider', default='openai')
+        parser.add_argument('--model', dest='model_id', default='gpt-4o-mini')
+        parser.add_argument('--system-prompt', default='')
+        parser.add_argument('--concurrency', type=int, help='Items in flight at once')
+        parser.add_argument('--provider-batch', action='store_true', help="Use the provider's batch API")
+        parser.add_argument('--resume', nargs='*', metavar='JOB_ID',
+                            help='Resume these jobs, or every interrupted one when no id is given')
+        parser.add_argument('--retry-failed', action='store_true', help='Run failed items again on --resume')
+        parser.add_argument('--stub', action='store_true', help='Send the calls to a local stub provider')
+        parser.add_argument('--progress-interval', type=float, default=2.0, help='Seconds between progress lines')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            if options['stub']:
+                server = stack.enter_context(StubProviderServer(tokens=20, batch_polls=0))
+                stack.enter_context(stub_provider_env(server))
+            if options['resume'] is not None:
+                job_ids = self.resume(options)
+            else:
+                job_ids = [self.create(options)]
+            self.follow(job_ids, options['progress_interval'])
+
+        for job in BatchJob.objects.filter(id__in=job_ids):
+            seconds = time.perf_counter() - started
+            self.stdout.write(
+                f'{job.id} {job.status}: {job.completed_items} completed, {job.failed_items} failed '
+                f'in {seconds:.1f}s ({(job.completed_items + job.failed_items) / seconds:.1f} items/s), '
+                f'{job.input_tokens}+{job.output_tokens} tokens, output in {batch_runner.output_path(job.id)}'
+            )
+            if job.error:
+                self.stderr.write(job.error)
+
+    def create(self, options):
+        if not options['file']:
+            raise CommandError('A JSONL file or --resume is required')
+        try:
+            with open(options['file'], 'rb') as lines:
+                job = batch_runner.create(
+                    lines, options['provider'], options['model_id'],
+                    system_prompt=options['system_prompt'],
+                    concurrency=options['concurrency'],
+                    mode=BatchJob.PROVIDER if options['provider_batch'] else BatchJob.LOCAL,
+                )
+        except (OSError, InvalidBatch) as e:
+            raise CommandError(str(e))
+        self.stdout.write(f'Created batch job {job.id} with {job.total_items} prompts')
+        batch_runner.start(job.id)
+        return job.id
+
+    def resume(self, options):
+        job_ids = options['resume'] or list(
+            BatchJob.objects.filter(status__in=[BatchJob.QUEUED, BatchJob.RUNNING]).values_list('id', flat=True)
+        )
+        resumed = [job_id for job_id in job_ids if batch_runner.resume(job_id, retry_failed=options['retry_failed'])]
+        for job_id in set(map(str, job_ids)) - set(map(str, resumed)):
+            self.stderr.write(f'{job_id} is still running elsewhere, skipped')
+        return resumed
+
+    def follow(self, job_ids, interval):
+        for job_id in job_ids:
+            while True:
+                try:
+                    batch_runner.wait(job_id, timeout=interval)
+                    break
+                except futures.TimeoutError:
+                    job = BatchJob.objects.get(id=job_id)
+                    self.stdout.write(
+                        f'{job.id}: {job.completed_items + job.failed_items}/{job.total_items} '
+                        f'({job.failed_items} failed)'
+                    )
@@ -0,0 +1,283 @@
+"""
+Latency and throughput metrics of the completion pipeline.
+
+Each completion request carries a ``Timeline`` of named spans: serializer validation,
+chatroom lookup, history load, rate limit queue wait, provider connect, first token,
+stream and persistence. When the request ends they are observed into Prometheus
+histograms (served in the text exposition format at ``/metrics``) together with time to
+first token, inter-token latency and output tokens per second.
+
+Model ids come from the request path, so only those the provider's model catalog lists
+are used as the ``model`` label; any other id is counted as ``other``, which keeps the
+number of series bounded whatever clients send.
+
+With TRACING enabled and opentelemetry-api installed the spans are also exported as an
+OpenTelemetry trace, to whatever tracer provider the deployment configured. A sample of
+LOG_SAMPLE_RATE of the requests logs its chunks and timings through the ``api`` logger.
+"""
+import bisect
+import importlib.util
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger('api')
+
+DEFAULT_METRICS_OPTIONS = {
+    'TRACING': False,
+    # Fraction of completion requests whose chunks and timings are logged
+    'LOG_SAMPLE_RATE': 0.01,
+    # Seconds the cached model ids of a provider's catalog are used for labels before they are read again
+    'MODEL_LABELS_TTL': 300,
+}
+
+# The model label of ids the provider's catalog does not list
+OTHER_MODEL = 'other'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800)
+
+
+def metrics_options():
+    return {**DEFAULT_METRICS_OPTIONS, **getattr(settings, 'METRICS', {})}
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, '', value) for labels, value in self._values.items()]
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        samples = []
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                samples.append((f'{self.name}_bucket', labels, f'le="{le}"', cumulative))
+            samples.append((f'{self.name}_sum', labels, '', total))
+            samples.append((f'{self.name}_count', labels, '', cumulative))
+        return samples
+
+    def clear(self):
+        with self._lock:
+            self._series = {}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def expose(self):
+        """Every metric in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, extra, value in metric.samples():
+                lines.append(f'{name}{format_labels(metric.labels, map(escape, labels), extra)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self._metrics:
+            metric.clear()
+
+
+metrics = MetricsRegistry()
+
+completions_total = metrics.counter(
+    'completions_total', 'Completion requests by how they ended', ('provider', 'model', 'outcome'))
+stage_seconds = metrics.histogram(
+    'completion_stage_seconds', 'Time spent in each stage of a completion request', ('provider', 'model', 'stage'))
+time_to_first_token_seconds = metrics.histogram(
+    'completion_time_to_first_token_seconds', 'Time from the request to the first streamed token', ('provider', 'model'))
+inter_token_seconds = metrics.histogram(
+    'completion_inter_token_seconds', 'Mean time between output tokens of a completion', ('provider', 'model'))
+tokens_per_second = metrics.histogram(
+    'completion_tokens_per_second', 'Output tokens per second once the first token arrived', ('provider', 'model'),
+    buckets=RATE_BUCKETS)
+
+
+class ModelLabels:
+    """
+    The ``model`` label of a provider's model ids: the id when the provider's catalog lists
+    it, OTHER_MODEL otherwise. Only the catalog core.catalog already has cached is read, so
+    labelling never calls a provider; until the model list was fetched once every id is
+    labelled OTHER_MODEL.
+    """
+    def __init__(self):
+        self._known = {}
+
+    def label(self, provider, model_id):
+        known, loaded_at = self._known.get(provider, (None, None))
+        if loaded_at is None or time.monotonic() - loaded_at >= metrics_options()['MODEL_LABELS_TTL']:
+            known = self.refresh(provider)
+        return model_id if known and model_id in known else OTHER_MODEL
+
+    def refresh(self, provider):
+        from .catalog import model_catalog
+
+        try:
+            entry = model_catalog.cached(provider)
+        except Exception as e:
+            logger.warning('Reading the cached %s model ids for metrics failed: %s', provider, e)
+            entry = None
+        if entry is None:
+            # Looked up again on the next request, it is only a cache read
+            return self._known.get(provider, (None, None))[0]
+        known = frozenset(entry['models'])
+        self._known[provider] = (known, time.monotonic())
+        return known
+
+    def clear(self):
+        self._known = {}
+
+
+model_labels = ModelLabels()
+
+
+class Timeline:
+    """
+    Timings of one completion request, taken with ``time.perf_counter``. Spans are
+    recorded with ``span()`` or ``add_span()``, points in time (``first_token``,
+    ``last_token``) with ``mark()``; the first mark of a name wins.
+    """
+    def __init__(self, provider='', model_id=''):
+        self.provider = provider
+        self.model_id = model_id
+        self.started = time.perf_counter()
+        self.wall_started = time.time_ns()
+        self.spans = []
+        self.marks = {}
+        self.sampled = random.random() < metrics_options()['LOG_SAMPLE_RATE']
+        # Set by finish()
+        self.outcome = self.output_tokens = self.finished = None
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.perf_counter()))
+
+    def add_span(self, name, start, end=None):
+        self.spans.append((name, start, time.perf_counter() if end is None else end))
+
+    def mark(self, name):
+        self.marks.setdefault(name, time.perf_counter())
+
+    def finish(self, outcome, output_tokens=None):
+        self.outcome, self.output_tokens, self.finished = outcome, output_tokens, time.perf_counter()
+        labels = (self.provider, model_labels.label(self.provider, self.model_id))
+        completions_total.inc(*labels, outcome)
+        for name, start, end in self.spans:
+            stage_seconds.observe(end - start, *labels, name)
+
+        first, last = self.marks.get('first_token'), self.marks.get('last_token')
+        if first is not None:
+            time_to_first_token_seconds.observe(first - self.started, *labels)
+        if first is not None and last is not None and last > first and output_tokens and output_tokens > 1:
+            inter_token_seconds.observe((last - first) / (output_tokens - 1), *labels)
+            tokens_per_second.observe((output_tokens - 1) / (last - first), *labels)
+
+        if self.sampled:
+            timings = ' '.join(f'{name}={(end - start) * 1000:.1f}ms' for name, start, end in self.spans)
+            logger.info('%s %s completion %s: %s', self.provider, self.model_id, outcome, timings)
+        if metrics_options()['TRACING']:
+            export_trace(self, outcome)
+
+
+_tracer = None
+
+
+def export_trace(timeline, outcome):
+    """Replays the timeline as an OpenTelemetry trace, a child span per stage"""
+    global _tracer
+    if _tracer is None:
+        if importlib.util.find_spec('opentelemetry') is None:
+            logger.warning('METRICS TRACING needs opentelemetry-api, spans are not exported')
+            _tracer = False
+            return
+        from opentelemetry import trace
+        _tracer = trace.get_tracer('core.completions')
+    if _tracer is False:
+        return
+    from opentelemetry import trace
+
+    def to_ns(value):
+        return timeline.wall_started + int((value - timeline.started) * 1e9)
+
+    end = max([span_end for _, _, span_end in timeline.spans] + [time.perf_counter()])
+    root = _tracer.start_span('completion', start_time=timeline.wall_started, attributes={
+        'llm.provider': timeline.provider, 'llm.model': timeline.model_id, 'completion.outcome': outcome,
+    })
+    parent = trace.set_span_in_context(root)
+    for name, start, span_end in timeline.spans:
+        _tracer.start_span(name, context=parent, start_time=to_ns(start)).end(end_time=to_ns(span_end))
+    root.end(end_time=to_ns(end))
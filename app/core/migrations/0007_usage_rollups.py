@@ -0,0 +1,46 @@
+# Generated by Django 5.1.3 on 2026-10-18 12:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_message_token_count_chatroom_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyModelUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('provider', models.CharField(max_length=50)),
+                ('model_id', models.CharField(max_length=50)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('input_tokens', models.PositiveBigIntegerField(default=0)),
+                ('output_tokens', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-day', 'provider', 'model_id'],
+                'constraints': [models.UniqueConstraint(fields=('day', 'provider', 'model_id'), name='daily_model_usage_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ChatRoomUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=50)),
+                ('model_id', models.CharField(max_length=50)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('input_tokens', models.PositiveBigIntegerField(default=0)),
+                ('output_tokens', models.PositiveBigIntegerField(default=0)),
+                ('chatroom', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage', to='core.chatroom')),
+            ],
+            options={
+                'ordering': ['provider', 'model_id'],
+                'constraints': [models.UniqueConstraint(fields=('chatroom', 'provider', 'model_id'), name='chatroom_usage_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.3 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_usage_rollups'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_chatroom_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['updated_at', 'id'], name='chatroom_updated_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chatroom', 'created_at', 'id'], name='message_chatroom_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 12:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[('streaming', 'Streaming'), ('complete', 'Complete'), ('aborted', 'Aborted')], default='complete', max_length=10),
+        ),
+    ]
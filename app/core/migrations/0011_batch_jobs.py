@@ -0,0 +1,63 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:41
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_message_created_at_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('provider', models.CharField(max_length=50)),
+                ('model_id', models.CharField(max_length=50)),
+                ('system_prompt', models.TextField(blank=True)),
+                ('mode', models.CharField(choices=[('local', 'Local worker pool'), ('provider', 'Provider batch API')], default='local', max_length=10)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=10)),
+                ('concurrency', models.PositiveSmallIntegerField(default=4)),
+                ('total_items', models.PositiveIntegerField(default=0)),
+                ('completed_items', models.PositiveIntegerField(default=0)),
+                ('failed_items', models.PositiveIntegerField(default=0)),
+                ('input_tokens', models.PositiveBigIntegerField(default=0)),
+                ('output_tokens', models.PositiveBigIntegerField(default=0)),
+                ('provider_batch_id', models.CharField(blank=True, max_length=255)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BatchItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('custom_id', models.CharField(max_length=255)),
+                ('prompt', models.TextField()),
+                ('system_prompt', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('complete', 'Complete'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('content', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('input_tokens', models.IntegerField(blank=True, null=True)),
+                ('output_tokens', models.IntegerField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='core.batchjob')),
+            ],
+            options={
+                'ordering': ['index'],
+                'indexes': [models.Index(fields=['job', 'status', 'index'], name='batch_item_status_idx')],
+                'constraints': [models.UniqueConstraint(fields=('job', 'index'), name='batch_item_index_unique')],
+            },
+        ),
+    ]
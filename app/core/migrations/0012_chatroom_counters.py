@@ -0,0 +1,62 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:46
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def count_existing_messages(apps, schema_editor):
+    ChatRoom = apps.get_model('core', 'ChatRoom')
+    Message = apps.get_model('core', 'Message')
+    messages = Message.objects.filter(chatroom=OuterRef('pk')).order_by()
+    totals = messages.values('chatroom')
+
+    def total(aggregate):
+        return Coalesce(Subquery(totals.annotate(total=aggregate).values('total')), 0)
+
+    last = messages.order_by('-created_at', '-id')
+    ChatRoom.objects.update(
+        message_count=total(Count('id')),
+        input_tokens=total(Sum('input_tokens')),
+        output_tokens=total(Sum('output_tokens')),
+        last_message_at=Subquery(last.values('created_at')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(last.annotate(preview=Substr('content', 1, 100)).values('preview')[:1]), Value(''),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_batch_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='input_tokens',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='output_tokens',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(count_existing_messages, migrations.RunPython.noop),
+    ]
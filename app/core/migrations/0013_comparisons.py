@@ -0,0 +1,46 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:49
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_chatroom_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Comparison',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('message', models.TextField()),
+                ('system_prompt', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ComparisonTarget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('provider', models.CharField(max_length=50)),
+                ('model_id', models.CharField(max_length=50)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('complete', 'Complete'), ('error', 'Error')], default='pending', max_length=10)),
+                ('time_to_first_token', models.FloatField(blank=True, null=True)),
+                ('total_time', models.FloatField(blank=True, null=True)),
+                ('output_tokens', models.IntegerField(blank=True, null=True)),
+                ('chatroom', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.chatroom')),
+                ('comparison', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='targets', to='core.comparison')),
+            ],
+            options={
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['provider', 'model_id', 'status'], name='comparison_target_model_idx')],
+            },
+        ),
+    ]
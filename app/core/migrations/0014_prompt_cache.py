@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_comparisons'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='context_start',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='cache_read_tokens',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='cache_write_tokens',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
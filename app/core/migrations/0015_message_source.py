@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 14:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_prompt_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='source',
+            field=models.CharField(choices=[('provider', 'Provider call'), ('cache', 'Response cache'), ('shared', 'Shared provider call')], default='provider', max_length=10),
+        ),
+    ]
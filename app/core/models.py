@@ -1,8 +1,11 @@
 import uuid
 
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 
+from .tokens import count_message_tokens
+
 class User(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
@@ -14,9 +17,26 @@ class ChatRoom(models.Model):
     provider = models.CharField(max_length=50)  # 'openai' or 'anthropic'
     model_id = models.CharField(max_length=50)  # e.g., 'gpt-4' or 'claude-3'
     system_prompt = models.TextField(blank=True)
+    # Rolling summary of the turns that no longer fit in the context window
+    summary = models.TextField(blank=True)
+    summary_until = models.DateTimeField(null=True, blank=True)
+    # Oldest message sent as history, kept in place between turns so the prompt prefix stays
+    # the same for the providers' prompt caches (core.context)
+    context_start = models.DateTimeField(null=True, blank=True)
+    # Denormalized for the chatroom list, kept up to date as messages are written (core.counters)
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=255, blank=True)
+    # Provider reported tokens of every reply in the chatroom
+    input_tokens = models.PositiveBigIntegerField(default=0)
+    output_tokens = models.PositiveBigIntegerField(default=0)
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Keyset pagination of the chatroom list
+            models.Index(fields=['updated_at', 'id'], name='chatroom_updated_keyset_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} - {self.provider}/{self.model_id}"
@@ -27,16 +47,226 @@ class Message(models.Model):
         ('user', 'User'),
         ('assistant', 'Assistant'),
     ]
+    STREAMING = 'streaming'
+    COMPLETE = 'complete'
+    ABORTED = 'aborted'
+    STATUS_CHOICES = [
+        (STREAMING, 'Streaming'),
+        (COMPLETE, 'Complete'),
+        (ABORTED, 'Aborted'),
+    ]
+    PROVIDER = 'provider'
+    CACHE = 'cache'
+    SHARED = 'shared'
+    SOURCE_CHOICES = [
+        (PROVIDER, 'Provider call'),
+        (CACHE, 'Response cache'),
+        (SHARED, 'Shared provider call'),
+    ]
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     chatroom = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set when the message is built rather than saved, messages can be written behind (core.persistence)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     input_tokens = models.IntegerField(null=True, blank=True)
     output_tokens = models.IntegerField(null=True, blank=True)
-    
+    # Prompt tokens of input_tokens the provider read from and wrote to its prompt cache
+    cache_read_tokens = models.IntegerField(null=True, blank=True)
+    cache_write_tokens = models.IntegerField(null=True, blank=True)
+    # Estimated prompt tokens of this message, counted once when it is written
+    token_count = models.IntegerField(null=True, blank=True)
+    # Assistant replies are stored while they stream when completion checkpoints are enabled
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=COMPLETE)
+    # Where an assistant reply came from: its own provider call, the response cache
+    # (core.responses) or an identical request's call (core.singleflight), which carry no tokens
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default=PROVIDER)
+
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Keyset pagination of a chatroom's messages and the context window walk
+            models.Index(fields=['chatroom', 'created_at', 'id'], name='message_chatroom_keyset_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.token_count is None:
+            self.token_count = count_message_tokens(self.content)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}..."
+
+class DailyModelUsage(models.Model):
+    """Token usage rolled up per day and model, updated as each completion finishes"""
+    day = models.DateField()
+    provider = models.CharField(max_length=50)
+    model_id = models.CharField(max_length=50)
+    requests = models.PositiveIntegerField(default=0)
+    input_tokens = models.PositiveBigIntegerField(default=0)
+    output_tokens = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-day', 'provider', 'model_id']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'provider', 'model_id'], name='daily_model_usage_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.provider}/{self.model_id}: {self.input_tokens}+{self.output_tokens}"
+
+
+class ChatRoomUsage(models.Model):
+    """Token usage rolled up per chatroom and model"""
+    chatroom = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='usage')
+    provider = models.CharField(max_length=50)
+    model_id = models.CharField(max_length=50)
+    requests = models.PositiveIntegerField(default=0)
+    input_tokens = models.PositiveBigIntegerField(default=0)
+    output_tokens = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        ordering = ['provider', 'model_id']
+        constraints = [
+            models.UniqueConstraint(fields=['chatroom', 'provider', 'model_id'], name='chatroom_usage_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.chatroom_id} {self.provider}/{self.model_id}: {self.input_tokens}+{self.output_tokens}"
+
+
+class BatchJob(models.Model):
+    """A JSONL upload of prompts completed offline by one model, see core.batches"""
+    LOCAL = 'local'
+    PROVIDER = 'provider'
+    MODE_CHOICES = [
+        (LOCAL, 'Local worker pool'),
+        (PROVIDER, 'Provider batch API'),
+    ]
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (COMPLETED, 'Completed'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    provider = models.CharField(max_length=50)
+    model_id = models.CharField(max_length=50)
+    system_prompt = models.TextField(blank=True)
+    mode = models.CharField(max_length=10, choices=MODE_CHOICES, default=LOCAL)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    # Items of this job in flight at once in the local worker pool
+    concurrency = models.PositiveSmallIntegerField(default=4)
+    total_items = models.PositiveIntegerField(default=0)
+    completed_items = models.PositiveIntegerField(default=0)
+    failed_items = models.PositiveIntegerField(default=0)
+    input_tokens = models.PositiveBigIntegerField(default=0)
+    output_tokens = models.PositiveBigIntegerField(default=0)
+    # Set once the items are submitted to the provider's batch API, polled until it ends
+    provider_batch_id = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Renewed while a worker runs the job; a running job with a stale heartbeat was interrupted
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.id} {self.provider}/{self.model_id}: {self.status}"
+
+
+class BatchItem(models.Model):
+    """One prompt of a BatchJob; its status is the checkpoint a resumed job starts from"""
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (COMPLETE, 'Complete'),
+        (FAILED, 'Failed'),
+    ]
+    job = models.ForeignKey(BatchJob, on_delete=models.CASCADE, related_name='items')
+    # Line of the item in the upload, counted from 0 over the non-blank lines
+    index = models.PositiveIntegerField()
+    custom_id = models.CharField(max_length=255)
+    prompt = models.TextField()
+    system_prompt = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    content = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    input_tokens = models.IntegerField(null=True, blank=True)
+    output_tokens = models.IntegerField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'index'], name='batch_item_index_unique'),
+        ]
+        indexes = [
+            # The pending items a (resumed) job still has to run
+            models.Index(fields=['job', 'status', 'index'], name='batch_item_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.job_id} #{self.index} {self.custom_id}: {self.status}"
+
+
+class Comparison(models.Model):
+    """One prompt sent to several models at once, see core.fanout"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    message = models.TextField()
+    system_prompt = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.id}: {self.message[:50]}"
+
+
+class ComparisonTarget(models.Model):
+    """One model's answer to a Comparison, in a chatroom of its own, and how fast it came"""
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    ERROR = 'error'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (COMPLETE, 'Complete'),
+        (ERROR, 'Error'),
+    ]
+    comparison = models.ForeignKey(Comparison, on_delete=models.CASCADE, related_name='targets')
+    chatroom = models.ForeignKey(ChatRoom, on_delete=models.SET_NULL, null=True, related_name='+')
+    # Order the targets were asked for in
+    position = models.PositiveSmallIntegerField()
+    provider = models.CharField(max_length=50)
+    model_id = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # Seconds from the request to the first token and to the end of the stream
+    time_to_first_token = models.FloatField(null=True, blank=True)
+    total_time = models.FloatField(null=True, blank=True)
+    output_tokens = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['position']
+        indexes = [
+            # Latency per model over all comparisons
+            models.Index(fields=['provider', 'model_id', 'status'], name='comparison_target_model_idx'),
+        ]
+
+    @property
+    def label(self):
+        return f'{self.provider}/{self.model_id}'
 
     def __str__(self):
-        return f"{self.role}: {self.content[:50]}..."
\ No newline at end of file
+        return f"{self.comparison_id} {self.label}: {self.status}"
@@ -0,0 +1,197 @@
+"""
+Keyset ("seek") pagination.
+
+Pages are fetched with ``WHERE (a, b) < (cursor) ORDER BY a DESC, b DESC LIMIT n`` on a
+unique ordering such as (created_at, id). Backed by a composite index on those columns
+every page costs the same, however deep it is, unlike OFFSET which reads and throws away
+every row before the page.
+"""
+import base64
+import json
+from datetime import datetime
+from uuid import UUID
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else str(value) for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_values(cursor):
+    """The values of a cursor made by encode_cursor, as strings. Raises ValueError"""
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def decode_cursor(cursor):
+    try:
+        created, key = decode_values(cursor)
+        values = (parse_datetime(created), UUID(key))
+    except (TypeError, ValueError):
+        raise NotFound('Invalid cursor')
+    if values[0] is None:
+        raise NotFound('Invalid cursor')
+    return values
+
+
+def keyset_filter(ordering, values, after=True):
+    """
+    Q object selecting the rows that come after (or before) ``values`` in ``ordering``,
+    e.g. ``('-created_at', '-id')``. Expands the row comparison into ORs that work on
+    every database backend. The leading column is also bounded on its own (``<=``/``>=``):
+    without it SQLite walks the index from the start of the chatroom instead of seeking.
+    """
+    condition = Q()
+    for index, (field, value) in enumerate(zip(ordering, values)):
+        descending = field.startswith('-')
+        name = field.lstrip('-')
+        lookup = 'lt' if descending == after else 'gt'
+        equal = {f.lstrip('-'): v for f, v in zip(ordering[:index], values[:index])}
+        condition |= Q(**equal, **{f'{name}__{lookup}': value})
+        if index == 0:
+            bound = Q(**{f'{name}__{lookup}e': value})
+    return bound & condition
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only keyset pagination in ``ordering``. Responses look like
+    ``{"next": <url or null>, "results": [...]}``.
+    """
+    ordering = ('-updated_at', '-id')
+    page_size = 50
+    max_page_size = 500
+    page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def cursor_values(self, obj):
+        # Rows of .values() querysets are dicts
+        if isinstance(obj, dict):
+            return [obj[field.lstrip('-')] for field in self.ordering]
+        return [getattr(obj, field.lstrip('-')) for field in self.ordering]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limit = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(keyset_filter(self.ordering, decode_cursor(cursor)))
+
+        rows = list(queryset[:limit + 1])
+        page = rows[:limit]
+        self.next_cursor = encode_cursor(self.cursor_values(page[-1])) if len(rows) > limit else None
+        return page
+
+    def cursor_url(self, param, cursor):
+        url = self.request.build_absolute_uri()
+        for other in (self.cursor_query_param, 'before', 'since'):
+            url = remove_query_param(url, other)
+        return replace_query_param(url, param, cursor)
+
+    def get_paginated_response(self, data):
+        next_url = self.cursor_url(self.cursor_query_param, self.next_cursor) if self.next_cursor else None
+        return Response({'next': next_url, 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class MessagePagination(KeysetPagination):
+    """
+    Chat-shaped keyset pagination over (created_at, id). Every page is returned oldest
+    first, like a chat transcript:
+
+    - no parameters: the newest ``limit`` messages
+    - ``?before=<cursor>``: the ``limit`` messages before the cursor (scrolling up)
+    - ``?since=<cursor>``: up to ``limit`` messages after the cursor (polling for new ones)
+
+    ``previous`` links to older messages when there are any; ``next`` is the ``since`` link
+    for whatever arrives after this page.
+    """
+    ordering = ('created_at', 'id')
+    page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limit = self.get_page_size(request)
+        since = request.query_params.get('since')
+        before = request.query_params.get('before')
+        newest_first = tuple(f'-{field}' for field in self.ordering)
+
+        if since:
+            since_values = decode_cursor(since)
+            rows = list(queryset.filter(keyset_filter(self.ordering, since_values)).order_by(*self.ordering)[:limit])
+            self.previous_cursor = None
+            self.next_cursor = encode_cursor(self.cursor_values(rows[-1])) if rows else since
+            return rows
+
+        if before:
+            queryset = queryset.filter(keyset_filter(newest_first, decode_cursor(before)))
+        rows = list(queryset.order_by(*newest_first)[:limit + 1])
+        page = rows[:limit][::-1]
+        self.previous_cursor = encode_cursor(self.cursor_values(page[0])) if len(rows) > limit else None
+        self.next_cursor = encode_cursor(self.cursor_values(page[-1])) if page else None
+        return page
+
+    def get_paginated_response(self, data):
+        previous_url = self.cursor_url('before', self.previous_cursor) if self.previous_cursor else None
+        next_url = self.cursor_url('since', self.next_cursor) if self.next_cursor else None
+        return Response({'previous': previous_url, 'next': next_url, 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        response = super().get_paginated_response_schema(schema)
+        response['properties']['previous'] = {'type': 'string', 'nullable': True, 'format': 'uri'}
+        return response
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Keyset pagination of ranked search results, best match first. The cursor is made
+    by core.search.Search, which takes the place of the queryset.
+    """
+    page_size = 20
+    max_page_size = 100
+
+    def paginate_queryset(self, search, request, view=None):
+        self.request = request
+        page, self.next_cursor = search.page(request.query_params.get(self.cursor_query_param),
+                                             self.get_page_size(request))
+        return page
+
+
+class BatchJobPagination(KeysetPagination):
+    """Batch jobs, newest first"""
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    max_page_size = 100
+
+
+class ComparisonPagination(KeysetPagination):
+    """Comparisons, newest first"""
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    max_page_size = 100
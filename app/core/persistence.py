@@ -0,0 +1,181 @@
+"""
+Write-behind persistence of chat messages.
+
+The user's prompt and the finished reply used to be written with one INSERT each on the
+request path, where concurrent requests queue for the database's write lock.
+``message_writer.add()`` queues the message instead, and a writer thread inserts the
+queue with one ``bulk_create`` once BATCH_SIZE messages are waiting or FLUSH_INTERVAL
+seconds passed, updating the counters and ``updated_at`` of the chatrooms written to in
+the same transaction (core.counters).
+
+Messages are written in the order they were added, by a single writer, and get their
+``created_at`` when they are built, so the order of a chatroom's messages is preserved.
+Reads that must see a chatroom's latest messages (its history for the next completion,
+the messages endpoint) call ``flush(chatroom_id)`` first, which returns at once unless
+that chatroom still has messages queued. The queue is drained at interpreter exit, so a
+graceful shutdown loses nothing; with ENABLED off messages are saved right away.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+
+from .asgi import shared_sync_threads
+from .counters import amessages_added, messages_added
+from .models import Message
+from .tokens import count_message_tokens
+
+logger = logging.getLogger('api')
+
+DEFAULT_WRITE_BEHIND_OPTIONS = {
+    'ENABLED': True,
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 0.05,
+}
+
+
+class MessageWriter:
+    def __init__(self, options=None):
+        self._explicit_options = options
+        self._options = options
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pending = []
+        # Sequence numbers: last added, last written, the last added per chatroom, and
+        # the last one a flush() is waiting for
+        self._added = 0
+        self._written = 0
+        self._chatrooms = {}
+        self._flush_to = 0
+        self._closing = False
+        self.metrics = {'messages': 0, 'batches': 0, 'errors': 0}
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_WRITE_BEHIND_OPTIONS, **getattr(settings, 'WRITE_BEHIND', {})}
+        return self._options
+
+    def add(self, message):
+        """Queues a new Message for insertion, or saves it right away when write-behind is off"""
+        if message.token_count is None:
+            message.token_count = count_message_tokens(message.content)
+        if not self.options['ENABLED']:
+            with transaction.atomic():
+                message.save(force_insert=True)
+                messages_added([message])
+            return message
+        with self._condition:
+            self._added += 1
+            self._pending.append((self._added, message))
+            self._chatrooms[message.chatroom_id] = self._added
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='navi-message-writer', daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.options['BATCH_SIZE']:
+                self._condition.notify_all()
+        return message
+
+    async def aadd(self, message):
+        if self.options['ENABLED']:
+            return self.add(message)
+        if message.token_count is None:
+            message.token_count = count_message_tokens(message.content)
+        await message.asave(force_insert=True)
+        await amessages_added([message])
+        return message
+
+    def flush(self, chatroom_id=None):
+        """
+        Blocks until the queued messages of ``chatroom_id`` (of every chatroom if None)
+        are written.
+        """
+        with self._condition:
+            target = self._added if chatroom_id is None else self._chatrooms.get(chatroom_id, 0)
+            if target <= self._written:
+                return
+            self._flush_to = max(self._flush_to, target)
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._written >= target)
+
+    async def aflush(self, chatroom_id=None):
+        if self.pending(chatroom_id):
+            await asyncio.get_running_loop().run_in_executor(shared_sync_threads.executor, self.flush, chatroom_id)
+
+    def pending(self, chatroom_id=None):
+        with self._condition:
+            target = self._added if chatroom_id is None else self._chatrooms.get(chatroom_id, 0)
+            return target > self._written
+
+    def _run(self):
+        interval = self.options['FLUSH_INTERVAL']
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closing or self._pending)
+                # The first message waits at most FLUSH_INTERVAL for others to share its batch
+                self._condition.wait_for(
+                    lambda: self._closing or self._flush_to > self._written
+                    or len(self._pending) >= self.options['BATCH_SIZE'],
+                    timeout=interval,
+                )
+                batch, self._pending = self._pending[:self.options['BATCH_SIZE']], self._pending[self.options['BATCH_SIZE']:]
+                closing = self._closing and not self._pending
+            if batch:
+                self._write([message for _, message in batch])
+                with self._condition:
+                    self._written = batch[-1][0]
+                    for chatroom_id, sequence in list(self._chatrooms.items()):
+                        if sequence <= self._written:
+                            del self._chatrooms[chatroom_id]
+                    self._condition.notify_all()
+            if closing:
+                connections.close_all()
+                return
+
+    def _write(self, messages):
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(messages)
+                messages_added(messages)
+        except Exception:
+            # One bad row (e.g. its chatroom was deleted meanwhile) must not take the batch down with it
+            logger.exception('Batched insert of %d messages failed, inserting them one by one', len(messages))
+            for message in messages:
+                try:
+                    with transaction.atomic():
+                        message.save(force_insert=True)
+                        messages_added([message])
+                except Exception:
+                    self.metrics['errors'] += 1
+                    logger.exception('Dropped message %s of chatroom %s', message.id, message.chatroom_id)
+        else:
+            self.metrics['batches'] += 1
+        self.metrics['messages'] += len(messages)
+        close_old_connections()
+
+    def close(self):
+        """Writes everything still queued and stops the writer"""
+        with self._condition:
+            thread = self._thread
+            self._closing = True
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+        with self._condition:
+            self._thread = None
+            self._closing = False
+
+    def stats(self):
+        with self._condition:
+            return {**self.metrics, 'queued': len(self._pending)}
+
+    def reset(self):
+        self.close()
+        self._options = self._explicit_options
+
+
+message_writer = MessageWriter()
+atexit.register(message_writer.close)
@@ -0,0 +1,62 @@
+"""
+Completion providers.
+
+Each provider is a ProviderAdapter configured in ``settings.COMPLETION_PROVIDERS``:
+
+    COMPLETION_PROVIDERS = {
+        'openai': {'BACKEND': 'core.providers.openai.OpenAIProvider'},
+        'fake': {'BACKEND': 'core.providers.fake.FakeProvider', 'OPTIONS': {'tokens': 50}},
+    }
+
+Adapters are imported and instantiated the first time they are looked up, so adding a
+provider only takes a new adapter class and a settings entry.
+"""
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .base import Chunk, ProviderAdapter, ProviderNotFound
+
+
+class ProviderRegistry:
+    def __init__(self, config=None):
+        self._config = config
+        self._adapters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        if self._config is None:
+            return settings.COMPLETION_PROVIDERS
+        return self._config
+
+    def names(self):
+        return list(self.config)
+
+    def get(self, name):
+        """Returns the adapter registered under ``name`` (case-insensitive)"""
+        name = name.lower()
+        adapter = self._adapters.get(name)
+        if adapter is None:
+            if name not in self.config:
+                raise ProviderNotFound(f'Provider not found: {name}')
+            with self._lock:
+                adapter = self._adapters.get(name)
+                if adapter is None:
+                    entry = self.config[name]
+                    adapter_class = import_string(entry['BACKEND'])
+                    adapter = self._adapters[name] = adapter_class(name, **entry.get('OPTIONS', {}))
+        return adapter
+
+    def listed(self):
+        return [adapter for adapter in map(self.get, self.names()) if adapter.listed]
+
+    def reset(self):
+        with self._lock:
+            self._adapters = {}
+
+
+providers = ProviderRegistry()
+
+__all__ = ['Chunk', 'ProviderAdapter', 'ProviderNotFound', 'ProviderRegistry', 'providers']
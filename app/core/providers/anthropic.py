@@ -0,0 +1,129 @@
+import os
+
+from ..clients import provider_clients
+from .base import Chunk, ProviderAdapter
+
+# Anthropic does not have an endpoint to retrieve all models.
+# Models scrapped from: https://docs.anthropic.com/en/docs/about-claude/models
+ANTHROPIC_MODELS = [
+    "claude-3-5-sonnet-20241022",
+    "claude-3-opus-20240229",
+    "claude-3-haiku-20240307"
+]
+
+# Prompt cache breakpoint, the prefix up to and including the block is cached for 5 minutes
+EPHEMERAL = {'type': 'ephemeral'}
+
+
+class AnthropicProvider(ProviderAdapter):
+    display_name = 'Anthropic'
+    max_tokens = 1024
+    default_context_window = 200000
+    prices = {
+        'claude-3-5-sonnet': (3.00, 15.00),
+        'claude-3-5-haiku': (0.80, 4.00),
+        'claude-3-opus': (15.00, 75.00),
+        'claude-3-sonnet': (3.00, 15.00),
+        'claude-3-haiku': (0.25, 1.25),
+    }
+    batch_api = True
+
+    def __init__(self, name, prompt_cache=True, **options):
+        super().__init__(name, **options)
+        self.prompt_cache = prompt_cache
+
+    def list_models(self):
+        if not os.getenv("ANTHROPIC_API_KEY"):
+            raise ValueError('ANTHROPIC_API_KEY not found')
+        return list(ANTHROPIC_MODELS)
+
+    def format_messages(self, history):
+        """
+        Anthropic only accepts 'user' and 'assistant' roles, the system prompt is a separate
+        parameter. With ``prompt_cache`` the newest message and the one the previous turn
+        ended on are marked as cache breakpoints: this turn reads the prefix the previous
+        one wrote, and writes the prefix the next one will read.
+        """
+        messages = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in history
+            if msg["role"] != 'system'
+        ]
+        if self.prompt_cache:
+            for message in messages[-1:] + messages[-3:-2]:
+                message['content'] = [{'type': 'text', 'text': message['content'], 'cache_control': EPHEMERAL}]
+        return messages
+
+    def format_system(self, system_prompt):
+        """The system prompt leads every request of a chatroom, so it is cached on its own too"""
+        if not system_prompt:
+            return {}
+        if not self.prompt_cache:
+            return {'system': system_prompt}
+        return {'system': [{'type': 'text', 'text': system_prompt, 'cache_control': EPHEMERAL}]}
+
+    async def stream(self, model_id, history, system_prompt=''):
+        stream = await provider_clients.async_anthropic().messages.create(
+            max_tokens=self.max_tokens,
+            messages=self.format_messages(history),
+            model=model_id,
+            stream=True,
+            **self.format_system(system_prompt)
+        )
+        try:
+            async for event in stream:
+                if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                    yield Chunk(content=event.delta.text)
+                elif event.type == 'message_start':
+                    usage = event.message.usage
+                    # input_tokens leaves out the tokens read from or written to the cache
+                    cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+                    cache_write = getattr(usage, 'cache_creation_input_tokens', None) or 0
+                    yield Chunk(
+                        input_tokens=usage.input_tokens + cache_read + cache_write,
+                        output_tokens=usage.output_tokens,
+                        cache_read_tokens=cache_read,
+                        cache_write_tokens=cache_write,
+                    )
+                elif event.type == 'message_delta':
+                    yield Chunk(output_tokens=event.usage.output_tokens)
+        finally:
+            await stream.close()
+
+    async def submit_batch(self, model_id, requests):
+        batch = await provider_clients.async_anthropic().beta.messages.batches.create(requests=[
+            {
+                'custom_id': custom_id,
+                'params': {
+                    'model': model_id,
+                    'max_tokens': self.max_tokens,
+                    'messages': self.format_messages(history),
+                    **self.format_system(system_prompt),
+                },
+            }
+            for custom_id, history, system_prompt in requests
+        ])
+        return batch.id
+
+    async def batch_finished(self, batch_id):
+        batch = await provider_clients.async_anthropic().beta.messages.batches.retrieve(batch_id)
+        return batch.processing_status == 'ended'
+
+    async def batch_results(self, batch_id):
+        results = await provider_clients.async_anthropic().beta.messages.batches.results(batch_id)
+        async for entry in results:
+            result = entry.result
+            if result.type == 'succeeded':
+                message = result.message
+                yield entry.custom_id, {
+                    'content': ''.join(block.text for block in message.content if block.type == 'text'),
+                    'input_tokens': message.usage.input_tokens,
+                    'output_tokens': message.usage.output_tokens,
+                }
+            elif result.type == 'errored':
+                yield entry.custom_id, {'error': result.error.error.message}
+            else:
+                yield entry.custom_id, {'error': f'Request {result.type}'}
+
+    async def cancel_batch(self, batch_id):
+        await provider_clients.async_anthropic().beta.messages.batches.cancel(batch_id)
@@ -0,0 +1,91 @@
+from dataclasses import dataclass
+
+
+class ProviderNotFound(KeyError):
+    pass
+
+
+@dataclass(slots=True)
+class Chunk:
+    """
+    One normalized piece of a provider stream. Usage chunks carry the request's token
+    counts as reported by the provider; ``output_tokens`` is cumulative, the last value wins.
+    ``input_tokens`` counts every prompt token, of which ``cache_read_tokens`` were read from
+    and ``cache_write_tokens`` written to the provider's prompt cache.
+    """
+    content: str = ''
+    input_tokens: int | None = None
+    output_tokens: int | None = None
+    cache_read_tokens: int | None = None
+    cache_write_tokens: int | None = None
+
+
+class ProviderAdapter:
+    """
+    Interface every completion provider implements.
+
+    ``history`` is the normalized chat history: a list of ``{'role': ..., 'content': ...}``
+    dicts in chronological order, with the system prompt passed separately. Adapters
+    translate it to the provider's wire format and yield ``Chunk`` objects back.
+
+    Adapter modules must stay cheap to import; SDKs are only imported once a provider
+    is first used (see core.clients).
+    """
+    display_name = None
+    # Hidden providers are routable but not offered in /api/providers
+    listed = True
+    # Output tokens requested per completion, reserved out of the context window
+    max_tokens = 1024
+    # Context window sizes in tokens keyed by model id prefix, the longest matching prefix wins
+    context_windows = {}
+    default_context_window = 8192
+    # (input, output) prices in USD per million tokens keyed by model id prefix, the longest
+    # matching prefix wins; models without one have no known price
+    prices = {}
+    # Whether the provider has an asynchronous batch API for core.batches, see submit_batch()
+    batch_api = False
+
+    def __init__(self, name, **options):
+        self.name = name
+        self.options = options
+
+    def list_models(self):
+        raise NotImplementedError
+
+    def context_window(self, model_id):
+        matches = [prefix for prefix in self.context_windows if model_id.startswith(prefix)]
+        if not matches:
+            return self.default_context_window
+        return self.context_windows[max(matches, key=len)]
+
+    def price(self, model_id):
+        matches = [prefix for prefix in self.prices if model_id.startswith(prefix)]
+        if not matches:
+            return None
+        return self.prices[max(matches, key=len)]
+
+    async def stream(self, model_id, history, system_prompt=''):
+        raise NotImplementedError
+        yield
+
+    async def submit_batch(self, model_id, requests):
+        """
+        Submits ``requests``, a list of ``(custom_id, history, system_prompt)``, to the
+        provider's batch API and returns the provider's batch id.
+        """
+        raise NotImplementedError
+
+    async def batch_finished(self, batch_id):
+        """Whether the batch has ended and its results can be read"""
+        raise NotImplementedError
+
+    async def batch_results(self, batch_id):
+        """
+        Yields ``(custom_id, result)`` per request of an ended batch, in any order. Results
+        are dicts of ``content``, ``input_tokens`` and ``output_tokens``, or of ``error``.
+        """
+        raise NotImplementedError
+        yield
+
+    async def cancel_batch(self, batch_id):
+        raise NotImplementedError
@@ -0,0 +1,39 @@
+import asyncio
+
+from ..tokens import count_message_tokens, count_tokens
+from .base import Chunk, ProviderAdapter
+
+
+class FakeProvider(ProviderAdapter):
+    """
+    In-process provider for load tests and local development.
+
+    Streams ``tokens`` words back, ``token_delay`` seconds apart, without any network
+    I/O. The ``fake-echo`` model repeats the last user message instead.
+    """
+    display_name = 'Fake'
+    listed = False
+    default_context_window = 4096
+    prices = {'fake': (0.0, 0.0)}
+
+    def __init__(self, name, tokens=20, token_delay=0.0, **options):
+        super().__init__(name, **options)
+        self.tokens = tokens
+        self.token_delay = token_delay
+
+    def list_models(self):
+        return ['fake-lorem', 'fake-echo']
+
+    async def stream(self, model_id, history, system_prompt=''):
+        if model_id == 'fake-echo' and history:
+            words = history[-1]['content'].split(' ')
+        else:
+            words = ['lorem'] * self.tokens
+        for index, word in enumerate(words):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield Chunk(content=word if index == 0 else f' {word}')
+        yield Chunk(
+            input_tokens=count_tokens(system_prompt) + sum(count_message_tokens(msg['content']) for msg in history),
+            output_tokens=len(words),
+        )
@@ -0,0 +1,133 @@
+import json
+
+from ..clients import provider_clients
+from .base import Chunk, ProviderAdapter
+
+
+class OpenAIProvider(ProviderAdapter):
+    display_name = 'OpenAI'
+    max_tokens = 1000
+    context_windows = {
+        'gpt-3.5-turbo': 16385,
+        'gpt-4': 8192,
+        'gpt-4-32k': 32768,
+        'gpt-4-turbo': 128000,
+        'gpt-4-1106': 128000,
+        'gpt-4-0125': 128000,
+        'gpt-4o': 128000,
+        'chatgpt-4o': 128000,
+        'o1': 128000,
+    }
+    prices = {
+        'gpt-3.5-turbo': (0.50, 1.50),
+        'gpt-4': (30.00, 60.00),
+        'gpt-4-32k': (60.00, 120.00),
+        'gpt-4-turbo': (10.00, 30.00),
+        'gpt-4-1106': (10.00, 30.00),
+        'gpt-4-0125': (10.00, 30.00),
+        'gpt-4o': (2.50, 10.00),
+        'gpt-4o-mini': (0.15, 0.60),
+        'chatgpt-4o': (5.00, 15.00),
+        'o1': (15.00, 60.00),
+        'o1-mini': (3.00, 12.00),
+    }
+    batch_api = True
+    # Batches that end like this without an output file have nothing to read
+    failed_batch_statuses = ('failed', 'expired', 'cancelled')
+
+    def list_models(self):
+        models = provider_clients.openai().models.list()
+        return [model.id for model in models.data]
+
+    def format_messages(self, history, system_prompt):
+        """
+        OpenAI takes the system prompt as the first message of the history. OpenAI caches
+        prompt prefixes on its own, so nothing in front of the history may change between
+        turns of a chatroom.
+        """
+        message_list = []
+        if system_prompt:
+            message_list.append({"role": "system", "content": system_prompt})
+        message_list.extend({"role": msg["role"], "content": msg["content"]} for msg in history)
+        return message_list
+
+    async def stream(self, model_id, history, system_prompt=''):
+        stream = await provider_clients.async_openai().chat.completions.create(
+            model=model_id,
+            messages=self.format_messages(history, system_prompt),
+            stream=True,
+            stream_options={'include_usage': True},
+            max_tokens=self.max_tokens
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield Chunk(content=chunk.choices[0].delta.content)
+                # With include_usage the last chunk has no choices and reports the totals
+                if chunk.usage is not None:
+                    details = chunk.usage.prompt_tokens_details
+                    yield Chunk(
+                        input_tokens=chunk.usage.prompt_tokens,
+                        output_tokens=chunk.usage.completion_tokens,
+                        cache_read_tokens=details.cached_tokens if details is not None else None,
+                    )
+        finally:
+            # Hangs up on the provider when the stream is closed early, so it stops generating
+            await stream.close()
+
+    async def submit_batch(self, model_id, requests):
+        """Uploads the requests as a JSONL file of chat completions and starts a batch over it"""
+        client = provider_clients.async_openai()
+        lines = [
+            json.dumps({
+                'custom_id': custom_id,
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {
+                    'model': model_id,
+                    'messages': self.format_messages(history, system_prompt),
+                    'max_tokens': self.max_tokens,
+                },
+            })
+            for custom_id, history, system_prompt in requests
+        ]
+        upload = await client.files.create(file=('batch.jsonl', '\n'.join(lines).encode()), purpose='batch')
+        batch = await client.batches.create(
+            input_file_id=upload.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h',
+        )
+        return batch.id
+
+    async def batch_finished(self, batch_id):
+        batch = await provider_clients.async_openai().batches.retrieve(batch_id)
+        if batch.status in self.failed_batch_statuses and not (batch.output_file_id or batch.error_file_id):
+            raise RuntimeError(f'OpenAI batch {batch_id} {batch.status}')
+        return batch.status in ('completed', *self.failed_batch_statuses)
+
+    async def batch_results(self, batch_id):
+        client = provider_clients.async_openai()
+        batch = await client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get('response') or {}
+                body = response.get('body') or {}
+                if response.get('status_code') == 200:
+                    usage = body.get('usage') or {}
+                    yield record['custom_id'], {
+                        'content': body['choices'][0]['message']['content'] or '',
+                        'input_tokens': usage.get('prompt_tokens'),
+                        'output_tokens': usage.get('completion_tokens'),
+                    }
+                else:
+                    error = record.get('error') or body.get('error') or {}
+                    yield record['custom_id'], {'error': error.get('message') or 'Request failed'}
+
+    async def cancel_batch(self, batch_id):
+        await provider_clients.async_openai().batches.cancel(batch_id)
@@ -0,0 +1,59 @@
+"""
+JSON renderer and parser for the read-heavy endpoints, backed by ``orjson`` (pinned in
+requirements.txt), and by DRF's own JSONRenderer and JSONParser where it is not installed.
+
+The output is the same as DRF's compact UTF-8 JSON: datetimes are ISO 8601 with ``Z`` for
+UTC, UUIDs are strings, and U+2028/U+2029 are escaped. orjson formats datetimes and UUIDs
+itself, so serializers can hand them over as they come out of the database (see
+MessageSerializer.values). Anything orjson does not know goes through DRF's encoder, and
+data it cannot encode at all (integers over 64 bits, indented output) falls back to DRF's
+renderer.
+"""
+import functools
+import importlib.util
+
+from rest_framework import renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.utils import encoders
+
+
+@functools.lru_cache(maxsize=1)
+def _orjson():
+    if importlib.util.find_spec('orjson') is None:
+        return None
+    import orjson
+    return orjson
+
+
+class ORJSONRenderer(renderers.JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        orjson = _orjson()
+        if data is None or orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=encoders.JSONEncoder().default,
+                               option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Like DRF, for JSON that ends up inside <script> tags
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        orjson = _orjson()
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as e:
+            raise ParseError(f'JSON parse error - {e}')
+
+
+class FastJSONMixin:
+    """Renders and parses a view's JSON with orjson, the browsable API and forms as before"""
+    renderer_classes = [ORJSONRenderer, renderers.BrowsableAPIRenderer]
+    parser_classes = [ORJSONParser, FormParser, MultiPartParser]
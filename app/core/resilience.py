@@ -0,0 +1,224 @@
+"""
+Retries, hedging and failover around provider streams.
+
+A provider call that fails before its first token (a 429, a 5xx, a dropped connection)
+is retried after an exponential backoff with full jitter, or after the delay the
+provider asked for in ``Retry-After``. Once the retries of a model are used up, the
+models configured as its FAILOVER chain are tried in turn, so the client only sees a
+reply, not which model wrote it. Errors after the first token still reach the client:
+the part of the reply it already got cannot be taken back.
+
+With HEDGE enabled a second, identical request is fired when the first token takes
+longer than HEDGE_PERCENTILE of the model's recent times to first token; whichever
+request streams first is kept and the other one is cancelled.
+
+Usage and rate limits are still accounted to the model that was asked for.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import httpx
+from django.conf import settings
+
+from .providers import ProviderNotFound, providers
+
+logger = logging.getLogger('api')
+
+DEFAULT_RESILIENCE_OPTIONS = {
+    # Retries per model before failing over to the next one
+    'MAX_RETRIES': 2,
+    # The n-th retry waits a random delay up to BACKOFF_BASE * 2**n seconds, at most BACKOFF_MAX
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8.0,
+    # A model asking to be retried later than this is failed over right away
+    'RETRY_AFTER_MAX': 30.0,
+    'HEDGE': False,
+    'HEDGE_PERCENTILE': 95,
+    # Times to first token recorded per model, and needed before hedging starts
+    'LATENCY_SAMPLES': 200,
+    'HEDGE_MIN_SAMPLES': 20,
+    # Never hedge sooner than this many seconds
+    'HEDGE_MIN_DELAY': 0.25,
+    # {'anthropic:claude-3-5-sonnet-20241022': ['openai:gpt-4o'], 'openai': ['anthropic:claude-3-5-sonnet-20241022']}
+    'FAILOVER': {},
+}
+
+RETRYABLE_STATUS = {408, 409, 425, 429}
+# The request itself is at fault, another model would reject it just the same
+FATAL_STATUS = {400, 413, 422}
+
+
+def is_retryable(error):
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    # The SDKs' APIConnectionError and APITimeoutError, matched by name so neither SDK is imported here
+    return isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError, httpx.TransportError)) or any(
+        cls.__name__ == 'APIConnectionError' for cls in type(error).__mro__)
+
+
+def retry_after(error):
+    """Seconds the provider asked to wait before the next attempt, if it said so"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            value = headers['retry-after']
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+async def first_content(stream):
+    """Reads ``stream`` up to its first chunk with content, returns the chunks read"""
+    head = []
+    async for chunk in stream:
+        head.append(chunk)
+        if chunk.content:
+            break
+    return head
+
+
+class ResilientStreams:
+    def __init__(self, options=None):
+        self._explicit_options = options
+        self._options = options
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_RESILIENCE_OPTIONS, **getattr(settings, 'RESILIENCE', {})}
+        return self._options
+
+    def targets(self, adapter, model_id):
+        """The requested model followed by its failover chain, as ``(adapter, model_id)`` pairs"""
+        chain = self.options['FAILOVER']
+        targets = [(adapter, model_id)]
+        for name in chain.get(f'{adapter.name}:{model_id}', chain.get(adapter.name, [])):
+            provider, _, target_model = name.partition(':')
+            try:
+                targets.append((providers.get(provider), target_model or model_id))
+            except ProviderNotFound:
+                logger.warning('Failover target %s is not a configured provider', name)
+        return targets
+
+    def backoff(self, attempt, error):
+        hint = retry_after(error)
+        if hint is not None:
+            return hint
+        return random.uniform(0, min(self.options['BACKOFF_MAX'], self.options['BACKOFF_BASE'] * 2 ** attempt))
+
+    def observe(self, key, seconds):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None:
+                samples = self._latencies[key] = deque(maxlen=self.options['LATENCY_SAMPLES'])
+            samples.append(seconds)
+
+    def hedge_delay(self, key):
+        """Seconds to wait for the first token before hedging, None when not hedging"""
+        if not self.options['HEDGE']:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies.get(key, ()))
+        if len(samples) < self.options['HEDGE_MIN_SAMPLES']:
+            return None
+        if not samples:
+            return self.options['HEDGE_MIN_DELAY']
+        percentile = samples[min(len(samples) - 1, len(samples) * self.options['HEDGE_PERCENTILE'] // 100)]
+        return max(self.options['HEDGE_MIN_DELAY'], percentile)
+
+    async def stream(self, adapter, model_id, history, system_prompt=''):
+        """``adapter.stream()`` with retries, hedging and failover"""
+        options = self.options
+        targets = self.targets(adapter, model_id)
+        for index, (target, target_model) in enumerate(targets):
+            last = index == len(targets) - 1
+            for attempt in range(options['MAX_RETRIES'] + 1):
+                try:
+                    head, stream = await self.open(target, target_model, history, system_prompt)
+                except Exception as e:
+                    retry = is_retryable(e) and attempt < options['MAX_RETRIES']
+                    delay = self.backoff(attempt, e) if retry else None
+                    if retry and delay <= options['RETRY_AFTER_MAX']:
+                        self.metrics['retries'] += 1
+                        logger.info('%s %s failed (%s), retrying in %.2fs', target.name, target_model, e, delay)
+                        await asyncio.sleep(delay)
+                        continue
+                    if last or getattr(e, 'status_code', None) in FATAL_STATUS:
+                        raise
+                    self.metrics['failovers'] += 1
+                    logger.warning('%s %s failed (%s), failing over to %s %s', target.name, target_model, e,
+                                   targets[index + 1][0].name, targets[index + 1][1])
+                    break
+                try:
+                    for chunk in head:
+                        yield chunk
+                    async for chunk in stream:
+                        yield chunk
+                finally:
+                    await stream.aclose()
+                return
+
+    async def open(self, adapter, model_id, history, system_prompt):
+        """
+        Starts the provider stream and waits for its first token, hedging if it is slow.
+        Returns the chunks read so far and the stream to read the rest from.
+        """
+        key = f'{adapter.name}:{model_id}'
+        attempts = {}
+
+        def launch(hedge=False):
+            stream = adapter.stream(model_id, history, system_prompt=system_prompt)
+            attempts[asyncio.ensure_future(first_content(stream))] = (stream, time.monotonic(), hedge)
+
+        launch()
+        delay = self.hedge_delay(key)
+        try:
+            while True:
+                done, _ = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Slower than usual, race a second request against it
+                    self.metrics['hedges'] += 1
+                    launch(hedge=True)
+                    delay = None
+                    continue
+                task = done.pop()
+                stream, started, hedge = attempts.pop(task)
+                if task.exception() is None:
+                    self.observe(key, time.monotonic() - started)
+                    self.metrics['hedges_won'] += hedge
+                    return task.result(), stream
+                await stream.aclose()
+                if not attempts:
+                    raise task.exception()
+        finally:
+            for task, (stream, _, _) in attempts.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await stream.aclose()
+
+    def stats(self):
+        with self._lock:
+            return {**self.metrics, 'models': {key: len(samples) for key, samples in self._latencies.items()}}
+
+    def reset(self):
+        self._options = self._explicit_options
+        self._latencies = {}
+        self.metrics = {'retries': 0, 'failovers': 0, 'hedges': 0, 'hedges_won': 0}
+
+
+resilient_streams = ResilientStreams()
@@ -0,0 +1,244 @@
+"""
+Response cache for completions.
+
+Eval runs and shared canned prompts send the exact same request over and over. Replies
+are cached under a hash of the normalized request (provider, model, max tokens, system
+prompt and the history actually sent) and replayed through the normal SSE pipeline on a
+hit, so the client cannot tell the difference. Entries are evicted least recently used
+first once MAX_ENTRIES or MAX_BYTES is reached, and expire after TTL seconds.
+
+With SEMANTIC enabled (and NumPy installed) a miss falls back to a nearest-neighbour
+lookup among the cached requests for the same model with exactly the same system prompt
+and history before the last message. Only that last message is compared: it is embedded
+locally by feature hashing its words and bigrams, and the most similar one is used when
+its cosine similarity reaches SEMANTIC_THRESHOLD.
+
+A replayed reply cost no provider tokens, so it reports none and is not added to the
+message's, chatroom's or daily token usage.
+"""
+import hashlib
+import importlib.util
+import json
+import logging
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .providers import Chunk
+
+logger = logging.getLogger('api')
+
+DEFAULT_RESPONSE_CACHE_OPTIONS = {
+    'ENABLED': False,
+    'TTL': 3600,
+    'MAX_ENTRIES': 1000,
+    'MAX_BYTES': 32 * 1024 * 1024,
+    # Replies longer than this are not cached at all
+    'MAX_ENTRY_BYTES': 256 * 1024,
+    'SEMANTIC': False,
+    'SEMANTIC_THRESHOLD': 0.95,
+    'EMBEDDING_DIMENSIONS': 512,
+}
+
+WORD_RE = re.compile(r'\w+')
+
+
+def request_key(adapter, model_id, context):
+    """Canonical hash of everything that shapes the provider's reply"""
+    request = {
+        'provider': adapter.name,
+        'model': model_id,
+        'max_tokens': adapter.max_tokens,
+        'system': context.system_prompt.strip(),
+        'messages': [[msg['role'], msg['content'].strip()] for msg in context.history],
+    }
+    return hashlib.sha256(json.dumps(request, separators=(',', ':'), ensure_ascii=False).encode()).hexdigest()
+
+
+def prefix_key(adapter, model_id, context):
+    """Hash of the request without its last message, which semantic matches must share"""
+    request = {
+        'provider': adapter.name,
+        'model': model_id,
+        'max_tokens': adapter.max_tokens,
+        'system': context.system_prompt.strip(),
+        'messages': [[msg['role'], msg['content'].strip()] for msg in context.history[:-1]],
+    }
+    return hashlib.sha256(json.dumps(request, separators=(',', ':'), ensure_ascii=False).encode()).hexdigest()
+
+
+class SemanticIndex:
+    """Cosine similarity search over unit vectors kept in one NumPy matrix"""
+    def __init__(self, capacity, dimensions):
+        import numpy
+        self.numpy = numpy
+        self.dimensions = dimensions
+        self.vectors = numpy.zeros((capacity, dimensions), dtype=numpy.float32)
+        self.keys = []
+        self.scopes = []
+        self.rows = {}
+
+    def embed(self, text):
+        vector = self.numpy.zeros(self.dimensions, dtype=self.numpy.float32)
+        words = WORD_RE.findall(text.lower())
+        for feature in words + [f'{a} {b}' for a, b in zip(words, words[1:])]:
+            digest = zlib.crc32(feature.encode())
+            vector[digest % self.dimensions] += 1.0 if digest & 0x80000000 else -1.0
+        norm = self.numpy.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def add(self, key, scope, vector):
+        if key in self.rows or len(self.keys) == len(self.vectors):
+            return
+        self.rows[key] = len(self.keys)
+        self.vectors[len(self.keys)] = vector
+        self.keys.append(key)
+        self.scopes.append(scope)
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self.keys) - 1
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.keys[row], self.scopes[row] = self.keys[last], self.scopes[last]
+            self.rows[self.keys[row]] = row
+        self.keys.pop()
+        self.scopes.pop()
+
+    def search(self, scope, vector):
+        """Returns ``(key, similarity)`` of the closest vector in ``scope``, or ``(None, 0.0)``"""
+        if not self.keys:
+            return None, 0.0
+        scores = self.vectors[:len(self.keys)] @ vector
+        scores[[index for index, other in enumerate(self.scopes) if other != scope]] = -1.0
+        row = int(scores.argmax())
+        return (self.keys[row], float(scores[row])) if scores[row] > -1.0 else (None, 0.0)
+
+
+class ResponseCache:
+    """
+    In-process LRU of completion replies. ``lookup()`` returns ``(key, entry)`` where
+    ``entry`` is None on a miss; ``store()`` the reply under that key once it completed.
+    """
+    def __init__(self, options=None):
+        self._explicit_options = options
+        self._options = options
+        self._lock = threading.Lock()
+        self._index = None
+        self.clear()
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_RESPONSE_CACHE_OPTIONS, **getattr(settings, 'RESPONSE_CACHE', {})}
+        return self._options
+
+    @property
+    def enabled(self):
+        return self.options['ENABLED']
+
+    @property
+    def index(self):
+        if self._index is None and self.options['SEMANTIC']:
+            if importlib.util.find_spec('numpy') is None:
+                logger.warning('RESPONSE_CACHE SEMANTIC needs numpy, only exact matches are cached')
+                self._options = {**self.options, 'SEMANTIC': False}
+                return None
+            self._index = SemanticIndex(self.options['MAX_ENTRIES'], self.options['EMBEDDING_DIMENSIONS'])
+        return self._index
+
+    def semantic_text(self, context):
+        return context.history[-1]['content'] if context.history else ''
+
+    def lookup(self, adapter, model_id, context):
+        key = request_key(adapter, model_id, context)
+        now = time.time()
+        with self._lock:
+            entry = self._get(key, now)
+            if entry is not None:
+                self.metrics['hits'] += 1
+                return key, entry
+            if self.index is not None:
+                match, similarity = self.index.search(prefix_key(adapter, model_id, context),
+                                                      self.index.embed(self.semantic_text(context)))
+                entry = self._get(match, now) if similarity >= self.options['SEMANTIC_THRESHOLD'] else None
+                if entry is not None:
+                    self.metrics['semantic_hits'] += 1
+                    return key, entry
+            self.metrics['misses'] += 1
+        return key, None
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry['expires_at'] <= now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def store(self, key, adapter, model_id, context, content, input_tokens=None, output_tokens=None):
+        size = len(content.encode())
+        if size > self.options['MAX_ENTRY_BYTES']:
+            return
+        vector = scope = None
+        if self.index is not None:
+            vector, scope = self.index.embed(self.semantic_text(context)), prefix_key(adapter, model_id, context)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                'content': content,
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'size': size,
+                'expires_at': time.time() + self.options['TTL'],
+            }
+            self._bytes += size
+            self.metrics['stores'] += 1
+            while len(self._entries) > self.options['MAX_ENTRIES'] or self._bytes > self.options['MAX_BYTES']:
+                self._remove(next(iter(self._entries)))
+                self.metrics['evictions'] += 1
+            if vector is not None and key in self._entries:
+                self.index.add(key, scope, vector)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+        if self._index is not None:
+            self._index.remove(key)
+
+    async def replay(self, entry):
+        """The cached reply as the adapter chunks it was built from, without provider tokens"""
+        yield Chunk(content=entry['content'])
+        yield Chunk(input_tokens=0, output_tokens=0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.metrics['hits'] + self.metrics['semantic_hits'] + self.metrics['misses']
+            return {
+                **self.metrics,
+                'hit_rate': (self.metrics['hits'] + self.metrics['semantic_hits']) / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'enabled': self.enabled,
+                'semantic': bool(self.options['SEMANTIC']),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._bytes = 0
+            self._index = None
+            self._options = self._explicit_options
+            self.metrics = {'hits': 0, 'semantic_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,269 @@
+"""
+Provider rate limiting.
+
+Every configured provider (or provider:model) gets token buckets for requests per minute
+(RPM) and tokens per minute (TPM), plus an optional cap on concurrent streams. A
+completion takes one request and its estimated tokens (history plus the reply budget)
+before it opens the provider stream; the estimate is corrected with the usage the
+provider reports once the stream ends.
+
+Requests that do not fit wait in a queue ordered by priority, then arrival, and are told
+their position while they wait. Only the head of the queue draws from the buckets, so a
+large request is not starved by a stream of small ones. Requests still queued at their
+deadline fail with ``QueueTimeout``.
+
+Bucket state lives in the backend: process memory by default, or a Django cache shared
+by every worker (``CacheRateLimitBackend``). Queues are per process, so across workers
+the order is only as fair as their turns at the shared buckets. Concurrency slots are
+leases that expire after LEASE_TTL seconds unless released, so the slots of a worker that
+died mid-stream are freed again.
+"""
+import asyncio
+import bisect
+import itertools
+import threading
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+DEFAULT_RATE_LIMIT_OPTIONS = {
+    'BACKEND': 'core.scheduler.MemoryRateLimitBackend',
+    # {'openai': {'RPM': 500, 'TPM': 30000}, 'openai:gpt-4o': {'RPM': 100, 'TPM': 30000, 'CONCURRENCY': 10}}
+    'LIMITS': {},
+    # Default seconds a request may wait in the queue
+    'MAX_WAIT': 60.0,
+    # How often waiting requests re-check their place in the queue
+    'POLL_INTERVAL': 0.1,
+    # Seconds a concurrency slot is held at most, longer streams stop counting against it
+    'LEASE_TTL': 600,
+    # CacheRateLimitBackend only
+    'CACHE_ALIAS': 'default',
+}
+
+
+# Returned by CacheRateLimitBackend.update when another process holds the lock
+BUSY = object()
+
+
+class QueueTimeout(Exception):
+    pass
+
+
+def refill(state, limits, now):
+    elapsed = max(0.0, now - state['updated'])
+    state['requests'] = min(limits.get('RPM', 0), state['requests'] + elapsed * limits.get('RPM', 0) / 60)
+    state['tokens'] = min(limits.get('TPM', 0), state['tokens'] + elapsed * limits.get('TPM', 0) / 60)
+    state['updated'] = now
+
+
+def new_state(limits, now):
+    # leases maps the ids of the tickets holding a concurrency slot to when the slot expires
+    return {'requests': limits.get('RPM', 0), 'tokens': limits.get('TPM', 0), 'leases': {}, 'updated': now}
+
+
+def take(state, limits, tokens, lease, now):
+    """
+    Draws from ``state`` in place, ``lease`` is ``(ticket_id, ttl)``. Returns 0 on success,
+    else the seconds until it could succeed, or None when that depends on a running stream
+    finishing.
+    """
+    refill(state, limits, now)
+    state['leases'] = {ticket_id: expires for ticket_id, expires in state.get('leases', {}).items() if expires > now}
+    waits = []
+    if 'RPM' in limits and state['requests'] < 1:
+        waits.append((1 - state['requests']) * 60 / limits['RPM'])
+    if 'TPM' in limits and state['tokens'] < tokens:
+        waits.append((tokens - state['tokens']) * 60 / limits['TPM'])
+    if 'CONCURRENCY' in limits and len(state['leases']) >= limits['CONCURRENCY']:
+        waits.append(0)
+    if waits:
+        return max(waits) or None
+    state['requests'] -= 1 if 'RPM' in limits else 0
+    state['tokens'] -= tokens if 'TPM' in limits else 0
+    if 'CONCURRENCY' in limits:
+        ticket_id, ttl = lease
+        state['leases'][ticket_id] = now + ttl
+    return 0
+
+
+def give_back(state, limits, refund, ticket_id, now):
+    refill(state, limits, now)
+    if 'TPM' in limits:
+        state['tokens'] = min(limits['TPM'], state['tokens'] + refund)
+    state.setdefault('leases', {}).pop(ticket_id, None)
+
+
+class MemoryRateLimitBackend:
+    def __init__(self, options):
+        self.options = options
+        self._states = {}
+        self._lock = threading.Lock()
+
+    async def acquire(self, key, limits, tokens, ticket_id):
+        now = time.time()
+        with self._lock:
+            state = self._states.setdefault(key, new_state(limits, now))
+            return take(state, limits, tokens, (ticket_id, self.options['LEASE_TTL']), now)
+
+    async def release(self, key, limits, refund, ticket_id):
+        now = time.time()
+        with self._lock:
+            state = self._states.setdefault(key, new_state(limits, now))
+            give_back(state, limits, refund, ticket_id, now)
+
+
+class CacheRateLimitBackend:
+    """
+    Bucket state in a Django cache. Updates are serialized by a short lock taken with
+    ``cache.add``, which is atomic on Redis and memcached; a busy lock is reported as a
+    short wait instead of being spun on. The cache round trips run in a worker thread, off
+    the event loop.
+    """
+    lock_timeout = 2
+
+    def __init__(self, options):
+        self.options = options
+
+    @property
+    def cache(self):
+        return caches[self.options['CACHE_ALIAS']]
+
+    def update(self, key, limits, change):
+        lock = f'rate-limit:{key}:lock'
+        if not self.cache.add(lock, 1, timeout=self.lock_timeout):
+            return BUSY
+        try:
+            now = time.time()
+            state = self.cache.get(f'rate-limit:{key}') or new_state(limits, now)
+            result = change(state, now)
+            # Untouched that long, the buckets are full and the leases expired: a new state
+            self.cache.set(f'rate-limit:{key}', state, timeout=max(60, self.options['LEASE_TTL']))
+            return result
+        finally:
+            self.cache.delete(lock)
+
+    async def acquire(self, key, limits, tokens, ticket_id):
+        lease = (ticket_id, self.options['LEASE_TTL'])
+        wait = await sync_to_async(self.update)(key, limits, lambda state, now: take(state, limits, tokens, lease, now))
+        return self.options['POLL_INTERVAL'] / 10 if wait is BUSY else wait
+
+    async def release(self, key, limits, refund, ticket_id):
+        for _ in range(100):
+            change = lambda state, now: give_back(state, limits, refund, ticket_id, now)
+            if await sync_to_async(self.update)(key, limits, change) is not BUSY:
+                return
+            await asyncio.sleep(0.001)
+
+
+class Ticket:
+    def __init__(self, key, limits, tokens, priority, deadline, order):
+        self.key = key
+        self.limits = limits
+        self.tokens = tokens
+        self.sort_key = (-priority, order)
+        self.deadline = deadline
+        self.granted = False
+        # Unique across workers, names the ticket's concurrency lease
+        self.id = uuid.uuid4().hex
+
+
+class RateLimitScheduler:
+    def __init__(self, options=None):
+        self._explicit_options = options
+        self._options = options
+        self._backend = None
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._order = itertools.count()
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_RATE_LIMIT_OPTIONS, **getattr(settings, 'RATE_LIMITS', {})}
+        return self._options
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = import_string(self.options['BACKEND'])(self.options)
+        return self._backend
+
+    def limits_for(self, provider, model_id):
+        """The most specific limits configured for the model: ``provider:model``, then ``provider``"""
+        for key in (f'{provider}:{model_id}', provider):
+            if key in self.options['LIMITS']:
+                return key, self.options['LIMITS'][key]
+        return None, None
+
+    def ticket(self, provider, model_id, tokens, priority=0, max_wait=None):
+        """A place in line for one request of ``tokens``, or None when the model is not limited"""
+        key, limits = self.limits_for(provider, model_id)
+        if key is None:
+            return None
+        if 'TPM' in limits:
+            tokens = min(tokens, limits['TPM'])
+        max_wait = self.options['MAX_WAIT'] if max_wait is None else max_wait
+        ticket = Ticket(key, limits, tokens, priority, time.monotonic() + max_wait, next(self._order))
+        with self._lock:
+            queue = self._queues.setdefault(key, [])
+            bisect.insort(queue, ticket, key=lambda item: item.sort_key)
+        return ticket
+
+    def position(self, ticket):
+        with self._lock:
+            return self._queues[ticket.key].index(ticket) + 1
+
+    def leave(self, ticket):
+        with self._lock:
+            queue = self._queues[ticket.key]
+            if ticket in queue:
+                queue.remove(ticket)
+
+    async def wait(self, ticket):
+        """
+        Waits for the ticket's turn, yielding its 1-based queue position whenever it
+        changes (including the first check, unless it can go ahead right away).
+        """
+        last_position = None
+        try:
+            while True:
+                position = self.position(ticket)
+                wait = None
+                if position == 1:
+                    wait = await self.backend.acquire(ticket.key, ticket.limits, ticket.tokens, ticket.id)
+                    if wait == 0:
+                        ticket.granted = True
+                        return
+                remaining = ticket.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise QueueTimeout(f'Rate limited: still queued for {ticket.key} at the deadline')
+                if position != last_position:
+                    last_position = position
+                    yield position
+                await asyncio.sleep(min(remaining, wait or self.options['POLL_INTERVAL']))
+        finally:
+            self.leave(ticket)
+
+    async def release(self, ticket, tokens=None):
+        """Frees the ticket's slot; ``tokens`` actually used are credited against the estimate"""
+        if ticket is None or not ticket.granted:
+            return
+        ticket.granted = False
+        refund = ticket.tokens - tokens if tokens is not None else 0
+        await self.backend.release(ticket.key, ticket.limits, max(0, refund), ticket.id)
+
+    def stats(self):
+        with self._lock:
+            return {key: {'queued': len(queue)} for key, queue in self._queues.items()}
+
+    def reset(self):
+        self._options = self._explicit_options
+        self._backend = None
+        self._queues = {}
+
+
+scheduler = RateLimitScheduler()
@@ -0,0 +1,398 @@
+"""
+Full-text search over chat history: message contents and chatroom titles.
+
+The index depends on the database backend:
+
+- SQLite: FTS5 tables over ``core_message`` and ``core_chatroom`` (external content,
+  keyed by rowid), kept up to date by INSERT/UPDATE/DELETE triggers, ranked with bm25.
+- PostgreSQL: GIN indexes on ``to_tsvector(CONFIG, ...)``, ranked with ts_rank_cd.
+
+Either way a message is searchable as soon as it is written, which with write-behind
+(core.persistence) is a batch interval after it was added.
+
+Both are installed after every ``migrate`` (see CoreConfig.ready): SQLite drops a table's
+triggers when a migration rebuilds it, in which case they are recreated and the index
+rebuilt. VACUUM may renumber the rowids the FTS5 tables refer to; run
+``manage.py rebuild_search_index`` after one.
+
+Queries use web search syntax on both backends: words (all must match), "quoted
+phrases", ``or`` between alternatives and ``-excluded`` words. Ranking costs time in
+proportion to the number of matches, which for a word found in half of a million messages
+is far too long, so when there are more than RANK_WINDOW matches only the newest
+RANK_WINDOW are ranked. Results are paginated with a cursor on (rank, key); snippets
+mark the matched words with ``<mark>`` in otherwise escaped text.
+"""
+import bisect
+import html
+import re
+import uuid
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+
+from .models import ChatRoom, Message
+from .pagination import decode_values, encode_cursor
+
+DEFAULT_SEARCH_OPTIONS = {
+    # Broad queries rank only the newest RANK_WINDOW matches
+    'RANK_WINDOW': 5000,
+    # Approximate length of a snippet, in words
+    'SNIPPET_WORDS': 16,
+    # PostgreSQL text search configuration of the GIN indexes, changing it takes a
+    # rebuild_search_index
+    'CONFIG': 'english',
+}
+
+# Private use characters around matches in snippets, replaced by <mark> after escaping
+MARK_START, MARK_END = '\ue000', '\ue001'
+ELLIPSIS = '…'
+
+QUERY_TOKEN = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
+
+# Searched models and their indexed column
+SEARCHED = {Message: 'content', ChatRoom: 'title'}
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def search_options():
+    return {**DEFAULT_SEARCH_OPTIONS, **getattr(settings, 'SEARCH', {})}
+
+
+def parse_query(text):
+    """
+    Splits a web search style query into groups of alternatives, each of which must
+    match, and excluded terms: ``'deploy "blue green" or canary -staging'`` gives
+    ``([['deploy'], ['blue green', 'canary']], ['staging'])``.
+    """
+    groups, excluded, alternative = [], [], False
+    for match in QUERY_TOKEN.finditer(text):
+        negated, phrase, word = match.groups()
+        term = phrase if phrase is not None else word
+        if phrase is None and not negated and term.lower() == 'or':
+            alternative = bool(groups)
+            continue
+        if not re.search(r'\w', term):
+            continue
+        if negated:
+            excluded.append(term)
+        elif alternative:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+        alternative = False
+    if not groups:
+        raise InvalidQuery('Search for at least one word that is not excluded.')
+    return groups, excluded
+
+
+def highlight(snippet):
+    """Escapes a snippet for HTML and turns the match delimiters into <mark> tags"""
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+class SearchBackend:
+    """Index maintenance and ranked queries for one database vendor"""
+    def __init__(self, connection, options=None):
+        self.connection = connection
+        self.options = options or search_options()
+
+    def install(self):
+        """Creates whatever part of the index is missing"""
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def page(self, model, text, chatroom_id, floor, after, limit):
+        """
+        Returns ``(hits, floor)``: up to ``limit`` ``(rank, key, pk, snippet)`` rows, best
+        (lowest rank) first and then by key, that come after the ``(rank, key)`` of
+        ``after``. Without ``floor`` or ``after`` (the first page) only the RANK_WINDOW
+        newest matches are ranked, and ``floor`` becomes the oldest of them to be passed
+        back for the next pages; it stays None when there are fewer.
+        """
+        raise NotImplementedError
+
+    def count(self, model, text, chatroom_id=None):
+        """Number of matches, every one of them counted"""
+        raise NotImplementedError
+
+    def parse_key(self, value):
+        raise NotImplementedError
+
+    def parse_floor(self, value):
+        raise NotImplementedError
+
+
+def fts5_string(term):
+    return '"{}"'.format(term.replace('"', '""'))
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    FTS5 tables with external content, one per searched table, filled by triggers.
+    Besides the text each table indexes the chatroom id (as a single token of hex digits),
+    so a search within one chatroom intersects the query with the chatroom's entries in
+    the index instead of looking each match up in the table.
+    """
+    tokenizer = 'porter unicode61 remove_diacritics 2'
+    chatroom_columns = {Message: 'chatroom_id', ChatRoom: 'id'}
+
+    def fts_table(self, model):
+        return f'{model._meta.db_table}_fts'
+
+    def triggers(self, model):
+        table, fts = model._meta.db_table, self.fts_table(model)
+        columns = [SEARCHED[model], self.chatroom_columns[model]]
+        names = ', '.join(columns)
+        insert = f"INSERT INTO {fts}(rowid, {names}) VALUES (new.rowid, {', '.join(f'new.{c}' for c in columns)});"
+        delete = (f"INSERT INTO {fts}({fts}, rowid, {names}) "
+                  f"VALUES ('delete', old.rowid, {', '.join(f'old.{c}' for c in columns)});")
+        return {
+            f'{fts}_insert': f'AFTER INSERT ON {table} BEGIN {insert} END',
+            f'{fts}_delete': f'AFTER DELETE ON {table} BEGIN {delete} END',
+            f'{fts}_update': f'AFTER UPDATE OF {names} ON {table} BEGIN {delete} {insert} END',
+        }
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            for model, column in SEARCHED.items():
+                fts, triggers = self.fts_table(model), self.triggers(model)
+                cursor.execute('SELECT name FROM sqlite_master WHERE name IN (%s, %s, %s, %s)', [fts, *triggers])
+                existing = {name for name, in cursor.fetchall()}
+                if len(existing) == 1 + len(triggers):
+                    continue
+                if fts not in existing:
+                    cursor.execute(
+                        f'CREATE VIRTUAL TABLE {fts} USING fts5({column}, {self.chatroom_columns[model]}, '
+                        f"content='{model._meta.db_table}', content_rowid='rowid', tokenize='{self.tokenizer}')")
+                    # The chatroom id takes no part in the ranking
+                    cursor.execute(f"INSERT INTO {fts}({fts}, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+                for name, trigger in triggers.items():
+                    if name not in existing:
+                        cursor.execute(f'CREATE TRIGGER {name} {trigger}')
+                # Indexes the rows written while the triggers were missing
+                cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+    def rebuild(self):
+        self.install()
+        with self.connection.cursor() as cursor:
+            for model in SEARCHED:
+                fts = self.fts_table(model)
+                cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+                cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('optimize')")
+
+    def match(self, model, text, chatroom_id=None):
+        """FTS5 query of ``text`` on the model's text column, within one chatroom if given"""
+        groups, excluded = parse_query(text)
+        expression = ' AND '.join('(' + ' OR '.join(map(fts5_string, group)) + ')' for group in groups)
+        expression = ''.join([expression, *(f' NOT {fts5_string(term)}' for term in excluded)])
+        expression = f'{SEARCHED[model]} : ({expression})'
+        if chatroom_id is None:
+            return expression
+        return f'{self.chatroom_columns[model]} : {fts5_string(chatroom_id.hex)} AND {expression}'
+
+    def page(self, model, text, chatroom_id, floor, after, limit):
+        fts, table = self.fts_table(model), model._meta.db_table
+        match = self.match(model, text, chatroom_id)
+        window = self.options['RANK_WINDOW']
+        # A single walk over the matches that ranks only those it returns, sorted here:
+        # the newest RANK_WINDOW for the first page, the same ones from the floor onwards after
+        sql, params = f'SELECT rank, rowid FROM {fts} WHERE {fts} MATCH %s', [match]
+        if floor is not None:
+            sql += ' AND rowid >= %s'
+            params.append(floor)
+        elif after is None:
+            sql += ' ORDER BY rowid DESC LIMIT %s'
+            params.append(window)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ranked = cursor.fetchall()
+            if floor is None and after is None and len(ranked) == window:
+                floor = ranked[-1][1]
+            ranked.sort()
+            if after is not None:
+                ranked = ranked[bisect.bisect_right(ranked, tuple(after)):]
+            ranked = ranked[:limit]
+            if not ranked:
+                return [], floor
+            # Snippets are only built for the page
+            cursor.execute(
+                f'SELECT {fts}.rowid, {table}.id, snippet({fts}, 0, %s, %s, %s, %s) '
+                f'FROM {fts} CROSS JOIN {table} WHERE {fts} MATCH %s '
+                f"AND {fts}.rowid IN ({', '.join(['%s'] * len(ranked))}) AND {table}.rowid = {fts}.rowid",
+                [MARK_START, MARK_END, ELLIPSIS, self.options['SNIPPET_WORDS'], match, *(key for _, key in ranked)])
+            details = {key: (pk, snippet) for key, pk, snippet in cursor.fetchall()}
+        return [(rank, key, *details[key]) for rank, key in ranked if key in details], floor
+
+    def count(self, model, text, chatroom_id=None):
+        fts = self.fts_table(model)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {fts} WHERE {fts} MATCH %s', [self.match(model, text, chatroom_id)])
+            return cursor.fetchone()[0]
+
+    def parse_key(self, value):
+        return int(value)
+
+    def parse_floor(self, value):
+        return int(value)
+
+
+class PostgresSearchBackend(SearchBackend):
+    """GIN expression indexes on to_tsvector(CONFIG, column)"""
+    def index_name(self, model):
+        return f'{model._meta.db_table}_search_idx'
+
+    @property
+    def config(self):
+        config = self.options['CONFIG']
+        if not re.fullmatch(r'\w+', config):
+            raise ValueError(f'Invalid text search configuration: {config!r}')
+        return f"'{config}'::regconfig"
+
+    def vector(self, model):
+        # Spelled exactly like the indexed expression, or the index is not used
+        return f'to_tsvector({self.config}, {SEARCHED[model]})'
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            for model in SEARCHED:
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {self.index_name(model)} '
+                               f'ON {model._meta.db_table} USING gin ({self.vector(model)})')
+
+    def rebuild(self):
+        with self.connection.cursor() as cursor:
+            for model in SEARCHED:
+                cursor.execute(f'DROP INDEX IF EXISTS {self.index_name(model)}')
+        self.install()
+
+    def filters(self, model, text, chatroom_id):
+        condition = f'{self.vector(model)} @@ websearch_to_tsquery({self.config}, %s)'
+        if chatroom_id is None:
+            return condition, [text]
+        return condition + f" AND {'id' if model is ChatRoom else 'chatroom_id'} = %s", [text, chatroom_id]
+
+    def window(self, model, text, chatroom_id):
+        """created_at of the RANK_WINDOW-th newest match, None when there are fewer"""
+        condition, params = self.filters(model, text, chatroom_id)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT created_at FROM {model._meta.db_table} WHERE {condition} '
+                f'ORDER BY created_at DESC LIMIT 1 OFFSET %s',
+                [*params, self.options['RANK_WINDOW'] - 1])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def page(self, model, text, chatroom_id, floor, after, limit):
+        if floor is None and after is None:
+            floor = self.window(model, text, chatroom_id)
+        column = SEARCHED[model]
+        condition, params = self.filters(model, text, chatroom_id)
+        if floor is not None:
+            condition += ' AND created_at >= %s'
+            params.append(floor)
+        bound = ''
+        if after is not None:
+            bound = 'WHERE (rank, id) > (%s, %s)'
+            params += list(after)
+        words = self.options['SNIPPET_WORDS']
+        headline = (f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords={words}, MinWords={max(1, words // 2)}, '
+                    f'MaxFragments=2, FragmentDelimiter=" {ELLIPSIS} "')
+        # ts_headline parses the text again, so it only runs on the rows of the page
+        sql = (
+            f'SELECT rank, id, id, ts_headline({self.config}, {column}, websearch_to_tsquery({self.config}, %s), %s) '
+            f'FROM (SELECT * FROM ('
+            f'SELECT id, {column}, -ts_rank_cd({self.vector(model)}, websearch_to_tsquery({self.config}, %s))::float8 '
+            f'AS rank FROM {model._meta.db_table} WHERE {condition}'
+            f') hits {bound} ORDER BY rank, id LIMIT %s) page '
+            f'ORDER BY rank, id'
+        )
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, [text, headline, text, *params, limit])
+            return cursor.fetchall(), floor
+
+    def count(self, model, text, chatroom_id=None):
+        condition, params = self.filters(model, text, chatroom_id)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {model._meta.db_table} WHERE {condition}', params)
+            return cursor.fetchone()[0]
+
+    def parse_key(self, value):
+        return uuid.UUID(value)
+
+    def parse_floor(self, value):
+        floor = parse_datetime(value)
+        if floor is None:
+            raise ValueError(f'Invalid date: {value}')
+        return floor
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def search_backend(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if connection.vendor not in BACKENDS:
+        raise NotImplementedError(f'Full-text search is not available on {connection.vendor}')
+    return BACKENDS[connection.vendor](connection)
+
+
+def install_search_index(using=DEFAULT_DB_ALIAS, **kwargs):
+    """post_migrate receiver, installs the index once the searched tables exist"""
+    connection = connections[using]
+    tables = connection.introspection.table_names()
+    if connection.vendor in BACKENDS and all(model._meta.db_table in tables for model in SEARCHED):
+        search_backend(using).install()
+
+
+class Search:
+    """A search of messages or chatrooms, optionally within one chatroom, read a page at a time"""
+    models = {'messages': Message, 'chatrooms': ChatRoom}
+
+    def __init__(self, text, kind='messages', chatroom_id=None, using=DEFAULT_DB_ALIAS):
+        # Parsed here on every backend, so that e.g. a query excluding everything fails alike
+        parse_query(text)
+        self.text = text
+        self.model = self.models[kind]
+        self.chatroom_id = chatroom_id
+        self.backend = search_backend(using)
+
+    def decode_cursor(self, cursor):
+        """``(floor, (rank, key))`` of a cursor returned by ``page()``"""
+        try:
+            rank, key, floor = decode_values(cursor)
+            return (self.backend.parse_floor(floor) if floor else None), (float(rank), self.backend.parse_key(key))
+        except (TypeError, ValueError):
+            raise NotFound('Invalid cursor')
+
+    def page(self, cursor=None, limit=20):
+        """
+        Returns ``(results, next_cursor)``: up to ``limit`` Message or ChatRoom objects,
+        best match first, with ``score`` and ``snippet`` attributes.
+        """
+        floor, after = self.decode_cursor(cursor) if cursor else (None, None)
+        hits, floor = self.backend.page(self.model, self.text, self.chatroom_id, floor, after, limit + 1)
+        queryset = self.model.objects.select_related('chatroom') if self.model is Message else self.model.objects
+        objects = queryset.in_bulk([pk for _, _, pk, _ in hits[:limit]])
+        results = []
+        for rank, _, pk, snippet in hits[:limit]:
+            result = objects.get(self.model._meta.pk.to_python(pk))
+            if result is None:
+                # Deleted since the page was matched
+                continue
+            result.score = -rank
+            result.snippet = highlight(snippet)
+            results.append(result)
+        next_cursor = None
+        if len(hits) > limit:
+            rank, key = hits[limit - 1][:2]
+            next_cursor = encode_cursor([rank, key, '' if floor is None else floor])
+        return results, next_cursor
@@ -0,0 +1,318 @@
+"""
+Latency-aware automatic model selection behind the ``auto`` completion route.
+
+Completions sent to ``/api/providers/auto/models/auto/complete`` are routed to one of the
+CANDIDATES models, and ``/api/providers/<provider>/models/auto/complete`` to one of that
+provider's. Every finished completion (core.completions) is observed into rolling stats
+for its model: exponentially weighted moving averages (EWMA) of the time to first token,
+the output tokens per second, the reply length and the error rate, with the most recent
+WINDOW samples kept in a ring buffer.
+
+Requests can ask for a ``max_latency`` (expected seconds to the first token), a
+``max_cost`` (expected USD for the request, from the adapters' prices) and a
+``min_context`` window in tokens. Among the models that meet them, the one with the lowest
+expected time to a complete reply is picked, inflated by its error rate, or the cheapest
+one with ``optimize: cost``. Models without samples yet are assumed to be as fast as the
+PRIOR_* options, so new candidates get tried, and EXPLORE_RATE of the requests go to a
+random eligible model, so a model that was slow or failing once gets another chance.
+
+Selection only reads numbers kept up to date as completions finish, a few microseconds
+per request. With CACHE_ALIAS set, the ring buffers are saved to that cache every
+PERSIST_INTERVAL seconds and loaded on first use, so the stats survive restarts and are
+picked up by new workers.
+"""
+import logging
+import math
+import random
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .providers import ProviderNotFound, providers
+from .tokens import count_message_tokens, count_tokens
+
+logger = logging.getLogger('api')
+
+DEFAULT_SELECTOR_OPTIONS = {
+    # 'provider/model_id' the auto route picks from
+    'CANDIDATES': [],
+    # Weight of the newest sample in the moving averages
+    'ALPHA': 0.2,
+    # Samples kept per model
+    'WINDOW': 64,
+    # Assumed of models without samples yet
+    'PRIOR_TIME_TO_FIRST_TOKEN': 0.5,
+    'PRIOR_TOKENS_PER_SECOND': 100.0,
+    'PRIOR_OUTPUT_TOKENS': 300,
+    # Fraction of requests sent to a random eligible model instead of the best one
+    'EXPLORE_RATE': 0.05,
+    # Error rates are capped at this when inflating expected latency
+    'MAX_ERROR_RATE': 0.9,
+    # Cache the stats are saved to, None keeps them in memory only
+    'CACHE_ALIAS': None,
+    'PERSIST_INTERVAL': 60,
+}
+
+AUTO = 'auto'
+# Fields of one sample in a model's ring buffer
+TIME_TO_FIRST_TOKEN, TOKENS_PER_SECOND, OUTPUT_TOKENS, ERROR = range(4)
+SAMPLE_SIZE = 4
+
+
+class NoEligibleModel(Exception):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Candidate:
+    # 'provider/model_id'
+    key: str
+    adapter: object
+    model_id: str
+    context_window: int
+    # (input, output) USD per million tokens, None when unknown
+    price: tuple | None
+
+
+class ModelStats:
+    """
+    Rolling stats of one model. The averages are updated as samples come in, unknown
+    values (no first token, no token count) leave theirs as they were. ``samples`` is a
+    flat ring buffer of the last ``window`` samples, NaN for the unknown values.
+    """
+    __slots__ = ('time_to_first_token', 'tokens_per_second', 'output_tokens', 'error_rate', 'count',
+                 'samples', 'window', 'next')
+
+    def __init__(self, window, time_to_first_token, tokens_per_second, output_tokens):
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = 0.0
+        self.count = 0
+        self.samples = array('d', [math.nan]) * (window * SAMPLE_SIZE)
+        self.window = window
+        self.next = 0
+
+    def add(self, alpha, time_to_first_token, tokens_per_second, output_tokens, error):
+        # The first sample replaces the prior outright
+        alpha = 1.0 if self.count == 0 else alpha
+        if time_to_first_token is not None:
+            self.time_to_first_token += alpha * (time_to_first_token - self.time_to_first_token)
+        if tokens_per_second is not None:
+            self.tokens_per_second += alpha * (tokens_per_second - self.tokens_per_second)
+        if output_tokens is not None:
+            self.output_tokens += alpha * (output_tokens - self.output_tokens)
+        self.error_rate += alpha * (float(error) - self.error_rate)
+        self.count += 1
+
+        offset = self.next * SAMPLE_SIZE
+        for index, value in enumerate((time_to_first_token, tokens_per_second, output_tokens, error)):
+            self.samples[offset + index] = math.nan if value is None else float(value)
+        self.next = (self.next + 1) % self.window
+
+    def recent(self):
+        """The buffered samples, oldest first, as tuples with None for unknown values"""
+        filled = min(self.count, self.window)
+        start = (self.next - filled) % self.window
+        samples = []
+        for position in range(filled):
+            offset = (start + position) % self.window * SAMPLE_SIZE
+            samples.append(tuple(None if math.isnan(value) else value
+                                 for value in self.samples[offset:offset + SAMPLE_SIZE]))
+        return samples
+
+
+class ModelSelector:
+    def __init__(self, options=None):
+        self._explicit_options = options
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_SELECTOR_OPTIONS, **getattr(settings, 'MODEL_SELECTOR', {})}
+        return self._options
+
+    def candidates(self):
+        if self._candidates is None:
+            candidates = []
+            for name in self.options['CANDIDATES']:
+                provider, _, model_id = name.partition('/')
+                try:
+                    adapter = providers.get(provider)
+                except ProviderNotFound:
+                    logger.warning('Model selector candidate %s is not a configured provider', name)
+                    continue
+                candidates.append(Candidate(f'{adapter.name}/{model_id}', adapter, model_id,
+                                            adapter.context_window(model_id), adapter.price(model_id)))
+            self._candidates = candidates
+            self.load()
+        return self._candidates
+
+    def new_stats(self):
+        options = self.options
+        return ModelStats(options['WINDOW'], options['PRIOR_TIME_TO_FIRST_TOKEN'],
+                          options['PRIOR_TOKENS_PER_SECOND'], options['PRIOR_OUTPUT_TOKENS'])
+
+    @property
+    def prior(self):
+        """Stats of a model without samples"""
+        if self._prior is None:
+            self._prior = self.new_stats()
+        return self._prior
+
+    def select(self, provider=None, prompt_tokens=0, max_latency=None, max_cost=None, min_context=None,
+               optimize='latency'):
+        """
+        The best candidate (of ``provider``, if given) meeting the constraints, see the
+        module docstring. Raises NoEligibleModel when none does.
+        """
+        options = self.options
+        max_error_rate = options['MAX_ERROR_RATE']
+        context = max(min_context or 0, prompt_tokens)
+        prior = self.prior
+        eligible = []
+        best = best_score = None
+        for candidate in self.candidates():
+            if provider is not None and candidate.adapter.name != provider:
+                continue
+            if candidate.context_window < context:
+                continue
+            stats = self._stats.get(candidate.key) or prior
+            if max_latency is not None and stats.time_to_first_token > max_latency:
+                continue
+            cost = None
+            if candidate.price is not None:
+                cost = (prompt_tokens * candidate.price[0] + stats.output_tokens * candidate.price[1]) / 1e6
+            if max_cost is not None and (cost is None or cost > max_cost):
+                continue
+            latency = (stats.time_to_first_token + stats.output_tokens / stats.tokens_per_second) / (
+                1 - min(stats.error_rate, max_error_rate))
+            score = (math.inf if cost is None else cost, latency) if optimize == 'cost' else (latency,)
+            eligible.append(candidate)
+            if best is None or score < best_score:
+                best, best_score = candidate, score
+        if best is None:
+            raise NoEligibleModel('No model meets the constraints' if self._candidates else
+                                  'No candidate models are configured for automatic selection')
+        if len(eligible) > 1 and random.random() < options['EXPLORE_RATE']:
+            return random.choice(eligible)
+        return best
+
+    def resolve(self, provider_name, model_id, data):
+        """
+        The ``(adapter, model_id)`` a completion request goes to: the one in its path, or
+        the selected one for ``auto``. ``data`` is the validated CompletionSerializer data.
+        """
+        if model_id != AUTO and provider_name.lower() != AUTO:
+            return providers.get(provider_name), model_id
+        provider = None if provider_name.lower() == AUTO else providers.get(provider_name).name
+        candidate = self.select(
+            provider=provider,
+            prompt_tokens=count_tokens(data.get('system_prompt', '')) + count_message_tokens(data['message']),
+            max_latency=data.get('max_latency'),
+            max_cost=data.get('max_cost'),
+            min_context=data.get('min_context'),
+            optimize=data.get('optimize', 'latency'),
+        )
+        return candidate.adapter, candidate.model_id
+
+    def observe(self, timeline):
+        """Adds a finished completion's core.metrics Timeline to its model's stats"""
+        if timeline.outcome not in ('complete', 'error'):
+            # Cached and shared replies say nothing about the model
+            return
+        first, last = timeline.marks.get('first_token'), timeline.marks.get('last_token')
+        output_tokens = timeline.output_tokens
+        tokens_per_second = None
+        if first is not None and last is not None and last > first and output_tokens and output_tokens > 1:
+            tokens_per_second = (output_tokens - 1) / (last - first)
+        self.add(
+            f'{timeline.provider}/{timeline.model_id}',
+            time_to_first_token=None if first is None else first - timeline.started,
+            tokens_per_second=tokens_per_second,
+            output_tokens=output_tokens if timeline.outcome == 'complete' else None,
+            error=timeline.outcome == 'error',
+        )
+
+    def add(self, key, time_to_first_token=None, tokens_per_second=None, output_tokens=None, error=False):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = self.new_stats()
+            stats.add(self.options['ALPHA'], time_to_first_token, tokens_per_second, output_tokens, error)
+        if self.options['CACHE_ALIAS'] and time.monotonic() - self._saved >= self.options['PERSIST_INTERVAL']:
+            self.save_in_background()
+
+    def cache_key(self):
+        return 'model-selector:stats'
+
+    def load(self):
+        alias = self.options['CACHE_ALIAS']
+        if not alias:
+            return
+        try:
+            saved = caches[alias].get(self.cache_key()) or {}
+        except Exception:
+            logger.exception('Loading the model selector stats failed')
+            return
+        for key, samples in saved.items():
+            for sample in samples:
+                self.add(key, *sample[:OUTPUT_TOKENS + 1], error=bool(sample[ERROR]))
+
+    def save(self):
+        with self._lock:
+            saved = {key: stats.recent() for key, stats in self._stats.items()}
+        caches[self.options['CACHE_ALIAS']].set(self.cache_key(), saved, timeout=None)
+
+    def save_in_background(self):
+        """Starts at most one save at a time; a failed save is retried after PERSIST_INTERVAL"""
+        with self._lock:
+            if self._saving:
+                return
+            self._saving = True
+            self._saved = time.monotonic()
+
+        def run():
+            try:
+                self.save()
+            except Exception:
+                logger.exception('Saving the model selector stats failed')
+            finally:
+                self._saving = False
+
+        threading.Thread(target=run, name='model-selector-save', daemon=True).start()
+
+    def stats(self):
+        candidates = self.candidates()
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            candidate.key: {
+                'time_to_first_token': round(model.time_to_first_token, 4),
+                'tokens_per_second': round(model.tokens_per_second, 2),
+                'output_tokens': round(model.output_tokens, 1),
+                'error_rate': round(model.error_rate, 4),
+                'samples': model.count,
+                'context_window': candidate.context_window,
+                'price': candidate.price,
+            }
+            for candidate in candidates
+            for model in [stats.get(candidate.key) or self.prior]
+        }
+
+    def reset(self):
+        self._options = self._explicit_options
+        self._candidates = None
+        self._stats = {}
+        self._prior = None
+        self._saved = time.monotonic()
+        self._saving = False
+
+
+model_selector = ModelSelector()
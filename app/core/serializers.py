@@ -1,8 +1,10 @@
 from djoser.serializers import UserCreateSerializer as BaseUserCreateSerializer
 from rest_framework import serializers
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import ChatRoom, Message
+from django.utils import timezone
+from .models import BatchJob, ChatRoom, ChatRoomUsage, Comparison, ComparisonTarget, DailyModelUsage, Message
 
 from .models import User
 
@@ -14,17 +16,68 @@ class UserCreateSerializer(BaseUserCreateSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['id', 'role', 'content', 'created_at', 'input_tokens', 'output_tokens']
-        read_only_fields = ['input_tokens', 'output_tokens']
+        fields = [
+            'id', 'role', 'content', 'created_at', 'input_tokens', 'output_tokens', 'cache_read_tokens',
+            'cache_write_tokens', 'status', 'source',
+        ]
+        read_only_fields = [
+            'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens', 'status', 'source',
+        ]
 
-class ChatRoomSerializer(serializers.ModelSerializer):
+    @classmethod
+    def values(cls, queryset):
+        """
+        Fast path for listings: ``queryset`` read with ``.values()``, so rows come back as
+        dicts of the fields without instantiating Messages or going through the fields'
+        to_representation. Pass the fetched rows through from_values() to get ``data``.
+        """
+        return queryset.values(*cls.Meta.fields)
+
+    @classmethod
+    def from_values(cls, rows):
+        """
+        The ``data`` of ``rows`` from values(). ``created_at`` stays a datetime, in UTC unless
+        another time zone is active; core.renderers formats it like DateTimeField would.
+        """
+        if settings.USE_TZ and timezone.get_current_timezone_name() not in ('UTC', 'Etc/UTC'):
+            zone = timezone.get_current_timezone()
+            for row in rows:
+                row['created_at'] = row['created_at'].astimezone(zone)
+        return rows
+
+class SparseFieldsMixin:
+    """
+    Serializes only the ``fields`` passed to the serializer, e.g.
+    ``ChatRoomSerializer(chatrooms, many=True, fields=['id', 'title'])``
+    """
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class ChatRoomSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # messages = MessageSerializer(many=True, read_only=True)
     
     class Meta:
         model = ChatRoom
-        fields = ['id', 'title', 'created_at', 'updated_at', 'provider', 'model_id', 'system_prompt']
-        read_only_fields = ['created_at', 'updated_at']
-    
+        fields = [
+            'id', 'title', 'created_at', 'updated_at', 'provider', 'model_id', 'system_prompt',
+            'message_count', 'last_message_at', 'last_message_preview', 'input_tokens', 'output_tokens',
+        ]
+        read_only_fields = [
+            'created_at', 'updated_at', 'message_count', 'last_message_at', 'last_message_preview',
+            'input_tokens', 'output_tokens',
+        ]
+
+    def update(self, instance, validated_data):
+        # Only write the fields that were sent: a full save() would put back the counters
+        # (core.counters) and summary as they were when the chatroom was read
+        for name, value in validated_data.items():
+            setattr(instance, name, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+
 class MessageRequestSerializer(serializers.Serializer):
     role = serializers.CharField()
     content = serializers.CharField()
@@ -32,4 +85,129 @@ class MessageRequestSerializer(serializers.Serializer):
 class CompletionSerializer(serializers.Serializer):
     chatroom_id = serializers.UUIDField(required=False)
     system_prompt = serializers.CharField(required=False, allow_blank=True)
-    message = serializers.CharField()
\ No newline at end of file
+    message = serializers.CharField()
+    # Set to false for a provider call of its own, bypassing the response cache and
+    # single-flight sharing
+    cache = serializers.BooleanField(required=False, default=True)
+    # Place in the rate limit queue: higher goes first, and at most max_wait seconds in it
+    priority = serializers.IntegerField(required=False, default=0, min_value=-10, max_value=10)
+    max_wait = serializers.FloatField(required=False, min_value=0)
+    # Constraints on the model picked for the 'auto' route (core.selector): expected seconds to
+    # the first token, expected USD for the request and context window size in tokens
+    max_latency = serializers.FloatField(required=False, min_value=0)
+    max_cost = serializers.FloatField(required=False, min_value=0)
+    min_context = serializers.IntegerField(required=False, min_value=1)
+    optimize = serializers.ChoiceField(choices=['latency', 'cost'], required=False, default='latency')
+
+class CompareSerializer(serializers.Serializer):
+    system_prompt = serializers.CharField(required=False, allow_blank=True, default='')
+    message = serializers.CharField()
+    # 'provider/model_id' of every model to ask, each answers in a chatroom of its own
+    targets = serializers.ListField(child=serializers.CharField(), min_length=1, max_length=8)
+    cache = serializers.BooleanField(required=False, default=True)
+    priority = serializers.IntegerField(required=False, default=0, min_value=-10, max_value=10)
+    max_wait = serializers.FloatField(required=False, min_value=0)
+
+    def validate_targets(self, targets):
+        if len(set(targets)) != len(targets):
+            raise serializers.ValidationError('Targets must be distinct')
+        return targets
+
+class ComparisonTargetSerializer(serializers.ModelSerializer):
+    target = serializers.CharField(source='label')
+
+    class Meta:
+        model = ComparisonTarget
+        fields = [
+            'target', 'provider', 'model_id', 'chatroom_id', 'status', 'time_to_first_token', 'total_time',
+            'output_tokens',
+        ]
+
+class ComparisonSerializer(serializers.ModelSerializer):
+    targets = ComparisonTargetSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Comparison
+        fields = ['id', 'message', 'system_prompt', 'created_at', 'targets']
+
+class ModelLatencySerializer(serializers.Serializer):
+    provider = serializers.CharField()
+    model_id = serializers.CharField()
+    comparisons = serializers.IntegerField()
+    # Means over the completed comparisons, in seconds
+    time_to_first_token = serializers.FloatField()
+    total_time = serializers.FloatField()
+
+class DailyModelUsageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailyModelUsage
+        fields = ['day', 'provider', 'model_id', 'requests', 'input_tokens', 'output_tokens']
+
+class ChatRoomUsageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChatRoomUsage
+        fields = ['provider', 'model_id', 'requests', 'input_tokens', 'output_tokens']
+
+class ModelUsageSerializer(serializers.Serializer):
+    provider = serializers.CharField()
+    model_id = serializers.CharField()
+    requests = serializers.IntegerField()
+    input_tokens = serializers.IntegerField()
+    output_tokens = serializers.IntegerField()
+
+class UsageQuerySerializer(serializers.Serializer):
+    since = serializers.DateField(required=False)
+    until = serializers.DateField(required=False)
+    provider = serializers.CharField(required=False)
+    model_id = serializers.CharField(required=False)
+
+class SearchQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=500)
+    type = serializers.ChoiceField(choices=['messages', 'chatrooms'], required=False, default='messages')
+    chatroom_id = serializers.UUIDField(required=False)
+    limit = serializers.IntegerField(required=False, min_value=1)
+    cursor = serializers.CharField(required=False)
+
+class MessageSearchResultSerializer(serializers.ModelSerializer):
+    chatroom_title = serializers.CharField(source='chatroom.title')
+    # Matched words are wrapped in <mark>, the rest of the text is HTML escaped
+    snippet = serializers.CharField()
+    score = serializers.FloatField()
+
+    class Meta:
+        model = Message
+        fields = ['id', 'chatroom_id', 'chatroom_title', 'role', 'created_at', 'snippet', 'score']
+
+class ChatRoomSearchResultSerializer(serializers.ModelSerializer):
+    snippet = serializers.CharField()
+    score = serializers.FloatField()
+
+    class Meta:
+        model = ChatRoom
+        fields = ['id', 'title', 'updated_at', 'provider', 'model_id', 'snippet', 'score']
+
+class BatchJobCreateSerializer(serializers.Serializer):
+    # JSONL, one prompt per line, see core.batches
+    file = serializers.FileField()
+    provider = serializers.CharField(max_length=50)
+    model_id = serializers.CharField(max_length=50)
+    system_prompt = serializers.CharField(required=False, allow_blank=True, default='')
+    concurrency = serializers.IntegerField(required=False, min_value=1)
+    mode = serializers.ChoiceField(choices=BatchJob.MODE_CHOICES, required=False, default=BatchJob.LOCAL)
+
+class BatchJobSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = BatchJob
+        fields = [
+            'id', 'provider', 'model_id', 'mode', 'status', 'concurrency', 'total_items', 'completed_items',
+            'failed_items', 'progress', 'input_tokens', 'output_tokens', 'provider_batch_id', 'error',
+            'created_at', 'started_at', 'finished_at',
+        ]
+
+    def get_progress(self, job) -> float:
+        """Share of the items finished, completed or failed"""
+        if not job.total_items:
+            return 0.0
+        return (job.completed_items + job.failed_items) / job.total_items
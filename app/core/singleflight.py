@@ -0,0 +1,108 @@
+"""
+Single-flight provider streams.
+
+When the same completion is requested several times at once (a burst of users on a
+canned prompt, client retries) only the first request, the leader, opens a provider
+stream. Identical requests arriving while it is in flight subscribe to its chunks
+instead; whatever was already received is replayed to them first. The upstream stream
+is cancelled once every subscriber has gone away. The provider bills the call once, to
+the leader, so followers see its token counts as zero.
+
+Requests are matched by core.responses.request_key. Flights are tracked per event loop,
+like the async provider clients, so only requests served by the same loop are joined.
+"""
+import asyncio
+import dataclasses
+import weakref
+
+
+class Flight:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+def unbilled(chunk):
+    """``chunk`` with the token counts it carries zeroed"""
+    usage = {
+        name: 0 for name in ('input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens')
+        if getattr(chunk, name) is not None
+    }
+    return dataclasses.replace(chunk, **usage) if usage else chunk
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = weakref.WeakKeyDictionary()
+        self.started = 0
+        self.joined = 0
+
+    def join(self, key):
+        """Subscribes to the identical request in flight, returns None if there is none"""
+        flight = self._flights.get(asyncio.get_running_loop(), {}).get(key)
+        if flight is None:
+            return None
+        self.joined += 1
+        flight.subscribers += 1
+        return self._follow(flight, leader=False)
+
+    def stream(self, key, start):
+        """
+        Returns ``(chunks, leader)``. ``start()`` is only called, to open the provider
+        stream, when no identical request is in flight; ``leader`` tells the caller
+        whether it was.
+        """
+        chunks = self.join(key)
+        if chunks is not None:
+            return chunks, False
+        flights = self._flights.setdefault(asyncio.get_running_loop(), {})
+        flight = flights[key] = Flight()
+        flight.task = asyncio.ensure_future(self._pump(flights, key, flight, start()))
+        flight.subscribers += 1
+        self.started += 1
+        return self._follow(flight, leader=True), True
+
+    async def _pump(self, flights, key, flight, chunks):
+        try:
+            async for chunk in chunks:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if flights.get(key) is flight:
+                del flights[key]
+            flight.notify()
+
+    async def _follow(self, flight, leader):
+        index = 0
+        try:
+            while True:
+                while index < len(flight.chunks):
+                    chunk = flight.chunks[index]
+                    yield chunk if leader else unbilled(chunk)
+                    index += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                flight.task.cancel()
+
+    def in_flight(self):
+        return sum(len(flights) for flights in list(self._flights.values()))
+
+
+single_flight = SingleFlight()
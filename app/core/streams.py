@@ -0,0 +1,324 @@
+"""
+Resumable completion streams.
+
+A completion used to live and die with the HTTP response that started it: a dropped
+connection either cancelled the provider call or left the client unable to reattach, and
+a retry paid for the whole reply again. ``completion_streams.start()`` instead runs the
+completion as a task of its own, detached from any connection, and writes every frame
+into a per-stream ring buffer under an increasing event id. Responses
+just read the buffer; a client that reconnects with ``Last-Event-ID`` gets the frames it
+missed replayed and then follows the stream live.
+
+Buffers are kept in process memory by default. ``CacheStreamBuffer`` keeps them in a
+Django cache instead (a Redis cache in production, LocMem as a local stand-in) so any
+worker can serve a reconnect; readers of that backend poll for new frames.
+
+Once the last reader of a running stream went away (the client closed the tab: the WSGI
+server closes the response at its next failed write, the ASGI server cancels it on
+``http.disconnect``) and nobody reattached within DISCONNECT_GRACE seconds, the stream is
+cancelled: the provider connection is closed and the partial reply stored as aborted.
+``cancel()`` does the same on request. Only the process running a stream can cancel it.
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .asgi import shared_sync_threads
+from .background import background_loop
+from .sse import encode_event
+
+logger = logging.getLogger('api')
+
+DEFAULT_STREAM_BUFFER_OPTIONS = {
+    'BACKEND': 'core.streams.MemoryStreamBuffer',
+    # Frames kept per stream, older ones can no longer be replayed
+    'MAX_EVENTS': 1000,
+    # Seconds a stream stays replayable after it finished
+    'TTL': 300,
+    # Seconds a running stream is kept without readers for the client to reconnect before it
+    # is cancelled, None never cancels it
+    'DISCONNECT_GRACE': 2.0,
+    # CacheStreamBuffer only
+    'CACHE_ALIAS': 'default',
+    'POLL_INTERVAL': 0.05,
+}
+
+
+class StreamNotFound(KeyError):
+    pass
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _Stream:
+    def __init__(self, max_events):
+        self.events = deque(maxlen=max_events)
+        self.last_id = 0
+        self.finished_at = None
+        self.waiters = []
+
+
+class MemoryStreamBuffer:
+    """
+    Ring buffers in process memory. Readers may run on a different event loop than the
+    writer (ASGI requests vs. the background loop) and are woken through their own loop.
+    """
+    def __init__(self, options):
+        self.options = options
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def create(self, stream_id):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, stream in self._streams.items()
+                       if stream.finished_at is not None and now - stream.finished_at > self.options['TTL']]
+            for key in expired:
+                del self._streams[key]
+            self._streams[stream_id] = _Stream(self.options['MAX_EVENTS'])
+
+    def exists(self, stream_id):
+        return stream_id in self._streams
+
+    def append(self, stream_id, frame):
+        stream = self._streams[stream_id]
+        with self._lock:
+            stream.last_id += 1
+            stream.events.append((stream.last_id, b'id: %d\n' % stream.last_id + frame))
+            self._notify(stream)
+            return stream.last_id
+
+    def finish(self, stream_id):
+        stream = self._streams[stream_id]
+        with self._lock:
+            stream.finished_at = time.monotonic()
+            self._notify(stream)
+
+    def _notify(self, stream):
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for loop, waiter in stream.waiters:
+            if loop is current:
+                _wake(waiter)
+            elif not loop.is_closed():
+                loop.call_soon_threadsafe(_wake, waiter)
+        stream.waiters = []
+
+    async def read(self, stream_id, after=0):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            raise StreamNotFound(stream_id)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                first_id = stream.last_id - len(stream.events) + 1
+                frames = list(itertools.islice(stream.events, max(0, after + 1 - first_id), None))
+                finished = stream.finished_at is not None
+                if not frames and not finished:
+                    waiter = loop.create_future()
+                    stream.waiters.append((loop, waiter))
+            if frames:
+                for after, frame in frames:
+                    yield frame
+            elif finished:
+                return
+            else:
+                await waiter
+
+
+class CacheStreamBuffer:
+    """
+    Ring buffers in a Django cache, shared by every process using it. The writer deletes
+    frames that fall out of the ring; readers poll every POLL_INTERVAL seconds.
+    """
+    def __init__(self, options):
+        self.options = options
+        self._last_ids = {}
+
+    @property
+    def cache(self):
+        return caches[self.options['CACHE_ALIAS']]
+
+    def key(self, stream_id, event_id=None):
+        return f'sse-stream:{stream_id}' if event_id is None else f'sse-stream:{stream_id}:{event_id}'
+
+    def create(self, stream_id):
+        self._last_ids[stream_id] = 0
+        self.cache.set(self.key(stream_id), {'last_id': 0, 'finished': False}, timeout=self.options['TTL'])
+
+    def exists(self, stream_id):
+        return self.cache.get(self.key(stream_id)) is not None
+
+    def append(self, stream_id, frame):
+        event_id = self._last_ids[stream_id] = self._last_ids[stream_id] + 1
+        self.cache.set(self.key(stream_id, event_id), b'id: %d\n' % event_id + frame, timeout=self.options['TTL'])
+        if event_id > self.options['MAX_EVENTS']:
+            self.cache.delete(self.key(stream_id, event_id - self.options['MAX_EVENTS']))
+        self.cache.set(self.key(stream_id), {'last_id': event_id, 'finished': False}, timeout=self.options['TTL'])
+        return event_id
+
+    def finish(self, stream_id):
+        last_id = self._last_ids.pop(stream_id)
+        self.cache.set(self.key(stream_id), {'last_id': last_id, 'finished': True}, timeout=self.options['TTL'])
+
+    async def read(self, stream_id, after=0):
+        while True:
+            state = self.cache.get(self.key(stream_id))
+            if state is None:
+                raise StreamNotFound(stream_id)
+            first_id = max(after + 1, state['last_id'] - self.options['MAX_EVENTS'] + 1)
+            if first_id <= state['last_id']:
+                ids = range(first_id, state['last_id'] + 1)
+                frames = self.cache.get_many([self.key(stream_id, event_id) for event_id in ids])
+                for event_id in ids:
+                    frame = frames.get(self.key(stream_id, event_id))
+                    if frame is not None:
+                        yield frame
+                after = state['last_id']
+            elif state['finished']:
+                return
+            else:
+                await asyncio.sleep(self.options['POLL_INTERVAL'])
+
+
+class CompletionStreams:
+    """
+    Starts completion streams and reads them back by stream id. The first frame of every stream is ``{"type": "start", "stream_id": ...}``.
+    """
+    def __init__(self, options=None):
+        self._options = options
+        self._buffer = None
+        self._tasks = set()
+        # Cancel callbacks of the streams running in this process, and their reader counts
+        self._running = {}
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def options(self):
+        if self._options is None:
+            self._options = {**DEFAULT_STREAM_BUFFER_OPTIONS, **getattr(settings, 'STREAM_BUFFERS', {})}
+        return self._options
+
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            self._buffer = import_string(self.options['BACKEND'])(self.options)
+        return self._buffer
+
+    def start(self, frames):
+        """
+        Runs the ``frames`` async generator to completion, independently of the caller.
+        Called from a sync view it runs on the background loop, from an async view on the
+        server's loop in a fresh context, so it outlives the request.
+        """
+        stream_id = uuid.uuid4().hex
+        self.buffer.create(stream_id)
+        self.buffer.append(stream_id, encode_event({'type': 'start', 'stream_id': stream_id}))
+
+        # Registered up front, the pump may be done before it is scheduled below
+        with self._lock:
+            self._running[stream_id] = None
+        pump = self._pump(stream_id, frames)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            future = asyncio.run_coroutine_threadsafe(pump, background_loop.loop)
+            cancel = future.cancel
+        else:
+            task = contextvars.Context().run(loop.create_task, pump)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            cancel = lambda: loop.call_soon_threadsafe(task.cancel)
+        with self._lock:
+            if stream_id in self._running:
+                self._running[stream_id] = cancel
+        return stream_id
+
+    async def _pump(self, stream_id, frames):
+        # The stream's ORM calls run on the shared pool rather than asgiref's single global thread
+        shared_sync_threads.enter()
+        try:
+            async for frame in frames:
+                self.buffer.append(stream_id, frame)
+        except asyncio.CancelledError:
+            self.buffer.append(stream_id, encode_event({'type': 'cancelled'}))
+            # The buffer is still finished below, the task itself has to end cancelled
+            raise
+        except Exception:
+            logger.exception('Completion stream %s failed', stream_id)
+        finally:
+            with self._lock:
+                self._running.pop(stream_id, None)
+                self._readers.pop(stream_id, None)
+            self.buffer.finish(stream_id)
+
+    def exists(self, stream_id):
+        return self.buffer.exists(stream_id)
+
+    async def read(self, stream_id, last_event_id=0):
+        """Async generator over the frames after ``last_event_id``, live until the stream ends"""
+        with self._lock:
+            if stream_id in self._running:
+                self._readers[stream_id] = self._readers.get(stream_id, 0) + 1
+        finished = False
+        try:
+            async for frame in self.buffer.read(stream_id, last_event_id):
+                yield frame
+            finished = True
+        finally:
+            self._detach(stream_id, finished)
+
+    def _detach(self, stream_id, finished):
+        with self._lock:
+            readers = self._readers.get(stream_id)
+            if readers is None:
+                return
+            self._readers[stream_id] = readers = readers - 1
+        grace = self.options['DISCONNECT_GRACE']
+        if readers or finished or grace is None or stream_id not in self._running:
+            return
+        if grace:
+            loop = background_loop.loop
+            loop.call_soon_threadsafe(loop.call_later, grace, self._abandon, stream_id)
+        else:
+            self._abandon(stream_id)
+
+    def _abandon(self, stream_id):
+        """Cancels the stream unless a reader reattached in the meantime"""
+        with self._lock:
+            if self._readers.get(stream_id) or self._running.get(stream_id) is None:
+                return
+            cancel = self._running.pop(stream_id)
+        logger.debug('Completion stream %s has no readers left, cancelling it', stream_id)
+        cancel()
+
+    def cancel(self, stream_id):
+        """Cancels a stream running in this process, returns False when there is none"""
+        with self._lock:
+            if self._running.get(stream_id) is None:
+                return False
+            cancel = self._running.pop(stream_id)
+        cancel()
+        return True
+
+    def reset(self):
+        self._options = None
+        self._buffer = None
+
+
+completion_streams = CompletionStreams()
@@ -0,0 +1,417 @@
+"""
+A small local HTTP server that speaks just enough of the OpenAI and Anthropic
+streaming and batch APIs to stand in for the real providers in load tests and test cases.
+
+Point the SDKs at it with ``OPENAI_BASE_URL=<server.openai_base_url>`` and
+``ANTHROPIC_BASE_URL=<server.anthropic_base_url>`` and the real clients will
+parse its streams exactly like they parse production traffic.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import threading
+from collections import deque
+from email.parser import BytesParser
+
+
+class StubProviderServer:
+    """
+    Serves ``GET /v1/models``, ``POST /v1/chat/completions`` and ``POST /v1/messages``,
+    plus the OpenAI files and batches endpoints and Anthropic's message batches.
+
+    Every streamed completion emits ``tokens`` copies of ``token_text``, sleeping
+    ``token_delay`` seconds between them. Connection and request counters are kept
+    so callers can assert on how the clients behaved, and faults can be injected into
+    the next completions with ``fail()``. Batches complete every request the same way as
+    soon as they are created, but report themselves in progress for the first
+    ``batch_polls`` status checks.
+
+    Streamed completions also go through a prompt cache, with usage reported the way the
+    providers do: Anthropic caches the prefixes ending on blocks marked with
+    ``cache_control``, OpenAI every message boundary on its own.
+    """
+    def __init__(self, host='127.0.0.1', port=0, tokens=20, token_delay=0.0, token_text='tok ', batch_polls=1):
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.token_text = token_text
+        self.batch_polls = batch_polls
+
+        self.connections_opened = 0
+        self.open_connections = 0
+        self.requests_served = 0
+        self.request_bodies = deque(maxlen=100)
+        self.faults = deque()
+        self.files = {}
+        self.batches = {}
+        self.prompt_cache = set()
+        self._ids = itertools.count(1)
+
+        self._server = None
+        self._connections = {}
+        self._loop = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def openai_base_url(self):
+        return f'{self.url}/v1'
+
+    @property
+    def anthropic_base_url(self):
+        return self.url
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Pooled clients keep idle connections open, hang up on them so wait_closed() returns
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def fail(self, status=None, retry_after=None, delay=0.0, times=1):
+        """
+        Makes the next ``times`` completions answer with an error ``status`` (and a
+        ``Retry-After`` header), or stall ``delay`` seconds before their first token.
+        """
+        for _ in range(times):
+            self.faults.append({'status': status, 'retry_after': retry_after, 'delay': delay})
+
+    def start_in_thread(self):
+        """Run the server on its own event loop so synchronous code can call it."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='stub-provider', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start_in_thread()
+
+    def __exit__(self, *exc_info):
+        self.stop_thread()
+
+    async def _handle(self, reader, writer):
+        self.connections_opened += 1
+        self.open_connections += 1
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests_served += 1
+                await self._route(method, target.split('?', 1)[0], body, writer, headers.get('content-type', ''))
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.open_connections -= 1
+            self._connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def _route(self, method, path, body, writer, content_type=''):
+        if content_type.startswith('multipart/form-data'):
+            payload = self._form_fields(body, content_type)
+        else:
+            payload = json.loads(body) if body else {}
+        self.request_bodies.append(payload)
+
+        if method == 'GET' and path == '/v1/models':
+            data = [{'id': model_id, 'object': 'model', 'created': 0, 'owned_by': 'stub'}
+                    for model_id in ('stub-model-a', 'stub-model-b')]
+            await self._send_json(writer, 200, {'object': 'list', 'data': data})
+        elif method == 'POST' and path in ('/v1/chat/completions', '/v1/messages'):
+            fault = self.faults.popleft() if self.faults else None
+            if fault is not None and fault['status']:
+                headers = {'Retry-After': str(fault['retry_after'])} if fault['retry_after'] is not None else {}
+                error = {'type': 'error', 'error': {'type': 'stub_fault', 'message': f"Injected {fault['status']}"}}
+                await self._send_json(writer, fault['status'], error, headers)
+                return
+            if fault is not None:
+                await asyncio.sleep(fault['delay'])
+            events = self._openai_events(payload) if path == '/v1/chat/completions' else self._anthropic_events(payload)
+            await self._send_stream(writer, events)
+        elif path.startswith(('/v1/files', '/v1/batches', '/v1/messages/batches')):
+            await self._batch_route(method, path, payload, writer)
+        else:
+            await self._send_json(writer, 404, {'error': {'message': f'No stub route for {method} {path}'}})
+
+    async def _batch_route(self, method, path, payload, writer):
+        parts = path.strip('/').split('/')
+        if method == 'POST' and path == '/v1/files':
+            file_id = f'file-{next(self._ids)}'
+            self.files[file_id] = payload['file']
+            await self._send_json(writer, 200, {
+                'id': file_id, 'object': 'file', 'bytes': len(payload['file']), 'created_at': 0,
+                'filename': 'batch.jsonl', 'purpose': payload.get('purpose', 'batch'), 'status': 'processed',
+            })
+        elif method == 'GET' and len(parts) == 4 and parts[1] == 'files' and parts[3] == 'content':
+            if parts[2] not in self.files:
+                await self._send_json(writer, 404, {'error': {'message': f'No such file: {parts[2]}'}})
+                return
+            await self._send_body(writer, 200, self.files[parts[2]], 'application/octet-stream')
+        elif method == 'POST' and path == '/v1/batches':
+            lines = self.files[payload['input_file_id']].decode().splitlines()
+            results = [self._openai_batch_result(json.loads(line)) for line in lines if line.strip()]
+            output_id = f'file-{next(self._ids)}'
+            self.files[output_id] = '\n'.join(map(json.dumps, results)).encode()
+            batch_id = f'batch_{next(self._ids)}'
+            self.batches[batch_id] = {
+                'polls': 0, 'output_file_id': output_id,
+                'batch': {
+                    'id': batch_id, 'object': 'batch', 'endpoint': payload['endpoint'],
+                    'input_file_id': payload['input_file_id'], 'completion_window': payload['completion_window'],
+                    'status': 'in_progress', 'created_at': 0, 'output_file_id': None, 'error_file_id': None,
+                    'request_counts': {'total': len(results), 'completed': 0, 'failed': 0},
+                },
+            }
+            await self._send_json(writer, 200, self.batches[batch_id]['batch'])
+        elif method == 'POST' and path == '/v1/messages/batches':
+            results = [
+                {'custom_id': request['custom_id'], 'result': self._anthropic_batch_result(request['params'])}
+                for request in payload['requests']
+            ]
+            batch_id = f'msgbatch_{next(self._ids)}'
+            self.files[batch_id] = '\n'.join(map(json.dumps, results)).encode()
+            self.batches[batch_id] = {
+                'polls': 0,
+                'batch': {
+                    'id': batch_id, 'type': 'message_batch', 'processing_status': 'in_progress',
+                    'created_at': '1970-01-01T00:00:00Z', 'expires_at': '1970-01-02T00:00:00Z',
+                    'ended_at': None, 'archived_at': None, 'cancel_initiated_at': None, 'results_url': None,
+                    'request_counts': {'processing': len(results), 'succeeded': 0, 'errored': 0,
+                                       'canceled': 0, 'expired': 0},
+                },
+            }
+            await self._send_json(writer, 200, self.batches[batch_id]['batch'])
+        else:
+            batch_id = parts[-2] if parts[-1] in ('cancel', 'results') else parts[-1]
+            entry = self.batches.get(batch_id)
+            if entry is None:
+                await self._send_json(writer, 404, {'error': {'message': f'No such batch: {batch_id}'}})
+            elif parts[-1] == 'results':
+                await self._send_body(writer, 200, self.files[batch_id], 'application/binary')
+            elif parts[-1] == 'cancel':
+                if 'object' in entry['batch']:
+                    entry['batch']['status'] = 'cancelled'
+                else:
+                    entry['batch']['cancel_initiated_at'] = '1970-01-01T00:00:00Z'
+                await self._send_json(writer, 200, entry['batch'])
+            else:
+                entry['polls'] += 1
+                if entry['polls'] > self.batch_polls:
+                    self._end_batch(entry)
+                await self._send_json(writer, 200, entry['batch'])
+
+    def _end_batch(self, entry):
+        batch = entry['batch']
+        if 'object' in batch:
+            if batch['status'] == 'in_progress':
+                batch['status'] = 'completed'
+                batch['output_file_id'] = entry['output_file_id']
+        elif batch['processing_status'] != 'ended':
+            batch['processing_status'] = 'ended'
+            batch['ended_at'] = '1970-01-01T00:00:00Z'
+            batch['results_url'] = f"{self.url}/v1/messages/batches/{batch['id']}/results"
+
+    def _batch_fault(self):
+        """Batch requests fail with the next injected fault status, delays do not apply"""
+        fault = self.faults.popleft() if self.faults else None
+        return fault['status'] if fault is not None else None
+
+    def _openai_batch_result(self, request):
+        body, status = request['body'], self._batch_fault()
+        if status:
+            return {'id': 'batch_req_stub', 'custom_id': request['custom_id'], 'error': None, 'response': {
+                'status_code': status, 'request_id': 'req_stub',
+                'body': {'error': {'type': 'stub_fault', 'message': f'Injected {status}'}},
+            }}
+        prompt_tokens = self._prompt_tokens(body)
+        return {'id': 'batch_req_stub', 'custom_id': request['custom_id'], 'error': None, 'response': {
+            'status_code': 200, 'request_id': 'req_stub',
+            'body': {
+                'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': 0, 'model': body.get('model'),
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {
+                    'role': 'assistant', 'content': self.token_text * self.tokens,
+                }}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': self.tokens,
+                          'total_tokens': prompt_tokens + self.tokens},
+            },
+        }}
+
+    def _anthropic_batch_result(self, params):
+        status = self._batch_fault()
+        if status:
+            return {'type': 'errored', 'error': {'type': 'error', 'error': {
+                'type': 'api_error', 'message': f'Injected {status}',
+            }}}
+        return {'type': 'succeeded', 'message': {
+            'id': 'msg_stub', 'type': 'message', 'role': 'assistant', 'model': params.get('model'),
+            'content': [{'type': 'text', 'text': self.token_text * self.tokens}],
+            'stop_reason': 'end_turn', 'stop_sequence': None,
+            'usage': {'input_tokens': self._prompt_tokens(params), 'output_tokens': self.tokens},
+        }}
+
+    def _form_fields(self, body, content_type):
+        """The fields of a multipart/form-data body, file contents as bytes"""
+        message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        fields = {}
+        for part in message.get_payload():
+            value = part.get_payload(decode=True)
+            fields[part.get_param('name', header='content-disposition')] = (
+                value if part.get_filename() else value.decode()
+            )
+        return fields
+
+    async def _send_json(self, writer, status, payload, headers=None):
+        await self._send_body(writer, status, json.dumps(payload).encode(), 'application/json', headers)
+
+    async def _send_body(self, writer, status, body, content_type, headers=None):
+        extra = ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+        writer.write(
+            f'HTTP/1.1 {status} Stub\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'{extra}Content-Length: {len(body)}\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+
+    async def _send_stream(self, writer, frames):
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/event-stream\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+        )
+        for frame in frames:
+            if frame is None:
+                await writer.drain()
+                if self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+                continue
+            data = frame.encode()
+            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    def _blocks(self, payload):
+        """The prompt as ``(role, text, cache breakpoint)`` blocks, system prompt first"""
+        blocks = []
+        for role, content in [('system', payload.get('system') or [])] + [
+            (message.get('role'), message.get('content', '')) for message in payload.get('messages', [])
+        ]:
+            if isinstance(content, str):
+                blocks.append((role, content, False))
+            else:
+                blocks.extend((role, block.get('text', ''), 'cache_control' in block) for block in content)
+        return blocks
+
+    def _prompt_tokens(self, payload):
+        return max(1, sum(len(text) for _, text, _ in self._blocks(payload)) // 4)
+
+    def _cached_tokens(self, payload, breakpoints_only):
+        """
+        Prompt tokens ``(read, written)`` from and to the prompt cache: the longest prefix
+        cached before is read, the prefixes up to each breakpoint (or block) are written.
+        """
+        blocks = self._blocks(payload)
+        digest, chars, prefixes = hashlib.sha1(), 0, []
+        for role, text, breakpoint in blocks:
+            digest.update(json.dumps([role, text]).encode())
+            chars += len(text)
+            prefixes.append((digest.hexdigest(), chars // 4, breakpoint or not breakpoints_only))
+        read = max([tokens for key, tokens, _ in prefixes if key in self.prompt_cache], default=0)
+        written = 0
+        for key, tokens, cached in prefixes:
+            if cached and key not in self.prompt_cache:
+                self.prompt_cache.add(key)
+                written = max(written, tokens - read)
+        return read, written
+
+    def _openai_events(self, payload):
+        """Yields SSE frames; ``None`` marks a token boundary where the server may pause."""
+        model = payload.get('model', 'stub-model')
+
+        def chunk(delta, finish_reason=None):
+            return 'data: ' + json.dumps({
+                'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': 0, 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }) + '\n\n'
+
+        yield chunk({'role': 'assistant', 'content': ''})
+        for _ in range(self.tokens):
+            yield chunk({'content': self.token_text})
+            yield None
+        yield chunk({}, 'stop')
+        if payload.get('stream_options', {}).get('include_usage'):
+            prompt_tokens = self._prompt_tokens(payload)
+            cached, _ = self._cached_tokens(payload, breakpoints_only=False)
+            yield 'data: ' + json.dumps({
+                'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': 0, 'model': model,
+                'choices': [],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': self.tokens,
+                          'total_tokens': prompt_tokens + self.tokens,
+                          'prompt_tokens_details': {'cached_tokens': cached}},
+            }) + '\n\n'
+        yield 'data: [DONE]\n\n'
+
+    def _anthropic_events(self, payload):
+        model = payload.get('model', 'stub-model')
+
+        def event(name, data):
+            return f'event: {name}\ndata: {json.dumps(dict(data, type=name))}\n\n'
+
+        read, written = self._cached_tokens(payload, breakpoints_only=True)
+        yield event('message_start', {'message': {
+            'id': 'msg_stub', 'type': 'message', 'role': 'assistant', 'content': [], 'model': model,
+            'stop_reason': None, 'stop_sequence': None,
+            'usage': {'input_tokens': self._prompt_tokens(payload) - read - written, 'output_tokens': 1,
+                      'cache_read_input_tokens': read, 'cache_creation_input_tokens': written},
+        }})
+        yield event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+        for _ in range(self.tokens):
+            yield event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': self.token_text}})
+            yield None
+        yield event('content_block_stop', {'index': 0})
+        yield event('message_delta', {'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                      'usage': {'output_tokens': self.tokens}})
+        yield event('message_stop', {})
@@ -1,3 +1,1537 @@
-from django.test import TestCase
+import asyncio
+import importlib.util
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import addModuleCleanup, mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+
+from .asgi import shared_sync_threads
+from .batches import InvalidBatch, batch_runner, parse_items
+from .catalog import ModelCatalog, model_catalog
+from .clients import ProviderClientRegistry, provider_clients
+from .completions import stream_completion
+from .context import DEFAULT_CONTEXT_OPTIONS, Context, ContextBuilder
+from .management.benchmark import asgi_request, fake_provider, seed_messages
+from .metrics import Histogram, metrics, model_labels
+from .models import BatchItem, BatchJob, ChatRoom, ChatRoomUsage, DailyModelUsage, Message
+from .persistence import DEFAULT_WRITE_BEHIND_OPTIONS, MessageWriter, message_writer
+from .providers import Chunk, ProviderNotFound, ProviderRegistry, providers
+from .providers.anthropic import ANTHROPIC_MODELS, AnthropicProvider
+from .providers.fake import FakeProvider
+from .providers.openai import OpenAIProvider
+from .renderers import ORJSONRenderer
+from .resilience import DEFAULT_RESILIENCE_OPTIONS, ResilientStreams
+from .responses import DEFAULT_RESPONSE_CACHE_OPTIONS, ResponseCache, response_cache
+from .search import parse_query
+from .selector import DEFAULT_SELECTOR_OPTIONS, ModelSelector, NoEligibleModel, model_selector
+from .serializers import ChatRoomSerializer, MessageSerializer
+from .scheduler import DEFAULT_RATE_LIMIT_OPTIONS, QueueTimeout, RateLimitScheduler, scheduler
+from .singleflight import SingleFlight, single_flight
+from .sse import _dumps, coalesce, encode_event
+from .streams import (
+    DEFAULT_STREAM_BUFFER_OPTIONS, CacheStreamBuffer, CompletionStreams, MemoryStreamBuffer, StreamNotFound,
+    completion_streams,
+)
+from .stubserver import StubProviderServer
+from .usage import record_usage
+
+
+def setUpModule():
+    # The fake provider is off by default, the tests route completions to it
+    fake = fake_provider()
+    fake.enable()
+    addModuleCleanup(fake.disable)
+    addModuleCleanup(providers.reset)
+
+
+def stub_env(server):
+    return mock.patch.dict(os.environ, {
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': server.openai_base_url,
+        'ANTHROPIC_API_KEY': 'stub',
+        'ANTHROPIC_BASE_URL': server.anthropic_base_url,
+    })
+
+
+class AsyncCompletionViewTests(TransactionTestCase):
+    async def test_streams_and_stores_the_reply_over_asgi(self):
+        with StubProviderServer(tokens=5) as server, stub_env(server):
+            # AsyncClient drives the ASGI handler, the view runs on the event loop
+            response = await self.async_client.post('/api/providers/openai/models/gpt-4o/complete/async',
+                                                    {'message': 'hi'}, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            body = b''.join([chunk async for chunk in response.streaming_content])
+
+        events = [json.loads(line[len('data: '):]) for line in body.decode().split('\n') if line.startswith('data: ')]
+        content = ''.join(event['content'] for event in events if event.get('type') == 'chunk')
+        self.assertEqual(content, 'tok ' * 5)
+        self.assertEqual(events[-1]['type'], 'done')
+        messages = [(message.role, message.content) async for message in Message.objects.order_by('created_at')]
+        self.assertEqual(messages, [('user', 'hi'), ('assistant', content)])
+
+
+class ProviderClientRegistryTests(SimpleTestCase):
+    def test_sync_clients_reuse_one_connection(self):
+        with StubProviderServer(tokens=3) as server, stub_env(server):
+            registry = ProviderClientRegistry()
+            self.assertIs(registry.openai(), registry.openai())
+
+            for _ in range(5):
+                registry.openai().models.list()
+            for _ in range(3):
+                stream = registry.anthropic().messages.create(
+                    model='stub-model', max_tokens=10, stream=True,
+                    messages=[{'role': 'user', 'content': 'hi'}],
+                )
+                list(stream)
+
+            self.assertEqual(server.requests_served, 8)
+            # One keep-alive connection per provider client
+            self.assertEqual(server.connections_opened, 2)
+            stats = registry.stats()
+            self.assertEqual(stats['openai']['requests'], 5)
+            self.assertEqual(stats['openai']['connections'], 1)
+            self.assertEqual(stats['openai']['idle'], 1)
+            self.assertEqual(stats['anthropic']['requests'], 3)
+            registry.reset()
+
+    async def test_async_clients_reuse_connections_per_loop(self):
+        async with StubProviderServer(tokens=3) as server:
+            with stub_env(server):
+                registry = ProviderClientRegistry()
+                client = registry.async_openai()
+                for _ in range(4):
+                    stream = await client.chat.completions.create(
+                        model='stub-model', stream=True,
+                        messages=[{'role': 'user', 'content': 'hi'}],
+                    )
+                    chunks = [chunk async for chunk in stream]
+                    self.assertEqual(''.join(c.choices[0].delta.content or '' for c in chunks), 'tok ' * 3)
+
+                self.assertIs(registry.async_openai(), client)
+                self.assertEqual(server.connections_opened, 1)
+                self.assertEqual(registry.stats()['openai-async']['requests'], 4)
+                await client.close()
+
+    def test_async_clients_are_not_shared_between_loops(self):
+        registry = ProviderClientRegistry()
+
+        async def get_client():
+            return registry.async_openai()
+
+        with mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'stub'}):
+            self.assertIsNot(asyncio.run(get_client()), asyncio.run(get_client()))
+
+    def test_options_override_settings(self):
+        registry = ProviderClientRegistry({'MAX_CONNECTIONS': 3, 'MAX_KEEPALIVE_CONNECTIONS': 2,
+                                           'KEEPALIVE_EXPIRY': 1, 'CONNECT_TIMEOUT': 1, 'READ_TIMEOUT': 1,
+                                           'WRITE_TIMEOUT': 1, 'POOL_TIMEOUT': 1, 'HTTP2': False})
+        with mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'stub'}):
+            pool = registry.openai()._client._transport._pool
+        self.assertEqual(pool._max_connections, 3)
+        self.assertEqual(pool._max_keepalive_connections, 2)
+        self.assertFalse(registry.http2)
+
+
+class ModelCatalogTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = 0
+
+        def fetch():
+            self.calls += 1
+            return ['model-a', 'model-b']
+
+        self.catalog = ModelCatalog({'stub': fetch}, {'CACHE_ALIAS': 'default', 'TTL': 60, 'STALE_TTL': 600})
+        self.catalog.invalidate('stub')
+
+    def test_entries_are_cached_until_ttl(self):
+        first = self.catalog.get('stub')
+        second = self.catalog.get('stub')
+        self.assertEqual(first['models'], ['model-a', 'model-b'])
+        self.assertEqual(first['etag'], second['etag'])
+        self.assertEqual(self.calls, 1)
+
+    def test_stale_entries_are_served_while_refreshing(self):
+        self.catalog.get('stub')
+        with mock.patch('core.catalog.time.time', return_value=time.time() + 120):
+            with mock.patch.object(self.catalog, 'refresh_in_background') as refresh:
+                entry = self.catalog.get('stub')
+        refresh.assert_called_once_with('stub')
+        self.assertEqual(entry['models'], ['model-a', 'model-b'])
+        self.assertEqual(entry['max_age'], 0)
+        self.assertEqual(self.calls, 1)
+
+    def test_unknown_provider(self):
+        with self.assertRaises(ProviderNotFound):
+            self.catalog.get('nope')
+
+
+class ModelListViewTests(SimpleTestCase):
+    def setUp(self):
+        model_catalog.invalidate('anthropic')
+
+    def test_etag_revalidation(self):
+        with mock.patch.dict(os.environ, {'ANTHROPIC_API_KEY': 'stub'}):
+            response = self.client.get('/api/providers/anthropic/models')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), ANTHROPIC_MODELS)
+            self.assertIn('max-age=', response['Cache-Control'])
+            self.assertIn('stale-while-revalidate=', response['Cache-Control'])
+
+            revalidated = self.client.get('/api/providers/anthropic/models', HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(revalidated.status_code, 304)
+            self.assertEqual(revalidated.content, b'')
+
+    def test_unknown_provider(self):
+        self.assertEqual(self.client.get('/api/providers/nope/models').status_code, 404)
+
+
+def parse_events(body):
+    return [
+        json.loads(line[len('data: '):])
+        for frame in body.decode().split('\n\n') for line in frame.split('\n') if line.startswith('data: ')
+    ]
+
+
+def read_events(response):
+    return parse_events(b''.join(response.streaming_content))
+
+
+class MetricsTests(SimpleTestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('latency_seconds', 'Latency', ('stage',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value, 'connect')
+        samples = {(name, extra): value for name, labels, extra, value in histogram.samples()}
+        self.assertEqual(samples[('latency_seconds_bucket', 'le="0.1"')], 1)
+        self.assertEqual(samples[('latency_seconds_bucket', 'le="1.0"')], 3)
+        self.assertEqual(samples[('latency_seconds_bucket', 'le="+Inf"')], 4)
+        self.assertEqual(samples[('latency_seconds_count', '')], 4)
+        self.assertAlmostEqual(samples[('latency_seconds_sum', '')], 4.25)
+
+
+class ProviderRegistryTests(SimpleTestCase):
+    config = {
+        'fake': {'BACKEND': 'core.providers.fake.FakeProvider', 'OPTIONS': {'tokens': 3}},
+        'anthropic': {'BACKEND': 'core.providers.anthropic.AnthropicProvider'},
+    }
+
+    def test_adapters_are_built_once_from_config(self):
+        registry = ProviderRegistry(self.config)
+        adapter = registry.get('Fake')
+        self.assertIsInstance(adapter, FakeProvider)
+        self.assertIs(registry.get('fake'), adapter)
+        self.assertEqual(adapter.tokens, 3)
+
+    @skipUnless(os.getenv('FAKE_PROVIDER_ENABLED') is None, 'FAKE_PROVIDER_ENABLED is set')
+    def test_fake_provider_is_off_by_default(self):
+        from config import settings as project_settings
+        self.assertNotIn('fake', project_settings.COMPLETION_PROVIDERS)
+        with fake_provider():
+            self.assertIn('fake', ProviderRegistry().names())
+
+    def test_unknown_provider(self):
+        with self.assertRaises(ProviderNotFound):
+            ProviderRegistry(self.config).get('openai')
+
+    def test_hidden_providers_are_not_listed(self):
+        registry = ProviderRegistry(self.config)
+        self.assertEqual([adapter.name for adapter in registry.listed()], ['anthropic'])
+
+    async def test_fake_provider_streams_normalized_chunks(self):
+        adapter = FakeProvider('fake', tokens=3)
+        chunks = [chunk async for chunk in adapter.stream('fake-lorem', [])]
+        self.assertEqual([chunk.content for chunk in chunks], ['lorem', ' lorem', ' lorem', ''])
+        self.assertEqual(chunks[-1].output_tokens, 3)
+
+
+class CoalesceTests(SimpleTestCase):
+    async def batches(self, adapter, **kwargs):
+        return [[chunk.content for chunk in batch] async for batch in coalesce(adapter.stream('fake-lorem', []), **kwargs)]
+
+    async def test_first_chunk_is_flushed_then_batched_by_size(self):
+        batches = await self.batches(FakeProvider('fake', tokens=10, token_delay=0.001), max_bytes=10, max_delay=1)
+        self.assertEqual(batches, [['lorem']] + [[' lorem', ' lorem']] * 4 + [[' lorem', '']])
+
+    async def test_batches_are_flushed_on_time(self):
+        batches = await self.batches(FakeProvider('fake', tokens=4, token_delay=0.02), max_bytes=1000, max_delay=0.001)
+        self.assertEqual(len(batches), 4)
+
+    async def test_disabled(self):
+        batches = await self.batches(FakeProvider('fake', tokens=3), max_bytes=0)
+        self.assertEqual(batches, [['lorem'], [' lorem'], [' lorem'], ['']])
+
+    async def test_errors_are_raised_after_buffered_chunks(self):
+        class Failing(FakeProvider):
+            async def stream(self, model_id, history, system_prompt=''):
+                yield Chunk(content='partial')
+                raise RuntimeError('upstream closed')
+
+        seen = []
+        with self.assertRaisesMessage(RuntimeError, 'upstream closed'):
+            async for batch in coalesce(Failing('fake').stream('fake-lorem', []), max_bytes=100, max_delay=1):
+                seen += batch
+        self.assertEqual([chunk.content for chunk in seen], ['partial'])
+
+    def test_encode_event(self):
+        self.assertEqual(encode_event({'content': 'hé', 'type': 'chunk'}),
+                         'data: {"content":"hé","type":"chunk"}\n\n'.encode())
+
+    def test_encode_event_with_and_without_orjson(self):
+        payload = {'chatroom_id': uuid.UUID(int=1), 'at': timezone.now(), 'cost': Decimal('0.5')}
+        expected = b'data: ' + JSONRenderer().render(payload) + b'\n\n'
+        self.addCleanup(_dumps.cache_clear)
+        for spec in [importlib.util.find_spec, lambda name: None]:
+            _dumps.cache_clear()
+            with mock.patch('importlib.util.find_spec', spec):
+                self.assertEqual(encode_event(payload), expected)
+
+
+class StreamBufferTests(SimpleTestCase):
+    options = {**DEFAULT_STREAM_BUFFER_OPTIONS, 'MAX_EVENTS': 3, 'POLL_INTERVAL': 0.001}
+
+    async def follow(self, buffer):
+        buffer.create('s')
+        buffer.append('s', b'data: 1\n\n')
+
+        async def produce():
+            for value in range(2, 6):
+                await asyncio.sleep(0.005)
+                buffer.append('s', b'data: %d\n\n' % value)
+            buffer.finish('s')
+
+        producer = asyncio.ensure_future(produce())
+        frames = [frame async for frame in buffer.read('s')]
+        await producer
+        self.assertEqual(frames[0], b'id: 1\ndata: 1\n\n')
+        self.assertEqual(len(frames), 5)
+        # Only the last MAX_EVENTS frames can be replayed
+        self.assertEqual([frame async for frame in buffer.read('s', after=0)][0], b'id: 3\ndata: 3\n\n')
+        self.assertEqual(len([frame async for frame in buffer.read('s', after=4)]), 1)
+
+    async def test_memory_buffer(self):
+        await self.follow(MemoryStreamBuffer(self.options))
+
+    async def test_cache_buffer(self):
+        await self.follow(CacheStreamBuffer(self.options))
+        with self.assertRaises(StreamNotFound):
+            await anext(CacheStreamBuffer(self.options).read('unknown'))
+
+
+class ResponseCacheTests(SimpleTestCase):
+    options = {**DEFAULT_RESPONSE_CACHE_OPTIONS, 'ENABLED': True, 'MAX_ENTRIES': 2}
+
+    def setUp(self):
+        self.adapter = FakeProvider('fake')
+
+    def context(self, *messages, system_prompt=''):
+        return Context(history=[{'role': 'user', 'content': content} for content in messages], system_prompt=system_prompt)
+
+    def cache_reply(self, cache, context, content='reply'):
+        key, entry = cache.lookup(self.adapter, 'fake-lorem', context)
+        self.assertIsNone(entry)
+        cache.store(key, self.adapter, 'fake-lorem', context, content, 10, 2)
+
+    def test_exact_match(self):
+        cache = ResponseCache(self.options)
+        self.cache_reply(cache, self.context('hello'))
+        self.assertEqual(cache.lookup(self.adapter, 'fake-lorem', self.context(' hello '))[1]['content'], 'reply')
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-echo', self.context('hello'))[1])
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-lorem', self.context('hello', system_prompt='be brief'))[1])
+        self.assertEqual({key: cache.stats()[key] for key in ('hits', 'misses', 'stores', 'entries')},
+                         {'hits': 1, 'misses': 3, 'stores': 1, 'entries': 1})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResponseCache(self.options)
+        for prompt in ('a', 'b'):
+            self.cache_reply(cache, self.context(prompt))
+        cache.lookup(self.adapter, 'fake-lorem', self.context('a'))
+        self.cache_reply(cache, self.context('c'))
+        self.assertIsNotNone(cache.lookup(self.adapter, 'fake-lorem', self.context('a'))[1])
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-lorem', self.context('b'))[1])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_size_limits_and_expiry(self):
+        cache = ResponseCache({**self.options, 'MAX_ENTRY_BYTES': 5, 'TTL': 0})
+        self.cache_reply(cache, self.context('long'), content='too long')
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.cache_reply(cache, self.context('short'), content='ok')
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-lorem', self.context('short'))[1])
+
+    @skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_semantic_matches(self):
+        cache = ResponseCache({**self.options, 'SEMANTIC': True, 'SEMANTIC_THRESHOLD': 0.8})
+        self.cache_reply(cache, self.context('What is the capital of France? Answer in one word please'))
+        key, entry = cache.lookup(self.adapter, 'fake-lorem', self.context('what is the capital of France? answer in one word'))
+        self.assertEqual(entry['content'], 'reply')
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-lorem', self.context('Write a poem about the sea'))[1])
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-echo', self.context('What is the capital of France?'))[1])
+        self.assertEqual(cache.stats()['semantic_hits'], 1)
+
+    @skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_semantic_matches_need_the_same_history(self):
+        cache = ResponseCache({**self.options, 'SEMANTIC': True, 'SEMANTIC_THRESHOLD': 0.8})
+        history = [f'a long conversation about the history of Paris, part {index}' for index in range(30)]
+        self.cache_reply(cache, self.context(*history, 'What is the capital of France?'))
+        # Only the last message differs, most of the text is shared
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-lorem', self.context(*history, 'How old is the Eiffel tower?'))[1])
+        self.assertIsNone(cache.lookup(self.adapter, 'fake-lorem', self.context(*history[1:], 'What is the capital of France?'))[1])
+        self.assertEqual(cache.lookup(self.adapter, 'fake-lorem', self.context(*history, 'what is the capital of France'))[1]['content'], 'reply')
+
+
+class SingleFlightTests(TransactionTestCase):
+    def tearDown(self):
+        provider_clients.reset()
+
+    async def room(self):
+        chatroom = await ChatRoom.objects.acreate(title='t', provider='openai', model_id='gpt-4o')
+        await Message.objects.acreate(chatroom=chatroom, role='user', content='same prompt')
+        return chatroom
+
+    async def drain(self, stream, frames=()):
+        events = parse_events(b''.join(list(frames) + [frame async for frame in stream]))
+        return ''.join(event['content'] for event in events if event['type'] == 'chunk')
+
+    async def test_identical_requests_share_one_upstream_stream(self):
+        with StubProviderServer(tokens=10, token_delay=0.01) as server, stub_env(server):
+            provider_clients.reset()
+            adapter = OpenAIProvider('openai')
+            rooms = [await self.room() for _ in range(4)]
+
+            leader = stream_completion(adapter, 'gpt-4o', rooms[0], '')
+            # The others join once the leader already streamed part of the reply
+            received = [await anext(leader), await anext(leader)]
+            contents = await asyncio.gather(
+                self.drain(leader, received),
+                *[self.drain(stream_completion(adapter, 'gpt-4o', room, '')) for room in rooms[1:3]],
+            )
+            self.assertEqual(contents, ['tok ' * 10] * 3)
+            self.assertEqual(server.requests_served, 1)
+            self.assertEqual(await ChatRoomUsage.objects.acount(), 1)
+            self.assertEqual(single_flight.in_flight(), 0)
+            # The call is billed once, to the leader
+            replies = [await Message.objects.aget(chatroom=room, role='assistant') for room in rooms[:3]]
+            self.assertEqual([reply.source for reply in replies], [Message.PROVIDER, Message.SHARED, Message.SHARED])
+            self.assertGreater(replies[0].output_tokens, 0)
+            self.assertEqual([(reply.input_tokens, reply.output_tokens) for reply in replies[1:]], [(0, 0)] * 2)
+            counted = [await ChatRoom.objects.aget(id=room.id) for room in rooms[:3]]
+            self.assertEqual([room.output_tokens for room in counted], [replies[0].output_tokens, 0, 0])
+
+            await self.drain(stream_completion(adapter, 'gpt-4o', rooms[3], '', use_cache=False))
+            self.assertEqual(server.requests_served, 2)
+
+    async def test_upstream_is_cancelled_when_every_subscriber_left(self):
+        flights = SingleFlight()
+        start = lambda: FakeProvider('fake', token_delay=0.01).stream('fake-lorem', [])
+        first, leader = flights.stream('key', start)
+        second, joined = flights.stream('key', start)
+        self.assertEqual((leader, joined), (True, False))
+        self.assertEqual((await anext(first)).content, 'lorem')
+        self.assertEqual((await anext(second)).content, 'lorem')
+
+        flight = flights._flights[asyncio.get_running_loop()]['key']
+        await first.aclose()
+        self.assertFalse(flight.task.cancelled())
+        await second.aclose()
+        await asyncio.gather(flight.task, return_exceptions=True)
+        self.assertTrue(flight.task.cancelled())
+        self.assertEqual(flights.in_flight(), 0)
+
+
+class SchedulerTests(SimpleTestCase):
+    def scheduler(self, limits, backend='core.scheduler.MemoryRateLimitBackend', **options):
+        return RateLimitScheduler({**DEFAULT_RATE_LIMIT_OPTIONS, 'BACKEND': backend, 'LIMITS': limits,
+                                   'POLL_INTERVAL': 0.005, **options})
+
+    async def drain(self, scheduler, ticket):
+        return [position async for position in scheduler.wait(ticket)]
+
+    async def test_requests_per_minute(self):
+        scheduler = self.scheduler({'fake': {'RPM': 1}})
+        self.assertEqual(await self.drain(scheduler, scheduler.ticket('fake', 'fake-lorem', 10)), [])
+        ticket = scheduler.ticket('fake', 'fake-lorem', 10, max_wait=0.02)
+        positions = []
+        with self.assertRaises(QueueTimeout):
+            async for position in scheduler.wait(ticket):
+                positions.append(position)
+        self.assertEqual(positions, [1])
+        self.assertEqual(scheduler.stats(), {'fake': {'queued': 0}})
+        self.assertIsNone(scheduler.ticket('openai', 'gpt-4o', 10))
+
+    async def test_priority_then_arrival_order(self):
+        for backend in ('core.scheduler.MemoryRateLimitBackend', 'core.scheduler.CacheRateLimitBackend'):
+            with self.subTest(backend=backend):
+                cache.clear()
+                scheduler = self.scheduler({'fake:fake-lorem': {'CONCURRENCY': 1}}, backend)
+                running = scheduler.ticket('fake', 'fake-lorem', 10)
+                await self.drain(scheduler, running)
+
+                order = []
+
+                async def queue(name, priority):
+                    ticket = scheduler.ticket('fake', 'fake-lorem', 10, priority=priority)
+                    positions = await self.drain(scheduler, ticket)
+                    order.append((name, positions))
+                    await scheduler.release(ticket)
+
+                waiting = [asyncio.ensure_future(queue('low', 0)), asyncio.ensure_future(queue('high', 5))]
+                await asyncio.sleep(0.02)
+                await scheduler.release(running)
+                await asyncio.gather(*waiting)
+                # 'low' was first in line until 'high' arrived
+                self.assertEqual([name for name, _ in order], ['high', 'low'])
+                self.assertEqual(order[0][1], [1])
+                self.assertEqual(order[1][1][:2], [1, 2])
+
+    async def test_concurrency_leases_expire(self):
+        for backend in ('core.scheduler.MemoryRateLimitBackend', 'core.scheduler.CacheRateLimitBackend'):
+            with self.subTest(backend=backend):
+                cache.clear()
+                scheduler = self.scheduler({'fake': {'CONCURRENCY': 1}}, backend, LEASE_TTL=0.05)
+                # Never released, like the ticket of a worker that died mid-stream
+                await self.drain(scheduler, scheduler.ticket('fake', 'fake-lorem', 10))
+                ticket = scheduler.ticket('fake', 'fake-lorem', 10, max_wait=1)
+                self.assertEqual(await self.drain(scheduler, ticket), [1])
+                self.assertTrue(ticket.granted)
+
+    async def test_unused_tokens_are_credited_back(self):
+        scheduler = self.scheduler({'fake': {'TPM': 100}})
+        ticket = scheduler.ticket('fake', 'fake-lorem', 80)
+        await self.drain(scheduler, ticket)
+        await scheduler.release(ticket, tokens=30)
+        self.assertAlmostEqual(scheduler.backend._states['fake']['tokens'], 70, delta=1)
+
+
+class MessageWriterTests(TransactionTestCase):
+    def writer(self, **options):
+        writer = MessageWriter({**DEFAULT_WRITE_BEHIND_OPTIONS, **options})
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_messages_are_written_in_batches_in_order(self):
+        writer = self.writer(BATCH_SIZE=3, FLUSH_INTERVAL=10)
+        rooms = [ChatRoom.objects.create(title=name, provider='fake', model_id='fake-echo') for name in 'ab']
+        updated_at = rooms[0].updated_at
+        added = [writer.add(Message(chatroom=rooms[index % 2], role='user', content=f'm{index}')) for index in range(7)]
+        # Two full batches go out on their own, the seventh message waits for the interval
+        writer.flush(rooms[1].id)
+        self.assertEqual(Message.objects.count(), 6)
+        self.assertTrue(writer.pending(rooms[0].id))
+        writer.flush(rooms[0].id)
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [message.id for message in added])
+        self.assertEqual(writer.stats(), {'messages': 7, 'batches': 3, 'errors': 0, 'queued': 0})
+        self.assertGreater(ChatRoom.objects.get(id=rooms[0].id).updated_at, updated_at)
+
+    def test_close_writes_what_is_still_queued(self):
+        writer = self.writer(FLUSH_INTERVAL=10)
+        chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+        writer.add(Message(chatroom=chatroom, role='user', content='last words'))
+        writer.close()
+        self.assertEqual(Message.objects.get().content, 'last words')
+
+    def test_messages_endpoint_reads_its_writes(self):
+        chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+        with mock.patch.object(message_writer, '_options', {**DEFAULT_WRITE_BEHIND_OPTIONS, 'FLUSH_INTERVAL': 10}):
+            self.addCleanup(message_writer.close)
+            message_writer.add(Message(chatroom=chatroom, role='user', content='hi'))
+            self.assertFalse(Message.objects.exists())
+            results = self.client.get(f'/api/chatrooms/{chatroom.id}/messages').json()['results']
+            self.assertEqual([message['content'] for message in results], ['hi'])
+
+
+class ChatRoomCounterTests(TransactionTestCase):
+    def setUp(self):
+        self.chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+        self.addCleanup(providers.reset)
+
+    def test_counters_follow_written_messages(self):
+        writer = MessageWriter({**DEFAULT_WRITE_BEHIND_OPTIONS, 'FLUSH_INTERVAL': 10})
+        self.addCleanup(writer.close)
+        writer.add(Message(chatroom=self.chatroom, role='user', content='hello\n  there'))
+        reply = writer.add(Message(chatroom=self.chatroom, role='assistant', content='x' * 300,
+                                   input_tokens=12, output_tokens=30))
+        writer.flush()
+        # A message that was built earlier but written last does not become the last message
+        writer.add(Message(chatroom=self.chatroom, role='user', content='late',
+                           created_at=reply.created_at - timedelta(seconds=1)))
+        writer.flush()
+
+        self.chatroom.refresh_from_db()
+        self.assertEqual(self.chatroom.message_count, 3)
+        self.assertEqual((self.chatroom.input_tokens, self.chatroom.output_tokens), (12, 30))
+        self.assertEqual(self.chatroom.last_message_at, reply.created_at)
+        self.assertEqual(self.chatroom.last_message_preview, 'x' * 100)
+
+    @override_settings(COMPLETIONS={'CHECKPOINT': True, 'CHECKPOINT_INTERVAL': 0})
+    def test_checkpointed_completion_is_counted_once(self):
+        read_events(self.client.post('/api/providers/fake/models/fake-echo/complete',
+                                     {'message': 'count me', 'chatroom_id': str(self.chatroom.id)},
+                                     content_type='application/json'))
+        self.chatroom.refresh_from_db()
+        reply = self.chatroom.messages.get(role='assistant')
+        self.assertEqual(self.chatroom.message_count, 2)
+        self.assertEqual((self.chatroom.input_tokens, self.chatroom.output_tokens),
+                         (reply.input_tokens, reply.output_tokens))
+        self.assertEqual(self.chatroom.last_message_preview, 'count me')
+
+    def test_update_keeps_counters_written_meanwhile(self):
+        stale = ChatRoom.objects.get(id=self.chatroom.id)
+        seed_messages(self.chatroom, 2)
+        serializer = ChatRoomSerializer(stale, data={'title': 'renamed', 'message_count': 0}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        self.chatroom.refresh_from_db()
+        self.assertEqual(self.chatroom.title, 'renamed')
+        self.assertEqual(self.chatroom.message_count, 2)
+        self.assertEqual(self.chatroom.last_message_preview, 'benchmark message 1')
+
+    def test_sparse_fieldsets(self):
+        seed_messages(self.chatroom, 3)
+        ChatRoom.objects.create(title='other', provider='fake', model_id='fake-echo', system_prompt='long ' * 1000)
+        with CaptureQueriesContext(connection) as queries:
+            page = self.client.get('/api/chatrooms', {'fields': 'id,title,message_count', 'limit': 1}).json()
+        self.assertEqual(list(page['results'][0]), ['id', 'title', 'message_count'])
+        self.assertNotIn('system_prompt', queries[0]['sql'])
+        rest = self.client.get(page['next']).json()
+        self.assertEqual(rest['results'], [{'id': str(self.chatroom.id), 'title': 't', 'message_count': 3}])
+
+        detail = self.client.get(f'/api/chatrooms/{self.chatroom.id}', {'fields': 'last_message_preview'}).json()
+        self.assertEqual(detail, {'last_message_preview': 'benchmark message 2'})
+        self.assertIn('system_prompt', self.client.get('/api/chatrooms').json()['results'][0])
+        self.assertEqual(self.client.get('/api/chatrooms', {'fields': 'id,summary'}).status_code, 400)
+
+
+class ResilienceTests(SimpleTestCase):
+    history = [{'role': 'user', 'content': 'hi'}]
+
+    def tearDown(self):
+        provider_clients.reset()
+
+    def streams(self, **options):
+        return ResilientStreams({**DEFAULT_RESILIENCE_OPTIONS, 'BACKOFF_BASE': 0.01, **options})
+
+    async def read(self, streams, adapter, model_id):
+        return ''.join([chunk.content async for chunk in streams.stream(adapter, model_id, self.history)])
+
+    async def test_transient_errors_are_retried(self):
+        with StubProviderServer(tokens=3) as server, stub_env(server):
+            provider_clients.reset()
+            server.fail(status=429, retry_after=0)
+            server.fail(status=503)
+            streams = self.streams()
+            with self.assertLogs('api', 'INFO'):
+                self.assertEqual(await self.read(streams, OpenAIProvider('openai'), 'gpt-4o'), 'tok ' * 3)
+            self.assertEqual(server.requests_served, 3)
+            self.assertEqual(streams.metrics['retries'], 2)
+
+            server.fail(status=400)
+            with self.assertRaises(Exception):
+                await self.read(streams, OpenAIProvider('openai'), 'gpt-4o')
+            self.assertEqual(server.requests_served, 4)
+
+    async def test_failover_to_the_next_model(self):
+        with StubProviderServer(tokens=3) as server, stub_env(server):
+            provider_clients.reset()
+            server.fail(status=500, times=2)
+            streams = self.streams(MAX_RETRIES=1, FAILOVER={'openai:gpt-4o': ['anthropic:claude-3-haiku-20240307']})
+            with self.assertLogs('api', 'INFO') as logs:
+                self.assertEqual(await self.read(streams, OpenAIProvider('openai'), 'gpt-4o'), 'tok ' * 3)
+            self.assertIn('failing over to anthropic', logs.output[-1])
+            self.assertEqual(server.requests_served, 3)
+            self.assertEqual(server.request_bodies[-1]['model'], 'claude-3-haiku-20240307')
+            self.assertEqual(streams.metrics['failovers'], 1)
+
+    async def test_slow_first_token_is_hedged(self):
+        with StubProviderServer(tokens=3) as server, stub_env(server):
+            provider_clients.reset()
+            server.fail(delay=1.0)
+            streams = self.streams(HEDGE=True, HEDGE_MIN_SAMPLES=0, HEDGE_MIN_DELAY=0.05)
+            started = time.monotonic()
+            self.assertEqual(await self.read(streams, OpenAIProvider('openai'), 'gpt-4o'), 'tok ' * 3)
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.assertEqual(server.requests_served, 2)
+            self.assertEqual((streams.metrics['hedges'], streams.metrics['hedges_won']), (1, 1))
+
+
+class CompletionViewTests(TransactionTestCase):
+    def tearDown(self):
+        providers.reset()
+
+    async def test_async_completion_with_fake_provider(self):
+        response = await self.async_client.post(
+            '/api/providers/fake/models/fake-echo/complete/async',
+            {'message': 'hello there'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        events = parse_events(body)
+
+        self.assertEqual(''.join(event['content'] for event in events if event['type'] == 'chunk'), 'hello there')
+        self.assertEqual(events[-1]['type'], 'done')
+        self.assertEqual(events[-1]['message']['content'], 'hello there')
+        self.assertEqual(
+            [row async for row in Message.objects.values_list('role', 'content')],
+            [('user', 'hello there'), ('assistant', 'hello there')]
+        )
+
+    def test_asgi_streams_do_not_hold_threads(self):
+        from config.asgi import application
+
+        async def run():
+            peak = threading.active_count()
+            streams = asyncio.gather(*(
+                asgi_request(application, 'POST', '/api/providers/fake/models/fake-lorem/complete/async',
+                             {'message': f'stream {index}'})
+                for index in range(40)
+            ))
+            while not streams.done():
+                peak = max(peak, threading.active_count())
+                await asyncio.sleep(0.005)
+            return peak, await streams
+
+        # Outside of async_to_sync, which would run every sync call on this thread
+        before = threading.active_count()
+        peak, results = asyncio.run(run())
+        self.assertTrue(all(b'"type":"done"' in body for _, body in results))
+        self.assertLessEqual(peak, before + shared_sync_threads.options['MAX_WORKERS'] + 4)
+
+    def test_completion_stages_are_exported_as_metrics(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+        self.addCleanup(model_labels.clear)
+        self.addCleanup(model_catalog.invalidate, 'fake')
+        model_catalog.invalidate('fake')
+        # Labels only read the catalog already cached, they never fetch it
+        with mock.patch.object(FakeProvider, 'list_models') as list_models:
+            self.assertEqual(model_labels.label('fake', 'fake-lorem'), 'other')
+        list_models.assert_not_called()
+        self.client.get('/api/providers/fake/models')
+        for model_id in ('fake-lorem', 'made-up-1', 'made-up-2'):
+            read_events(self.client.post(f'/api/providers/fake/models/{model_id}/complete', {'message': 'hi'},
+                                         content_type='application/json'))
+        response = self.client.get('/metrics')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        labels = 'provider="fake",model="fake-lorem"'
+        self.assertIn(f'completions_total{{{labels},outcome="complete"}} 1', body)
+        self.assertIn(f'completion_time_to_first_token_seconds_count{{{labels}}} 1', body)
+        self.assertIn(f'completion_tokens_per_second_bucket{{{labels},le="+Inf"}} 1', body)
+        for stage in ('validate', 'chatroom_lookup', 'history_load', 'provider_connect', 'stream', 'persist'):
+            self.assertIn(f'completion_stage_seconds_count{{{labels},stage="{stage}"}} 1', body)
+        # Model ids the catalog does not list share one series
+        self.assertIn('completions_total{provider="fake",model="other",outcome="complete"} 2', body)
+        self.assertNotIn('made-up', body)
+
+    def test_sync_completion_runs_on_background_loop(self):
+        chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+        response = self.client.post(
+            '/api/providers/fake/models/fake-echo/complete',
+            {'message': 'hi again', 'chatroom_id': str(chatroom.id)}, content_type='application/json',
+        )
+        events = read_events(response)
+        self.assertEqual(events[-1]['message']['content'], 'hi again')
+        self.assertEqual(chatroom.messages.count(), 2)
+
+    @override_settings(COMPLETIONS={'CHECKPOINT': True, 'CHECKPOINT_INTERVAL': 0}, SSE_STREAMS={'FLUSH_BYTES': 0})
+    async def test_checkpoints_store_the_partial_reply(self):
+        chatroom = await ChatRoom.objects.acreate(title='t', provider='fake', model_id='fake-lorem')
+        adapter = FakeProvider('fake', tokens=5, token_delay=0.001)
+        stream = stream_completion(adapter, 'fake-lorem', chatroom, '')
+        for _ in range(3):
+            await anext(stream)
+        # Each frame is checkpointed right after it was sent
+        partial = await Message.objects.aget(chatroom=chatroom)
+        self.assertEqual((partial.status, partial.content), (Message.STREAMING, 'lorem lorem'))
+
+        await stream.aclose()
+        await partial.arefresh_from_db()
+        self.assertEqual((partial.status, partial.content), (Message.ABORTED, 'lorem lorem lorem'))
+
+        events = [event async for event in stream_completion(adapter, 'fake-lorem', chatroom, '')]
+        done = parse_events(b''.join(events))[-1]['message']
+        self.assertEqual((done['status'], done['content']), (Message.COMPLETE, ' '.join(['lorem'] * 5)))
+        self.assertEqual(await chatroom.messages.acount(), 2)
+
+    def test_reconnect_replays_missed_frames(self):
+        response = self.client.post('/api/providers/fake/models/fake-lorem/complete', {'message': 'hi'},
+                                    content_type='application/json')
+        stream_id = response['X-Stream-Id']
+        frames = iter(response.streaming_content)
+        received = next(frames) + next(frames)
+        response.close()
+        self.assertEqual(re.findall(rb'^id: (\d+)$', received, re.M), [b'1', b'2'])
+        self.assertEqual(parse_events(received)[0], {'type': 'start', 'stream_id': stream_id})
+
+        replay = read_events(self.client.get(f'/api/streams/{stream_id}', HTTP_LAST_EVENT_ID='2'))
+        content = ''.join(event['content'] for event in parse_events(received) + replay if event['type'] == 'chunk')
+        self.assertEqual(content, ' '.join(['lorem'] * 20))
+        self.assertEqual(replay[-1]['message']['content'], content)
+        self.assertEqual(Message.objects.filter(role='assistant').count(), 1)
+
+        self.assertEqual(self.client.get('/api/streams/nope').status_code, 404)
+
+    @mock.patch.object(response_cache, '_options', {**DEFAULT_RESPONSE_CACHE_OPTIONS, 'ENABLED': True})
+    def test_identical_requests_are_answered_from_the_cache(self):
+        def complete(**data):
+            response = self.client.post('/api/providers/fake/models/fake-echo/complete', {'message': 'hi', **data},
+                                        content_type='application/json')
+            return read_events(response)[-1]['message']['content']
+
+        self.addCleanup(response_cache.clear)
+        self.assertEqual([complete(), complete(), complete(cache=False)], ['hi', 'hi', 'hi'])
+        self.assertEqual({key: response_cache.stats()[key] for key in ('hits', 'misses')}, {'hits': 1, 'misses': 1})
+        self.assertEqual(sum(ChatRoomUsage.objects.values_list('requests', flat=True)), 2)
+        # The cached reply cost no provider tokens
+        replies = Message.objects.filter(role='assistant').order_by('created_at')
+        self.assertEqual([reply.output_tokens for reply in replies], [1, 0, 1])
+        self.assertEqual([reply.source for reply in replies], [Message.PROVIDER, Message.CACHE, Message.PROVIDER])
+        self.assertEqual([room.output_tokens for room in ChatRoom.objects.order_by('created_at')], [1, 0, 1])
+
+    async def test_completions_queue_for_rate_limits(self):
+        limited = RateLimitScheduler({**DEFAULT_RATE_LIMIT_OPTIONS, 'LIMITS': {'fake': {'CONCURRENCY': 1}},
+                                      'POLL_INTERVAL': 0.005})
+        running = limited.ticket('fake', 'fake-echo', 10)
+        async for _ in limited.wait(running):
+            pass
+        chatroom = await ChatRoom.objects.acreate(title='t', provider='fake', model_id='fake-echo')
+        await Message.objects.acreate(chatroom=chatroom, role='user', content='hi')
+
+        asyncio.get_running_loop().call_later(0.05, asyncio.ensure_future, limited.release(running))
+        with mock.patch('core.completions.scheduler', limited):
+            stream = stream_completion(FakeProvider('fake'), 'fake-echo', chatroom, '')
+            events = parse_events(b''.join([frame async for frame in stream]))
+        self.assertEqual(events[0], {'type': 'queued', 'position': 1})
+        self.assertEqual(events[-1]['message']['content'], 'hi')
+        self.assertEqual(limited.backend._states['fake']['leases'], {})
+
+    def test_unknown_provider(self):
+        response = self.client.post('/api/providers/nope/models/x/complete', {'message': 'hi'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(ChatRoom.objects.exists())
+
+
+@override_settings(COMPLETION_PROVIDERS={
+    'fake': {'BACKEND': 'core.providers.fake.FakeProvider', 'OPTIONS': {'tokens': 3}},
+    'slow': {'BACKEND': 'core.providers.fake.FakeProvider', 'OPTIONS': {'tokens': 3, 'token_delay': 0.05}},
+})
+class CompareViewTests(TransactionTestCase):
+    def setUp(self):
+        providers.reset()
+        self.addCleanup(providers.reset)
+
+    def test_targets_stream_concurrently_into_one_connection(self):
+        started = time.perf_counter()
+        response = self.client.post('/api/compare', {
+            'message': 'which is faster', 'targets': ['slow/fake-lorem', 'fake/fake-echo', 'slow/fake-echo'],
+        }, content_type='application/json')
+        events = read_events(response)
+        # Three slow streams of 3 tokens 50ms apart, run side by side
+        self.assertLess(time.perf_counter() - started, 0.4)
+
+        self.assertEqual([event['type'] for event in events[:2]], ['start', 'comparison'])
+        comparison_id = events[1]['comparison_id']
+        done = {event['target']: event['message']['content'] for event in events if event.get('type') == 'done'}
+        self.assertEqual(done, {
+            'slow/fake-lorem': 'lorem lorem lorem', 'fake/fake-echo': 'which is faster',
+            'slow/fake-echo': 'which is faster',
+        })
+        chunks = [event for event in events if event.get('type') == 'chunk']
+        self.assertTrue(all(event['target'] in done for event in chunks))
+        self.assertEqual(len([event for event in events if event.get('type') == 'timing']), 3)
+        summary = events[-1]
+        self.assertEqual(summary['type'], 'summary')
+        self.assertEqual(summary['targets'][0]['target'], 'fake/fake-echo')
+        self.assertTrue(all(target['status'] == 'complete' for target in summary['targets']))
+
+        # Every target answered in a chatroom of its own
+        comparison = self.client.get(f'/api/comparisons/{comparison_id}').json()
+        self.assertEqual([target['target'] for target in comparison['targets']],
+                         ['slow/fake-lorem', 'fake/fake-echo', 'slow/fake-echo'])
+        for target in comparison['targets']:
+            self.assertGreaterEqual(target['total_time'], target['time_to_first_token'])
+            messages = Message.objects.filter(chatroom_id=target['chatroom_id'])
+            self.assertEqual(list(messages.values_list('role', flat=True)), ['user', 'assistant'])
+
+        latency = self.client.get('/api/comparisons/latency').json()
+        self.assertEqual([(row['provider'], row['model_id']) for row in latency][0], ('fake', 'fake-echo'))
+        self.assertEqual({row['comparisons'] for row in latency}, {1})
+
+    async def test_async_compare(self):
+        response = await self.async_client.post('/api/compare/async', {
+            'message': 'hi', 'targets': ['fake/fake-echo', 'fake/fake-lorem'],
+        }, content_type='application/json')
+        events = parse_events(b''.join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual([target['status'] for target in events[-1]['targets']], ['complete', 'complete'])
+
+    def test_invalid_targets(self):
+        def post(targets):
+            return self.client.post('/api/compare', {'message': 'hi', 'targets': targets},
+                                    content_type='application/json').status_code
+        self.assertEqual(post(['fake/fake-echo', 'fake/fake-echo']), 400)
+        self.assertEqual(post(['fake-echo']), 400)
+        self.assertEqual(post([]), 400)
+        self.assertEqual(post(['fake/fake-echo', 'nope/model']), 404)
+        self.assertFalse(ChatRoom.objects.exists())
+
+
+@override_settings(COMPLETION_PROVIDERS={
+    'fake': {'BACKEND': 'core.providers.fake.FakeProvider', 'OPTIONS': {'tokens': 3}},
+    'slow': {'BACKEND': 'core.providers.fake.FakeProvider', 'OPTIONS': {'tokens': 3}},
+    'openai': {'BACKEND': 'core.providers.openai.OpenAIProvider'},
+})
+class ModelSelectorTests(SimpleTestCase):
+    def setUp(self):
+        providers.reset()
+        self.addCleanup(providers.reset)
+
+    def selector(self, **options):
+        return ModelSelector({
+            **DEFAULT_SELECTOR_OPTIONS,
+            'CANDIDATES': ['fake/fake-lorem', 'slow/fake-lorem', 'openai/gpt-4o-mini'],
+            'EXPLORE_RATE': 0,
+            **options,
+        })
+
+    def test_selects_the_fastest_model_meeting_the_constraints(self):
+        selector = self.selector()
+        # Expected reply times for 300 tokens: fake 0.2 + 6s, slow 1 + 1.5s, openai 0.5 + 3s (prior)
+        selector.add('fake/fake-lorem', time_to_first_token=0.2, tokens_per_second=50, output_tokens=300)
+        selector.add('slow/fake-lorem', time_to_first_token=1.0, tokens_per_second=200, output_tokens=300)
+        self.assertEqual(selector.select().key, 'slow/fake-lorem')
+        self.assertEqual(selector.select(max_latency=0.6).key, 'openai/gpt-4o-mini')
+        self.assertEqual(selector.select(max_latency=0.3).key, 'fake/fake-lorem')
+        self.assertEqual(selector.select(provider='fake').key, 'fake/fake-lorem')
+        # Only gpt-4o-mini has a window this large, and it has a price
+        self.assertEqual(selector.select(min_context=100000).key, 'openai/gpt-4o-mini')
+        self.assertEqual(selector.select(optimize='cost').key, 'slow/fake-lorem')
+        self.assertEqual(selector.select(max_cost=0).key, 'slow/fake-lorem')
+        with self.assertRaises(NoEligibleModel):
+            selector.select(max_cost=0, min_context=100000)
+
+        # Failures make a model look slower
+        for _ in range(3):
+            selector.add('slow/fake-lorem', error=True)
+        self.assertEqual(selector.select().key, 'openai/gpt-4o-mini')
+
+    def test_ring_buffer_keeps_the_recent_samples_and_persists(self):
+        selector = self.selector(WINDOW=4, ALPHA=0.5, CACHE_ALIAS='default')
+        for seconds in (1, 2, 3, 4, 5, 6):
+            selector.add('fake/fake-lorem', time_to_first_token=seconds, output_tokens=10)
+        selector.add('fake/fake-lorem', error=True)
+        stats = selector._stats['fake/fake-lorem']
+        self.assertEqual([sample[0] for sample in stats.recent()], [4, 5, 6, None])
+        self.assertEqual(stats.error_rate, 0.5)
+
+        selector.save()
+        self.addCleanup(cache.delete, selector.cache_key())
+        restored = self.selector(WINDOW=4, ALPHA=0.5, CACHE_ALIAS='default')
+        self.assertEqual(restored.stats()['fake/fake-lorem']['samples'], 4)
+        self.assertEqual(restored._stats['fake/fake-lorem'].recent(), stats.recent())
+
+    def test_selection_takes_microseconds(self):
+        selector = self.selector()
+        selector.select()
+        started = time.perf_counter()
+        for _ in range(10000):
+            selector.select(max_latency=5, max_cost=1, min_context=1000)
+        self.assertLess((time.perf_counter() - started) / 10000, 100e-6)
+
+
+@override_settings(
+    COMPLETION_PROVIDERS={'fake': {'BACKEND': 'core.providers.fake.FakeProvider', 'OPTIONS': {'tokens': 3}}},
+    MODEL_SELECTOR={'CANDIDATES': ['fake/fake-lorem', 'fake/fake-echo'], 'EXPLORE_RATE': 0},
+)
+class AutoCompletionViewTests(TransactionTestCase):
+    def setUp(self):
+        providers.reset()
+        model_selector.reset()
+        self.addCleanup(providers.reset)
+        self.addCleanup(model_selector.reset)
+
+    def test_auto_routes_to_a_selected_model_and_learns_from_it(self):
+        model_selector.add('fake/fake-lorem', time_to_first_token=2.0)
+        response = self.client.post('/api/providers/auto/models/auto/complete', {'message': 'hello'},
+                                    content_type='application/json')
+        self.assertEqual(response['X-Model'], 'fake/fake-echo')
+        events = read_events(response)
+        self.assertEqual(events[-1]['message']['content'], 'hello')
+        chatroom = ChatRoom.objects.get()
+        self.assertEqual((chatroom.provider, chatroom.model_id), ('fake', 'fake-echo'))
+        self.assertEqual(model_selector.stats()['fake/fake-echo']['samples'], 1)
+
+        response = self.client.post('/api/providers/fake/models/auto/complete',
+                                    {'message': 'hello', 'max_latency': 0}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        response = self.client.post('/api/providers/nope/models/auto/complete', {'message': 'hello'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(STREAM_BUFFERS={**DEFAULT_STREAM_BUFFER_OPTIONS, 'DISCONNECT_GRACE': 0})
+class StreamCancellationTests(TransactionTestCase):
+    url = '/api/providers/openai/models/gpt-4o/complete'
+
+    def setUp(self):
+        provider_clients.reset()
+        completion_streams.reset()
+        self.addCleanup(provider_clients.reset)
+        self.addCleanup(completion_streams.reset)
+
+    def until(self, condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'Timed out')
+            time.sleep(0.01)
+
+    def assert_aborted(self):
+        self.until(lambda: Message.objects.filter(role='assistant', status=Message.ABORTED).exists())
+        partial = Message.objects.get(role='assistant')
+        self.assertTrue(partial.content.startswith('tok'))
+        self.assertLess(len(partial.content), len('tok ' * 1000))
+
+    def test_closing_the_response_hangs_up_on_the_provider(self):
+        with StubProviderServer(tokens=1000, token_delay=0.005) as server, stub_env(server):
+            response = self.client.post(self.url, {'message': 'hi'}, content_type='application/json')
+            frames = iter(response.streaming_content)
+            next(frames), next(frames), next(frames)
+            self.assertEqual(server.open_connections, 1)
+            response.close()
+            self.until(lambda: server.open_connections == 0)
+        self.assert_aborted()
+        replay = read_events(self.client.get(f"/api/streams/{response['X-Stream-Id']}"))
+        self.assertEqual(replay[-1], {'type': 'cancelled'})
+
+    def test_cancel_endpoint(self):
+        with StubProviderServer(tokens=1000, token_delay=0.005) as server, stub_env(server):
+            response = self.client.post(self.url, {'message': 'hi'}, content_type='application/json')
+            stream_id = response['X-Stream-Id']
+            frames = iter(response.streaming_content)
+            next(frames), next(frames)
+            cancel = self.client.post(f'/api/streams/{stream_id}/cancel')
+            self.assertEqual(cancel.status_code, 202)
+            # The open response ends too
+            self.assertEqual(parse_events(b''.join(frames))[-1], {'type': 'cancelled'})
+            self.until(lambda: server.open_connections == 0)
+        self.assert_aborted()
+        self.assertEqual(self.client.post(f'/api/streams/{stream_id}/cancel').status_code, 409)
+        self.assertEqual(self.client.post('/api/streams/nope/cancel').status_code, 404)
+
+    async def test_cancelled_pump_ends_cancelled(self):
+        streams = CompletionStreams()
+
+        async def frames():
+            yield b'data: {"type": "chunk"}\n\n'
+            await asyncio.Event().wait()
+
+        stream_id = streams.start(frames())
+        task, = streams._tasks
+        await asyncio.sleep(0)
+        self.assertTrue(streams.cancel(stream_id))
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        events = parse_events(b''.join([frame async for frame in streams.read(stream_id)]))
+        self.assertEqual(events[-1], {'type': 'cancelled'})
+
+    async def test_asgi_disconnect_hangs_up_on_the_provider(self):
+        from config.asgi import application
+
+        async with StubProviderServer(tokens=1000, token_delay=0.005) as server:
+            with stub_env(server):
+                disconnect = asyncio.get_running_loop().create_future()
+                chunks = []
+
+                def on_body(chunk):
+                    chunks.append(chunk)
+                    if len(chunks) == 3 and not disconnect.done():
+                        disconnect.set_result(None)
+
+                await asyncio.wait_for(asgi_request(
+                    application, 'POST', f'{self.url}/async', {'message': 'hi'},
+                    on_body=on_body, disconnect=disconnect,
+                ), timeout=2)
+                deadline = time.monotonic() + 2
+                while server.open_connections:
+                    self.assertLess(time.monotonic(), deadline, 'Timed out')
+                    await asyncio.sleep(0.01)
+        await sync_to_async(self.assert_aborted)()
+
+
+class ContextBuilderTests(TestCase):
+    options = {'MAX_HISTORY_TOKENS': 400, 'FETCH_BATCH_SIZE': 10, 'SUMMARIZE': True,
+               'SUMMARY_MIN_TOKENS': 100, 'SUMMARY_MAX_TOKENS': 200, 'STABLE_PREFIX': True, 'TRIM_TO': 0.5}
+
+    def setUp(self):
+        self.adapter = FakeProvider('fake', tokens=3)
+        self.chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+        self.builder = ContextBuilder(self.options)
+
+    def build(self, system_prompt=''):
+        return async_to_sync(self.builder.build)(self.adapter, 'fake-echo', self.chatroom, system_prompt)
+
+    def test_short_chats_are_sent_whole(self):
+        seed_messages(self.chatroom, 5)
+        context = self.build()
+        self.assertFalse(context.truncated)
+        self.assertEqual([msg['content'] for msg in context.history],
+                         [f'benchmark message {index}' for index in range(5)])
+
+    def test_long_chats_keep_the_newest_turns_within_budget(self):
+        seed_messages(self.chatroom, 500, content='word ' * 20)
+        context = self.build(system_prompt='be brief')
+        self.assertTrue(context.truncated)
+        self.assertLessEqual(context.tokens, self.builder.budget(self.adapter, 'fake-echo', 'be brief'))
+        self.assertEqual(context.history[0]['role'], 'user')
+        self.assertTrue(context.history[-1]['content'].endswith(' 499'))
+
+    def test_window_start_stays_put_until_the_history_outgrows_it(self):
+        seed_messages(self.chatroom, 100, content='word ' * 20)
+        budget = self.builder.budget(self.adapter, 'fake-echo')
+        context = self.build()
+        self.assertLessEqual(context.tokens, budget / 2)
+        self.assertEqual(ChatRoom.objects.get(id=self.chatroom.id).context_start, context.oldest_included_at)
+
+        # Later turns extend the same prefix until it no longer fits
+        turns, history = 0, context.history
+        while True:
+            Message.objects.create(chatroom=self.chatroom, role=('user', 'assistant')[turns % 2], content='word ' * 20)
+            context = self.build()
+            if context.history[:len(history)] != history:
+                break
+            turns, history = turns + 1, context.history
+        self.assertGreater(turns, 3)
+        self.assertLessEqual(context.tokens, budget / 2)
+        self.assertEqual(context.history[0]['role'], 'user')
+
+    @override_settings(CONTEXT_BUILDER={'FETCH_BATCH_SIZE': 7})
+    def test_partial_options_fall_back_to_settings_and_defaults(self):
+        builder = ContextBuilder({'MAX_HISTORY_TOKENS': 400})
+        self.assertEqual(builder.options, {**DEFAULT_CONTEXT_OPTIONS, 'FETCH_BATCH_SIZE': 7, 'MAX_HISTORY_TOKENS': 400})
+        seed_messages(self.chatroom, 5)
+        context = async_to_sync(builder.build)(self.adapter, 'fake-echo', self.chatroom)
+        self.assertEqual(len(context.history), 5)
+
+    def test_missing_token_counts_are_backfilled(self):
+        seed_messages(self.chatroom, 3, token_counts=False)
+        self.build()
+        self.assertFalse(self.chatroom.messages.filter(token_count__isnull=True).exists())
+
+    def test_summary_replaces_dropped_turns(self):
+        seed_messages(self.chatroom, 500, content='word ' * 20)
+        context = self.build(system_prompt='be brief')
+        self.assertTrue(async_to_sync(self.builder.needs_summary)(self.chatroom, context))
+
+        with mock.patch.object(scheduler, 'ticket', wraps=scheduler.ticket) as ticket:
+            async_to_sync(self.builder.summarize)(self.adapter, 'fake-lorem', self.chatroom, context.oldest_included_at)
+        self.assertEqual(ticket.call_args.args[:2], ('fake', 'fake-lorem'))
+        # The summary call is provider spend of the chatroom
+        usage = ChatRoomUsage.objects.get(chatroom=self.chatroom)
+        self.assertEqual((usage.model_id, usage.requests), ('fake-lorem', 1))
+        self.assertGreater(usage.output_tokens, 0)
+        self.chatroom.refresh_from_db()
+        self.assertEqual(self.chatroom.summary_until, context.oldest_included_at)
+        self.assertEqual(self.chatroom.summary, 'lorem lorem lorem')
+
+        context = self.build(system_prompt='be brief')
+        self.assertFalse(async_to_sync(self.builder.needs_summary)(self.chatroom, context))
+        self.assertTrue(context.system_prompt.startswith('be brief\n\nSummary of the earlier conversation:\n'))
+
+
+class ProviderUsageTests(SimpleTestCase):
+    async def stream(self, adapter, server):
+        with stub_env(server):
+            provider_clients.reset()
+            try:
+                return [chunk async for chunk in adapter.stream('stub-model', [{'role': 'user', 'content': 'x' * 40}])]
+            finally:
+                provider_clients.reset()
+
+    async def test_openai_usage_comes_from_the_final_chunk(self):
+        async with StubProviderServer(tokens=4) as server:
+            chunks = await self.stream(OpenAIProvider('openai'), server)
+        self.assertTrue(server.request_bodies[-1]['stream_options']['include_usage'])
+        self.assertEqual(''.join(chunk.content for chunk in chunks), 'tok ' * 4)
+        self.assertEqual((chunks[-1].input_tokens, chunks[-1].output_tokens), (10, 4))
+
+    async def test_anthropic_usage_comes_from_message_events(self):
+        async with StubProviderServer(tokens=4) as server:
+            chunks = await self.stream(AnthropicProvider('anthropic'), server)
+        usage = [(chunk.input_tokens, chunk.output_tokens) for chunk in chunks if not chunk.content]
+        self.assertEqual(usage, [(10, 1), (None, 4)])
+
+
+class PromptCacheTests(TransactionTestCase):
+    def setUp(self):
+        provider_clients.reset()
+        self.addCleanup(provider_clients.reset)
+
+    async def turn(self, adapter, chatroom, prompt):
+        await message_writer.aadd(Message(chatroom=chatroom, role='user', content=prompt))
+        async for _ in stream_completion(adapter, chatroom.model_id, chatroom, 'be helpful ' * 100, use_cache=False):
+            pass
+        return await Message.objects.filter(chatroom=chatroom, role='assistant').order_by('-created_at').afirst()
+
+    async def test_anthropic_turns_read_the_prefix_the_previous_turn_wrote(self):
+        async with StubProviderServer(tokens=3) as server:
+            with stub_env(server):
+                adapter = AnthropicProvider('anthropic')
+                chatroom = await ChatRoom.objects.acreate(title='t', provider='anthropic', model_id='claude-3-5-sonnet')
+                first = await self.turn(adapter, chatroom, 'first question ' * 50)
+                second = await self.turn(adapter, chatroom, 'second question ' * 50)
+
+        body = server.request_bodies[-1]
+        self.assertEqual(body['system'][0]['cache_control'], {'type': 'ephemeral'})
+        self.assertEqual([isinstance(message['content'], list) for message in body['messages']], [True, False, True])
+        self.assertEqual((first.cache_read_tokens, second.cache_read_tokens), (0, first.cache_write_tokens))
+        self.assertGreater(second.cache_write_tokens, 0)
+        # input_tokens counts the whole prompt, every part of which was either read or written
+        self.assertEqual(second.input_tokens, second.cache_read_tokens + second.cache_write_tokens)
+
+    async def test_openai_reports_the_cached_prefix(self):
+        async with StubProviderServer(tokens=3) as server:
+            with stub_env(server):
+                adapter = OpenAIProvider('openai')
+                chatroom = await ChatRoom.objects.acreate(title='t', provider='openai', model_id='gpt-4o')
+                first = await self.turn(adapter, chatroom, 'first question ' * 50)
+                second = await self.turn(adapter, chatroom, 'second question ' * 50)
+        self.assertEqual(first.cache_read_tokens, 0)
+        self.assertGreater(second.cache_read_tokens, 0)
+        self.assertIsNone(second.cache_write_tokens)
+
+
+class UsageTests(TestCase):
+    def setUp(self):
+        self.chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+
+    def test_record_usage_increments_rollups(self):
+        record_usage(self.chatroom.id, 'openai', 'gpt-4o', 10, 5, day=date(2026, 1, 1))
+        record_usage(self.chatroom.id, 'openai', 'gpt-4o', 20, None, day=date(2026, 1, 1))
+        record_usage(self.chatroom.id, 'openai', 'gpt-4o', 1, 1, day=date(2026, 1, 2))
+
+        daily = DailyModelUsage.objects.get(day=date(2026, 1, 1))
+        self.assertEqual((daily.requests, daily.input_tokens, daily.output_tokens), (2, 30, 5))
+        usage = ChatRoomUsage.objects.get(chatroom=self.chatroom)
+        self.assertEqual((usage.requests, usage.input_tokens, usage.output_tokens), (3, 31, 6))
+
+    def test_usage_endpoints(self):
+        other = ChatRoom.objects.create(title='o', provider='openai', model_id='gpt-4o')
+        record_usage(self.chatroom.id, 'openai', 'gpt-4o', 10, 5, day=date(2026, 1, 1))
+        record_usage(other.id, 'openai', 'gpt-4o', 10, 5, day=date(2026, 1, 2))
+        record_usage(other.id, 'anthropic', 'claude', 7, 3, day=date(2026, 1, 2))
+
+        models = self.client.get('/api/usage/models', {'since': '2026-01-01'}).json()
+        self.assertEqual(models, [
+            {'provider': 'anthropic', 'model_id': 'claude', 'requests': 1, 'input_tokens': 7, 'output_tokens': 3},
+            {'provider': 'openai', 'model_id': 'gpt-4o', 'requests': 2, 'input_tokens': 20, 'output_tokens': 10},
+        ])
+        daily = self.client.get('/api/usage/daily', {'until': '2026-01-01'}).json()
+        self.assertEqual([(row['day'], row['requests']) for row in daily], [('2026-01-01', 1)])
+        self.assertEqual(self.client.get('/api/usage/daily', {'since': 'nope'}).status_code, 400)
+
+        rooms = self.client.get(f'/api/chatrooms/{other.id}/usage').json()
+        self.assertEqual([(row['provider'], row['input_tokens']) for row in rooms], [('anthropic', 7), ('openai', 10)])
+
+    # The writer thread cannot see into the transaction TestCase wraps the test in
+    @mock.patch.object(message_writer, '_options', {**DEFAULT_WRITE_BEHIND_OPTIONS, 'ENABLED': False})
+    def test_completion_records_provider_usage(self):
+        async_to_sync(self.drain)(stream_completion(FakeProvider('fake'), 'fake-echo', self.chatroom, ''))
+        Message.objects.create(chatroom=self.chatroom, role='user', content='one two three')
+        async_to_sync(self.drain)(stream_completion(FakeProvider('fake'), 'fake-echo', self.chatroom, ''))
+
+        *history, reply = self.chatroom.messages.all()
+        self.assertEqual(reply.output_tokens, 3)
+        self.assertEqual(reply.input_tokens, sum(msg.token_count for msg in history))
+        usage = ChatRoomUsage.objects.get(chatroom=self.chatroom)
+        self.assertEqual((usage.requests, usage.output_tokens), (2, 20 + 3))
+
+    async def drain(self, stream):
+        return [frame async for frame in stream]
+
+
+@skipUnless(connection.vendor == 'sqlite' and settings.DATABASES['default'].get('OPTIONS'), 'tuned SQLite only')
+class SQLiteSettingsTests(TestCase):
+    def test_connections_are_tuned(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        self.chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+        self.url = f'/api/chatrooms/{self.chatroom.id}/messages'
+
+    def contents(self, page):
+        return [int(msg['content'].rsplit(' ', 1)[1]) for msg in page['results']]
+
+    def test_messages_page_backwards_and_poll_forwards(self):
+        seed_messages(self.chatroom, 25)
+        page = self.client.get(self.url, {'limit': 10}).json()
+        self.assertEqual(self.contents(page), list(range(15, 25)))
+
+        older = self.client.get(page['previous']).json()
+        self.assertEqual(self.contents(older), list(range(5, 15)))
+        oldest = self.client.get(older['previous']).json()
+        self.assertEqual(self.contents(oldest), list(range(5)))
+        self.assertIsNone(oldest['previous'])
+
+        poll = self.client.get(page['next']).json()
+        self.assertEqual(poll['results'], [])
+        self.assertEqual(poll['next'], page['next'])
+        Message.objects.create(chatroom=self.chatroom, role='user', content='new 25')
+        self.assertEqual(self.contents(self.client.get(poll['next']).json()), [25])
+
+    def test_ties_on_created_at_are_not_skipped(self):
+        seed_messages(self.chatroom, 7)
+        self.chatroom.messages.update(created_at=self.chatroom.messages.first().created_at)
+        seen, url = [], f'{self.url}?limit=3'
+        while url:
+            page = self.client.get(url).json()
+            seen += [msg['id'] for msg in page['results']]
+            url = page['previous']
+        self.assertCountEqual(seen, [str(pk) for pk in self.chatroom.messages.values_list('id', flat=True)])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'nope'}).status_code, 404)
+        self.assertEqual(self.client.get('/api/chatrooms', {'cursor': 'bm9wZQ=='}).status_code, 404)
+
+    def test_chatrooms_are_listed_newest_first(self):
+        for index in range(5):
+            ChatRoom.objects.create(title=f'room {index}', provider='fake', model_id='fake-echo')
+        page = self.client.get('/api/chatrooms', {'limit': 4}).json()
+        rest = self.client.get(page['next']).json()
+        titles = [room['title'] for room in page['results'] + rest['results']]
+        self.assertEqual(titles, ['room 4', 'room 3', 'room 2', 'room 1', 'room 0', 't'])
+        self.assertIsNone(rest['next'])
+
+
+class FastJSONTests(TestCase):
+    def setUp(self):
+        self.chatroom = ChatRoom.objects.create(title='t', provider='fake', model_id='fake-echo')
+        seed_messages(self.chatroom, 3)
+        Message.objects.create(chatroom=self.chatroom, role='assistant', content='line\u2028break é',
+                               input_tokens=12, output_tokens=3, cache_read_tokens=8, cache_write_tokens=0)
+
+    def test_messages_match_the_model_serializer(self):
+        url = f'/api/chatrooms/{self.chatroom.id}/messages'
+        for zone in ('UTC', 'America/New_York'):
+            with timezone.override(zone):
+                expected = JSONRenderer().render(MessageSerializer(self.chatroom.messages.all(), many=True).data)
+                response = self.client.get(url)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            results = response.content[response.content.index(b'"results":') + len(b'"results":'):-1]
+            self.assertEqual(results, expected)
+
+    def test_renderer_matches_drf(self):
+        data = {
+            'id': uuid.uuid4(), 'at': timezone.now(), 'price': Decimal('1.50'), 'text': 'a\u2029b ü',
+            'nested': [{'day': date(2024, 1, 2), 1: None}], 'lazy': gettext_lazy('Provider'),
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        # Integers orjson can not encode and missing orjson fall back to DRF
+        self.assertEqual(ORJSONRenderer().render({'big': 2 ** 70}), b'{"big":1180591620717411303424}')
+        with mock.patch('core.renderers._orjson', return_value=None):
+            self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_parser(self):
+        response = self.client.post('/api/chatrooms', '{"title": "é", "provider": "fake", "model_id": "x"}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['title'], 'é')
+        response = self.client.post('/api/chatrooms', '{"title": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.json()['detail'])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.chatroom = ChatRoom.objects.create(title='Kubernetes deploys', provider='fake', model_id='fake-echo')
+        self.other = ChatRoom.objects.create(title='Sourdough', provider='fake', model_id='fake-echo')
+
+    def message(self, content, chatroom=None):
+        return Message.objects.create(chatroom=chatroom or self.chatroom, role='user', content=content)
+
+    def search(self, q, **params):
+        response = self.client.get('/api/search', {'q': q, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_parse_query(self):
+        self.assertEqual(parse_query('deploy "blue green" or canary -staging'),
+                         ([['deploy'], ['blue green', 'canary']], ['staging']))
+        with self.assertRaises(ValueError):
+            parse_query('-staging')
+
+    def test_messages_are_ranked_with_snippets(self):
+        once = self.message('the deploy <script> failed on monday, rolling back')
+        twice = self.message('deploy again: this deploy went fine')
+        self.message('starter needs feeding', chatroom=self.other)
+        results = self.search('deploy')['results']
+        self.assertEqual([result['id'] for result in results], [str(twice.id), str(once.id)])
+        self.assertGreater(results[0]['score'], results[1]['score'])
+        self.assertEqual(results[0]['chatroom_title'], 'Kubernetes deploys')
+        self.assertIn('the <mark>deploy</mark> &lt;script&gt;', results[1]['snippet'])
+        # Stemmed, quoted phrases, alternatives and exclusions
+        self.assertEqual(len(self.search('deploying')['results']), 2)
+        self.assertEqual(len(self.search('"rolling back"')['results']), 1)
+        self.assertEqual(len(self.search('monday or feeding')['results']), 2)
+        self.assertEqual(len(self.search('deploy -monday')['results']), 1)
+        self.assertEqual(len(self.search('deploy', chatroom_id=self.other.id)['results']), 0)
+        self.assertEqual(self.client.get('/api/search', {'q': '-deploy'}).status_code, 400)
+
+    def test_index_follows_writes(self):
+        message = self.message('first draft')
+        seed_messages(self.chatroom, 3, content='bulk draft')
+        self.assertEqual(len(self.search('draft')['results']), 4)
+        Message.objects.filter(id=message.id).update(content='final version')
+        self.assertEqual(len(self.search('draft')['results']), 3)
+        self.assertEqual(len(self.search('final')['results']), 1)
+        self.chatroom.delete()
+        self.assertEqual(self.search('draft')['results'], [])
+
+    @override_settings(SEARCH={'RANK_WINDOW': 7})
+    def test_pages_cover_the_newest_matches(self):
+        seed_messages(self.chatroom, 10, content='note')
+        seen, url = [], '/api/search?q=note&limit=3'
+        while url:
+            page = self.client.get(url).json()
+            seen += [int(re.sub(r'<[^>]+>', '', result['snippet']).split()[1]) for result in page['results']]
+            url = page['next']
+        # Only the 7 newest are ranked, each exactly once
+        self.assertCountEqual(seen, range(3, 10))
+        self.assertEqual(self.client.get('/api/search', {'q': 'note', 'cursor': 'bm9wZQ=='}).status_code, 404)
+
+    def test_chatroom_titles(self):
+        results = self.search('sourdough', type='chatrooms')['results']
+        self.assertEqual([result['id'] for result in results], [str(self.other.id)])
+        self.assertEqual(results[0]['snippet'], '<mark>Sourdough</mark>')
+        self.other.title = 'Rye'
+        self.other.save()
+        self.assertEqual(self.search('sourdough', type='chatrooms')['results'], [])
+
+
+class BatchJobTests(TransactionTestCase):
+    def setUp(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        settings_override = override_settings(BATCHES={'OUTPUT_DIR': output_dir, 'POLL_INTERVAL': 0.01})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        batch_runner.reset()
+        self.addCleanup(batch_runner.reset)
+        self.addCleanup(providers.reset)
+
+    def upload(self, lines, **params):
+        content = '\n'.join(map(json.dumps, lines)).encode()
+        return self.client.post('/api/batches', {
+            'file': SimpleUploadedFile('prompts.jsonl', content), 'model_id': 'fake-echo', 'provider': 'fake', **params,
+        })
+
+    def output(self, job_id):
+        response = self.client.get(f'/api/batches/{job_id}/output')
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_parse_items(self):
+        items = parse_items([
+            b'{"request_id": "user-001", "title": "Speed up search", "body": "It is slow"}\n',
+            b'\n',
+            b'{"prompt": "hi", "system_prompt": "Be brief"}\n',
+        ])
+        self.assertEqual([(item.index, item.custom_id) for item in items], [(0, 'user-001'), (1, '1')])
+        self.assertEqual(items[0].prompt, 'Speed up search\n\nIt is slow')
+        self.assertEqual(items[1].system_prompt, 'Be brief')
+        for lines, error in ([b'{"prompt": "a"}', b'nope'], 'Line 2'), ([b'[1]'], 'Line 1'), ([b''], 'No prompts'):
+            with self.assertRaisesRegex(InvalidBatch, error):
+                parse_items(lines)
+        with self.assertRaisesRegex(InvalidBatch, 'duplicate'):
+            parse_items([b'{"id": 1, "prompt": "a"}', b'{"id": 1, "prompt": "b"}'])
+
+    def test_job_runs_the_uploaded_prompts(self):
+        response = self.upload([{'custom_id': f'p{n}', 'prompt': f'prompt {n}'} for n in range(5)], concurrency=2)
+        self.assertEqual(response.status_code, 201, response.content)
+        job_id = response.json()['id']
+        batch_runner.wait(job_id, timeout=10)
+
+        job = self.client.get(f'/api/batches/{job_id}').json()
+        self.assertEqual((job['status'], job['completed_items'], job['failed_items']), ('completed', 5, 0))
+        self.assertEqual(job['progress'], 1.0)
+        lines = self.output(job_id)
+        self.assertCountEqual([(line['custom_id'], line['content']) for line in lines],
+                              [(f'p{n}', f'prompt {n}') for n in range(5)])
+        self.assertEqual(job['output_tokens'], 10)
+        # Usage counts per day, there is no chatroom
+        self.assertEqual(DailyModelUsage.objects.get(model_id='fake-echo').requests, 5)
+        self.assertFalse(ChatRoom.objects.exists())
+
+        self.assertEqual(self.upload([{'title': 'no body'}]).status_code, 400)
+        self.assertEqual(self.upload([{'prompt': 'a'}], provider='nope').status_code, 404)
+
+    def test_interrupted_job_resumes_from_checkpoints(self):
+        job = batch_runner.create([json.dumps({'prompt': f'prompt {n}'}) for n in range(4)], 'fake', 'fake-echo')
+        # A worker finished the first item, wrote it out and died
+        item = job.items.get(index=0)
+        item.status, item.content, item.finished_at = BatchItem.COMPLETE, 'from before', timezone.now()
+        item.save()
+        with open(batch_runner.output_path(job.id), 'w') as output:
+            output.write('{"custom_id": "0", "status": "complete", "content": "from before"}\n{"truncated\n')
+        BatchJob.objects.filter(id=job.id).update(
+            status=BatchJob.RUNNING, completed_items=1, heartbeat_at=timezone.now(),
+        )
+        self.assertEqual(self.client.post(f'/api/batches/{job.id}/resume').status_code, 409)
+
+        BatchJob.objects.filter(id=job.id).update(heartbeat_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(self.client.post(f'/api/batches/{job.id}/resume').status_code, 202)
+        batch_runner.wait(job.id, timeout=10)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.completed_items), (BatchJob.COMPLETED, 4))
+        lines = self.output(job.id)
+        self.assertEqual([line['custom_id'] for line in lines][:1], ['0'])
+        self.assertEqual(sorted(line['content'] for line in lines),
+                         ['from before', 'prompt 1', 'prompt 2', 'prompt 3'])
+
+    def test_provider_batch_api(self):
+        with StubProviderServer(tokens=2) as server, stub_env(server):
+            provider_clients.reset()
+            self.addCleanup(provider_clients.reset)
+            for provider in ('openai', 'anthropic'):
+                server.fail(status=500)
+                job = batch_runner.create([b'{"prompt": "a"}', b'{"prompt": "b"}'], provider, 'stub-model',
+                                          mode=BatchJob.PROVIDER)
+                batch_runner.start(job.id).result(timeout=10)
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.completed_items, job.failed_items), (BatchJob.COMPLETED, 1, 1))
+                self.assertTrue(job.provider_batch_id)
+                self.assertEqual(list(job.items.values_list('status', 'content', 'error')), [
+                    (BatchItem.FAILED, '', 'Injected 500'), (BatchItem.COMPLETE, 'tok tok ', ''),
+                ])
+
+                # Failed items go into a new provider batch
+                self.assertTrue(batch_runner.resume(job.id, retry_failed=True))
+                batch_runner.wait(job.id, timeout=10)
+                job.refresh_from_db()
+                self.assertEqual((job.completed_items, job.failed_items), (2, 0))
+            # Submitted as batches, nothing was streamed
+            self.assertFalse(any(body.get('stream') for body in server.request_bodies))
@@ -0,0 +1,34 @@
+"""
+Token counting for context budgeting.
+
+Counts only need to be good enough to keep a request under a model's context window,
+so the default is a fast characters-per-token estimate. When ``tiktoken`` is installed
+its ``cl100k_base`` encoding is used instead.
+"""
+import functools
+import importlib.util
+
+# Rough framing cost of one chat message (role, separators)
+MESSAGE_OVERHEAD = 4
+CHARS_PER_TOKEN = 4
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    if importlib.util.find_spec('tiktoken') is None:
+        return None
+    import tiktoken
+    return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(content):
+    return count_tokens(content) + MESSAGE_OVERHEAD
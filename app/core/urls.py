@@ -6,10 +6,25 @@ from . import views
 # Create a router and register the viewset
 router = DefaultRouter(trailing_slash=False)
 router.register(r'api/chatrooms', views.ChatRoomViewSet)
+router.register(r'api/batches', views.BatchJobViewSet)
+router.register(r'api/comparisons', views.ComparisonViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('api/usage/daily', views.DailyUsageView.as_view(), name='usage-daily'),
+    path('api/usage/models', views.ModelUsageView.as_view(), name='usage-models'),
+    path('api/search', views.SearchView.as_view(), name='search'),
     path('api/providers', views.ProviderListView.as_view(), name='provider-list'),
+    path('api/providers/clients/stats', views.ProviderClientStatsView.as_view(), name='provider-client-stats'),
+    path('api/providers/auto/stats', views.ModelSelectorStatsView.as_view(), name='model-selector-stats'),
     path('api/providers/<str:provider_name>/models', views.ModelListView.as_view(), name='model-list'),
     path('api/providers/<str:provider_name>/models/<str:model_id>/complete', views.CompletionView.as_view(), name='completion'),
+    path('api/providers/<str:provider_name>/models/<str:model_id>/complete/async', views.AsyncCompletionView.as_view(), name='completion-async'),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
+    path('api/compare', views.CompareView.as_view(), name='compare'),
+    path('api/compare/async', views.AsyncCompareView.as_view(), name='compare-async'),
+    path('api/completions/cache/stats', views.ResponseCacheStatsView.as_view(), name='response-cache-stats'),
+    path('api/streams/<str:stream_id>', views.StreamView.as_view(), name='stream'),
+    path('api/streams/<str:stream_id>/async', views.AsyncStreamView.as_view(), name='stream-async'),
+    path('api/streams/<str:stream_id>/cancel', views.StreamCancelView.as_view(), name='stream-cancel'),
 ]
\ No newline at end of file
@@ -0,0 +1,45 @@
+"""
+Token usage rollups.
+
+Every finished completion adds its token counts to one DailyModelUsage row and one
+ChatRoomUsage row, so the usage endpoints read a handful of pre-aggregated rows instead
+of scanning Message. Batch job items (core.batches) have no chatroom and only count per
+day. Increments use F-expressions, so concurrent writers never lose an update.
+"""
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ChatRoomUsage, DailyModelUsage
+
+
+def _increment(model, keys, input_tokens, output_tokens):
+    increments = {
+        'requests': F('requests') + 1,
+        'input_tokens': F('input_tokens') + input_tokens,
+        'output_tokens': F('output_tokens') + output_tokens,
+    }
+    if model.objects.filter(**keys).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, requests=1, input_tokens=input_tokens, output_tokens=output_tokens)
+    except IntegrityError:
+        # Another request created the row first
+        model.objects.filter(**keys).update(**increments)
+
+
+def record_usage(chatroom_id, provider, model_id, input_tokens, output_tokens, day=None):
+    input_tokens = input_tokens or 0
+    output_tokens = output_tokens or 0
+    day = day or timezone.now().date()
+    with transaction.atomic():
+        _increment(DailyModelUsage, {'day': day, 'provider': provider, 'model_id': model_id},
+                   input_tokens, output_tokens)
+        if chatroom_id is not None:
+            _increment(ChatRoomUsage, {'chatroom_id': chatroom_id, 'provider': provider, 'model_id': model_id},
+                       input_tokens, output_tokens)
+
+
+arecord_usage = sync_to_async(record_usage)
@@ -1,102 +1,396 @@
-from rest_framework import viewsets, status
+from rest_framework import mixins, viewsets, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from drf_spectacular.utils import extend_schema
-from .serializers import ChatRoomSerializer, MessageSerializer, CompletionSerializer
-from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ParseError
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+from .serializers import (
+    ChatRoomSerializer, MessageSerializer, CompletionSerializer, ChatRoomUsageSerializer,
+    DailyModelUsageSerializer, ModelUsageSerializer, UsageQuerySerializer, SearchQuerySerializer,
+    MessageSearchResultSerializer, ChatRoomSearchResultSerializer, BatchJobSerializer, BatchJobCreateSerializer,
+    CompareSerializer, ComparisonSerializer, ModelLatencySerializer,
+)
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, JsonResponse
 from rest_framework.decorators import action
 from django.core.exceptions import ValidationError
-from .models import ChatRoom, Message
-from openai import OpenAI
-from anthropic import Anthropic
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.db.models import Avg, Count, Sum
+from asgiref.sync import sync_to_async
+from .models import BatchJob, ChatRoom, Comparison, ComparisonTarget, DailyModelUsage, Message
+from .background import background_loop
+from .batches import InvalidBatch, batch_runner
+from .catalog import model_catalog
+from .clients import provider_clients
+from .completions import stream_completion
+from .fanout import create_comparison, parse_targets, stream_comparison
+from .metrics import Timeline, metrics
+from .pagination import (
+    BatchJobPagination, ComparisonPagination, KeysetPagination, MessagePagination, SearchPagination,
+)
+from .persistence import message_writer
+from .providers import ProviderNotFound, providers
+from .renderers import FastJSONMixin
+from .responses import response_cache
+from .search import InvalidQuery, Search
+from .selector import NoEligibleModel, model_selector
+from .streams import completion_streams
 
 import json
 import os
+import time
 
-class ChatRoomViewSet(viewsets.ModelViewSet):
+def event_stream_response(stream_id, frames):
+    response = StreamingHttpResponse(frames, content_type='text/event-stream')
+    response['X-Stream-Id'] = stream_id
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+class ChatRoomViewSet(FastJSONMixin, viewsets.ModelViewSet):
+    """
+    Chatrooms are listed most recently updated first, paginated with a keyset cursor on
+    (updated_at, id); see core.pagination. Each carries its message count, last message
+    and token totals (core.counters). ``?fields=id,title,...`` returns only those fields,
+    and the list then only reads those columns. JSON is rendered with orjson, and messages
+    are listed straight from ``.values()`` rows (core.renderers).
+    """
     queryset = ChatRoom.objects.all()
     serializer_class = ChatRoomSerializer
+    pagination_class = KeysetPagination
 
-    @action(detail=True, methods=['get'])
+    def sparse_fields(self):
+        """The fields asked for with ``?fields=``, on reads only"""
+        if self.request is None or self.request.method not in ('GET', 'HEAD'):
+            return None
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return None
+        fields = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = set(fields) - set(ChatRoomSerializer.Meta.fields)
+        if unknown:
+            raise ParseError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        return fields
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != 'list':
+            return queryset
+        fields = self.sparse_fields()
+        if fields is None:
+            # The rolling summary can be long and is never listed
+            return queryset.defer('summary')
+        # The keyset cursor needs the ordering columns
+        return queryset.only(*fields, 'id', 'updated_at')
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.sparse_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    @extend_schema(parameters=[
+        OpenApiParameter('fields', str, description='Comma separated fields to return, all by default'),
+    ])
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @extend_schema(parameters=[
+        OpenApiParameter('fields', str, description='Comma separated fields to return, all by default'),
+    ])
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('limit', int, description='Page size'),
+            OpenApiParameter('before', str, description='Cursor, returns the messages before it'),
+            OpenApiParameter('since', str, description='Cursor, returns the messages after it'),
+        ],
+        responses={200: MessageSerializer(many=True)}
+    )
+    @action(detail=True, methods=['get'], pagination_class=MessagePagination)
     def messages(self, request, pk=None):
+        """Newest page of the chat by default, see MessagePagination for the cursors"""
+        chatroom = self.get_object()
+        # Read your writes: messages still queued for this chatroom are written first
+        message_writer.flush(chatroom.id)
+        page = self.paginate_queryset(MessageSerializer.values(chatroom.messages.all()))
+        return self.get_paginated_response(MessageSerializer.from_values(page))
+
+    @extend_schema(responses={200: ChatRoomUsageSerializer(many=True)})
+    @action(detail=True, methods=['get'])
+    def usage(self, request, pk=None):
+        """Token usage of this chatroom per model"""
+        chatroom = self.get_object()
+        serializer = ChatRoomUsageSerializer(chatroom.usage.all(), many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+class UsageQueryMixin:
+    """Filters DailyModelUsage rows by the since/until/provider/model_id query parameters"""
+    def usage_queryset(self, request):
+        query = UsageQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        filters = query.validated_data
+        queryset = DailyModelUsage.objects.all()
+        if 'since' in filters:
+            queryset = queryset.filter(day__gte=filters['since'])
+        if 'until' in filters:
+            queryset = queryset.filter(day__lte=filters['until'])
+        if 'provider' in filters:
+            queryset = queryset.filter(provider=filters['provider'].lower())
+        if 'model_id' in filters:
+            queryset = queryset.filter(model_id=filters['model_id'])
+        return queryset
+
+class DailyUsageView(UsageQueryMixin, APIView):
+    """Token usage per day and model"""
+    @extend_schema(parameters=[UsageQuerySerializer], responses={200: DailyModelUsageSerializer(many=True)})
+    def get(self, request):
+        serializer = DailyModelUsageSerializer(self.usage_queryset(request), many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+class ModelUsageView(UsageQueryMixin, APIView):
+    """Token usage per model, summed over the requested days"""
+    @extend_schema(parameters=[UsageQuerySerializer], responses={200: ModelUsageSerializer(many=True)})
+    def get(self, request):
+        totals = (
+            self.usage_queryset(request)
+            .values('provider', 'model_id')
+            .annotate(
+                requests=Sum('requests'),
+                input_tokens=Sum('input_tokens'),
+                output_tokens=Sum('output_tokens'),
+            )
+            .order_by('provider', 'model_id')
+        )
+        return Response(ModelUsageSerializer(totals, many=True).data, status=status.HTTP_200_OK)
+
+class SearchView(APIView):
+    """
+    Full-text search over message contents (type=messages) or chatroom titles
+    (type=chatrooms), best match first, with highlighted snippets. See core.search for
+    the query syntax.
+    """
+    result_serializers = {
+        'messages': MessageSearchResultSerializer,
+        'chatrooms': ChatRoomSearchResultSerializer,
+    }
+
+    @extend_schema(parameters=[SearchQuerySerializer], responses={200: MessageSearchResultSerializer(many=True)})
+    def get(self, request):
+        query = SearchQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
         try:
-            chatroom = self.get_object()
-            messages = chatroom.messages.all()
-            serializer = MessageSerializer(messages, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        except ChatRoom.DoesNotExist:
+            search = Search(params['q'], params['type'], params.get('chatroom_id'))
+        except InvalidQuery as e:
+            return Response({'q': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(search, request, view=self)
+        serializer = self.result_serializers[params['type']](page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+class BatchJobViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                      viewsets.GenericViewSet):
+    """
+    Batch completion jobs (core.batches). A job is created from a JSONL upload of prompts,
+    runs in the background and reports its progress here; the results are served as JSONL
+    from ``output`` while it runs.
+    """
+    queryset = BatchJob.objects.all()
+    serializer_class = BatchJobSerializer
+    pagination_class = BatchJobPagination
+
+    @extend_schema(request={'multipart/form-data': BatchJobCreateSerializer}, responses={201: BatchJobSerializer})
+    def create(self, request):
+        serializer = BatchJobCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        try:
+            providers.get(params['provider'])
+        except ProviderNotFound:
             return Response(
-                {'error': 'Chatroom not found'}, 
+                {'error': f"Provider not found: {params['provider']}"},
                 status=status.HTTP_404_NOT_FOUND
             )
+        try:
+            job = batch_runner.create(
+                params['file'], params['provider'], params['model_id'],
+                system_prompt=params['system_prompt'],
+                concurrency=params.get('concurrency'),
+                mode=params['mode'],
+            )
+        except InvalidBatch as e:
+            return Response({'file': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        batch_runner.start(job.id)
+        return Response(BatchJobSerializer(job).data, status=status.HTTP_201_CREATED)
+
+    @extend_schema(responses={(200, 'application/jsonl'): bytes})
+    @action(detail=True, methods=['get'])
+    def output(self, request, pk=None):
+        """One JSON line per finished item, in the order they finished"""
+        job = self.get_object()
+        path = batch_runner.output_path(job.id)
+        if not os.path.exists(path):
+            return Response({'error': 'No output yet'}, status=status.HTTP_404_NOT_FOUND)
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'{job.id}.jsonl',
+                            content_type='application/jsonl')
+
+    @extend_schema(request=None, responses={200: BatchJobSerializer})
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """Stops the job; items not run yet stay pending for a resume"""
+        job = self.get_object()
+        if not batch_runner.cancel(job.id):
+            return Response({'error': f'Job is {job.status}'}, status=status.HTTP_409_CONFLICT)
+        job.refresh_from_db()
+        return Response(BatchJobSerializer(job).data, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        request=None,
+        parameters=[OpenApiParameter('retry_failed', bool, description='Run the failed items again too')],
+        responses={202: BatchJobSerializer}
+    )
+    @action(detail=True, methods=['post'])
+    def resume(self, request, pk=None):
+        """Runs the pending items of an interrupted, failed or cancelled job"""
+        job = self.get_object()
+        retry_failed = request.query_params.get('retry_failed', '').lower() in ('1', 'true')
+        if not batch_runner.resume(job.id, retry_failed=retry_failed):
+            return Response({'error': 'Job is still running'}, status=status.HTTP_409_CONFLICT)
+        job.refresh_from_db()
+        return Response(BatchJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+class ComparisonViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Prompts sent to several models at once (core.fanout), with each model's chatroom and
+    timings. Start one with POST /api/compare.
+    """
+    queryset = Comparison.objects.prefetch_related('targets')
+    serializer_class = ComparisonSerializer
+    pagination_class = ComparisonPagination
+
+    @extend_schema(
+        parameters=[OpenApiParameter('since', OpenApiTypes.DATE, description='Only comparisons from this day on')],
+        responses={200: ModelLatencySerializer(many=True)}
+    )
+    @action(detail=False, methods=['get'], pagination_class=None)
+    def latency(self, request):
+        """Mean time to first token and total time per model over its completed comparisons, fastest first"""
+        targets = ComparisonTarget.objects.filter(status=ComparisonTarget.COMPLETE)
+        since = request.query_params.get('since')
+        if since:
+            query = UsageQuerySerializer(data={'since': since})
+            query.is_valid(raise_exception=True)
+            targets = targets.filter(comparison__created_at__date__gte=query.validated_data['since'])
+        latencies = (
+            targets
+            .values('provider', 'model_id')
+            .annotate(
+                comparisons=Count('id'),
+                time_to_first_token=Avg('time_to_first_token'),
+                total_time=Avg('total_time'),
+            )
+            .order_by('time_to_first_token', 'provider', 'model_id')
+        )
+        return Response(ModelLatencySerializer(latencies, many=True).data, status=status.HTTP_200_OK)
 
 class ProviderListView(APIView):
     def get(self, request):
-        providers = ['OpenAI', 'Anthropic']
-        return Response(providers, status=status.HTTP_200_OK)
+        names = [adapter.display_name for adapter in providers.listed()]
+        return Response(names, status=status.HTTP_200_OK)
+
+class ProviderClientStatsView(APIView):
+    """Connection pool utilization of the shared provider clients"""
+    def get(self, request):
+        return Response(provider_clients.stats(), status=status.HTTP_200_OK)
+
+class ResponseCacheStatsView(APIView):
+    """Hit/miss counters and size of the completion response cache"""
+    def get(self, request):
+        return Response(response_cache.stats(), status=status.HTTP_200_OK)
 
-class ModelListView(APIView):
+class ModelSelectorStatsView(APIView):
+    """Rolling latency, throughput and error stats the auto route selects models by"""
+    def get(self, request):
+        return Response(model_selector.stats(), status=status.HTTP_200_OK)
+
+class MetricsView(View):
+    """Completion pipeline latency histograms in the Prometheus text format"""
+    def get(self, request):
+        return HttpResponse(metrics.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class ModelListView(FastJSONMixin, APIView):
+    """
+    Lists a provider's models from the cached model catalog.
+
+    Responses carry an ETag and Cache-Control so browsers and proxies can revalidate
+    with If-None-Match and get a 304 instead of the full list.
+    """
     def get(self, request, provider_name):
         provider_name = provider_name.lower()
-        if provider_name == 'openai':
-            models = self.get_openai_models()
-        elif provider_name == 'anthropic':
-            models = self.get_anthropic_models()
-        else:
+        try:
+            entry = model_catalog.get(provider_name)
+        except ProviderNotFound:
             return Response(
                 {'error': 'Provider not found.'},
                 status=status.HTTP_404_NOT_FOUND
             )
-        if 'error' in models:
-            return Response(models, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        return Response(models, status=status.HTTP_200_OK)
-
-    def get_openai_models(self):
-        try:
-            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            models = client.models.list()
-            return [model.id for model in models.data]
         except Exception as e:
-            return {'error': str(e)}
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    def get_anthropic_models(self):
-        """
-        Anthropic does not have an endpoint to retrieve all models.
-        Models scrapped from: https://docs.anthropic.com/en/docs/about-claude/models
-        """
-        try:
-            models = [
-                "claude-3-5-sonnet-20241022",
-                "claude-3-opus-20240229",
-                "claude-3-haiku-20240307"
-            ]
-            if not os.getenv("ANTHROPIC_API_KEY"):
-                return {'error': 'ANTHROPIC_API_KEY not found'}
-            return models
-        except Exception as e:
-            return {'error': str(e)}
+        etag = quote_etag(entry['etag'])
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(entry['models'], status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        patch_cache_control(
+            response,
+            max_age=entry['max_age'],
+            stale_while_revalidate=model_catalog.options['STALE_TTL']
+        )
+        return response
 
 class CompletionView(APIView):
     """
-    Routes the request for a message ("completion") to the appropriate router
+    Routes the request for a message ("completion") to the appropriate provider adapter, or
+    for an ``auto`` provider or model to the one core.selector picks, named in ``X-Model``
 
-    Each streaming function immediately forwards chunks from the provider to the frontend.
+    The adapter's chunks are immediately forwarded to the frontend. Adapters are async, so
+    the stream is driven from the shared background loop (see core.background).
     """
     @extend_schema(
         request=CompletionSerializer,
         responses={200: MessageSerializer}
     )
     def post(self, request, provider_name, model_id):
-        serializer = CompletionSerializer(data=request.data)
-        if not serializer.is_valid():
+        timeline = Timeline()
+        with timeline.span('validate'):
+            serializer = CompletionSerializer(data=request.data)
+            valid = serializer.is_valid()
+        if not valid:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+        try:
+            adapter, model_id = model_selector.resolve(provider_name, model_id, serializer.validated_data)
+        except ProviderNotFound:
+            return Response(
+                {'error': f'Provider not found: {provider_name}'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        except NoEligibleModel as e:
+            return Response({'error': str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
         chatroom_id = serializer.validated_data.get('chatroom_id')
         system_prompt = serializer.validated_data.get('system_prompt', '')
         message = serializer.validated_data['message']
         
         # Get or create chatroom
+        lookup = time.perf_counter()
         if chatroom_id:
             try:
                 chatroom = ChatRoom.objects.get(id=chatroom_id)
@@ -105,120 +399,197 @@ class CompletionView(APIView):
         else:
             chatroom = ChatRoom.objects.create(
                 title=message[:50],
-                provider=provider_name,
+                provider=adapter.name,
                 model_id=model_id,
                 system_prompt=system_prompt
             )
 
-        Message.objects.create(
-            chatroom=chatroom,
-            role='user',
-            content=message
-        )
+        message_writer.add(Message(chatroom=chatroom, role='user', content=message))
+        timeline.add_span('chatroom_lookup', lookup)
 
-        # Get conversation history
-        messages = chatroom.messages.all()
-        
-        # Route the request to the correct provider
-        if provider_name.lower() == 'openai':
-            return StreamingHttpResponse(
-                self.stream_openai_response(model_id, chatroom, system_prompt, messages),
-                content_type='text/event-stream'
-            )
-        elif provider_name.lower() == 'anthropic':
-            return StreamingHttpResponse(
-                self.stream_anthropic_response(model_id, chatroom, system_prompt, messages),
-                content_type='text/event-stream'
-            )
-        else:
-            return Response(
+        stream_id = completion_streams.start(stream_completion(
+            adapter, model_id, chatroom, system_prompt,
+            use_cache=serializer.validated_data['cache'],
+            priority=serializer.validated_data['priority'],
+            max_wait=serializer.validated_data.get('max_wait'),
+            timeline=timeline,
+        ))
+        response = event_stream_response(stream_id, background_loop.iterate(completion_streams.read(stream_id)))
+        response['X-Model'] = f'{adapter.name}/{model_id}'
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncCompletionView(View):
+    """
+    Async counterpart of CompletionView for ASGI deployments.
+
+    The chatroom lookup, history load and message writes go through the async ORM and the
+    provider stream runs on the server's event loop, so an in-flight completion waits on the
+    loop instead of holding a worker thread for the whole stream. The ORM calls run on the
+    shared thread pool of core.asgi.
+    """
+    async def post(self, request, provider_name, model_id):
+        try:
+            data = json.loads(request.body or b'{}')
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Request body must be valid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+
+        timeline = Timeline()
+        with timeline.span('validate'):
+            serializer = CompletionSerializer(data=data)
+            valid = serializer.is_valid()
+        if not valid:
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            adapter, model_id = model_selector.resolve(provider_name, model_id, serializer.validated_data)
+        except ProviderNotFound:
+            return JsonResponse(
                 {'error': f'Provider not found: {provider_name}'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        except NoEligibleModel as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
-    def stream_openai_response(self, model_id, chatroom, system_prompt, messages):
-        try:
-            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            
-            # Create the chat log history then stream the response
-            message_list = []
-            if system_prompt:
-                message_list.append({"role": "system", "content": system_prompt})
-            
-            for msg in messages:
-                message_list.append({
-                    "role": msg.role,
-                    "content": msg.content
-                })
-
-            full_content = ""
-            stream = client.chat.completions.create(
-                model=model_id,
-                messages=message_list,
-                stream=True,
-                max_tokens=1000
-            )
+        chatroom_id = serializer.validated_data.get('chatroom_id')
+        system_prompt = serializer.validated_data.get('system_prompt', '')
+        message = serializer.validated_data['message']
 
-            # Immediately forward all chunks to the frontend
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    content = chunk.choices[0].delta.content
-                    full_content += content
-                    yield f"data: {json.dumps({'content': content, 'type': 'chunk'})}\n\n"
-
-            # Save the complete message after streaming
-            message = Message.objects.create(
-                chatroom=chatroom,
-                role='assistant',
-                content=full_content
+        # Get or create chatroom
+        lookup = time.perf_counter()
+        if chatroom_id:
+            try:
+                chatroom = await ChatRoom.objects.aget(id=chatroom_id)
+            except ChatRoom.DoesNotExist:
+                return JsonResponse({'error': 'Chat room not found'}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            chatroom = await ChatRoom.objects.acreate(
+                title=message[:50],
+                provider=adapter.name,
+                model_id=model_id,
+                system_prompt=system_prompt
             )
-            
-            # Send final message with complete content
-            yield f"data: {json.dumps({'type': 'done', 'message': MessageSerializer(message).data})}\n\n"
-            
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
 
-    def stream_anthropic_response(self, model_id, chatroom, system_prompt, messages):
+        await message_writer.aadd(Message(chatroom=chatroom, role='user', content=message))
+        timeline.add_span('chatroom_lookup', lookup)
+
+        stream_id = completion_streams.start(stream_completion(
+            adapter, model_id, chatroom, system_prompt,
+            use_cache=serializer.validated_data['cache'],
+            priority=serializer.validated_data['priority'],
+            max_wait=serializer.validated_data.get('max_wait'),
+            timeline=timeline,
+        ))
+        response = event_stream_response(stream_id, completion_streams.read(stream_id))
+        response['X-Model'] = f'{adapter.name}/{model_id}'
+        return response
+
+
+class CompareView(APIView):
+    """
+    Sends one prompt to several models at once and streams their answers over one
+    connection, every frame tagged with its ``target``; see core.fanout.
+    """
+    @extend_schema(
+        request=CompareSerializer,
+        responses={200: ComparisonSerializer}
+    )
+    def post(self, request):
+        serializer = CompareSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        params = serializer.validated_data
         try:
-            client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-
-            # Format messages for Anthropic's API
-            message_list = []
-            for msg in messages:
-                if msg.role != 'system':
-                    # Anthropic only accepts 'user' and 'assistant' roles
-                    # role = 'user' if msg.role in ['user', 'human'] else 'assistant'
-                    message_list.append({
-                        "role": msg.role,
-                        "content": msg.content
-                    })
-
-            stream = client.messages.create(
-                max_tokens=1024,
-                messages=message_list,
-                model=model_id,
-                stream=True,
-            )
+            targets = parse_targets(params['targets'])
+        except ValueError as e:
+            return Response({'targets': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        except ProviderNotFound as e:
+            return Response({'error': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
 
-            full_content = ""
-            for event in stream:
-                print(event.type)
-                if event.type == 'content_block_delta':
-                    content = event.delta.text
-                    full_content += content
-                    yield f"data: {json.dumps({'content': content, 'type': 'chunk'})}\n\n"
-
-            Message.objects.create(
-                chatroom=chatroom,
-                role='assistant',
-                content=full_content,
-                input_tokens=None,
-                output_tokens=None
-            )
+        timelines = [Timeline() for _ in targets]
+        comparison, rows = create_comparison(params['message'], params['system_prompt'], targets)
+        stream_id = completion_streams.start(stream_comparison(
+            comparison, rows, timelines,
+            use_cache=params['cache'],
+            priority=params['priority'],
+            max_wait=params.get('max_wait'),
+        ))
+        return event_stream_response(stream_id, background_loop.iterate(completion_streams.read(stream_id)))
 
-            yield f"data: {json.dumps({'type': 'done', 'message': full_content})}\n\n"
-            
-        except Exception as e:
-            print(f"Anthropic streaming error: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
\ No newline at end of file
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncCompareView(View):
+    """Async counterpart of CompareView for ASGI deployments"""
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Request body must be valid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = CompareSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        params = serializer.validated_data
+        try:
+            targets = parse_targets(params['targets'])
+        except ValueError as e:
+            return JsonResponse({'targets': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        except ProviderNotFound as e:
+            return JsonResponse({'error': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+
+        timelines = [Timeline() for _ in targets]
+        comparison, rows = await sync_to_async(create_comparison)(params['message'], params['system_prompt'], targets)
+        stream_id = completion_streams.start(stream_comparison(
+            comparison, rows, timelines,
+            use_cache=params['cache'],
+            priority=params['priority'],
+            max_wait=params.get('max_wait'),
+        ))
+        return event_stream_response(stream_id, completion_streams.read(stream_id))
+
+
+def last_event_id(request):
+    value = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id') or 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return 0
+
+
+class StreamView(APIView):
+    """
+    Reattaches to a completion stream: replays the frames after ``Last-Event-ID`` (header,
+    or ``last_event_id`` query parameter) and follows the stream until it ends.
+    """
+    @extend_schema(
+        parameters=[OpenApiParameter('last_event_id', int, description='Last event id the client received')],
+        responses={200: None}
+    )
+    def get(self, request, stream_id):
+        if not completion_streams.exists(stream_id):
+            return Response({'error': 'Stream not found'}, status=status.HTTP_404_NOT_FOUND)
+        frames = completion_streams.read(stream_id, last_event_id(request))
+        return event_stream_response(stream_id, background_loop.iterate(frames))
+
+
+class AsyncStreamView(View):
+    """Async counterpart of StreamView for ASGI deployments"""
+    async def get(self, request, stream_id):
+        if not completion_streams.exists(stream_id):
+            return JsonResponse({'error': 'Stream not found'}, status=status.HTTP_404_NOT_FOUND)
+        return event_stream_response(stream_id, completion_streams.read(stream_id, last_event_id(request)))
+
+
+class StreamCancelView(APIView):
+    """
+    Stops a completion stream: the provider call is closed, the part of the reply streamed
+    so far is stored as aborted and readers get a ``cancelled`` event as the last one.
+    """
+    @extend_schema(request=None, responses={202: None})
+    def post(self, request, stream_id):
+        if not completion_streams.exists(stream_id):
+            return Response({'error': 'Stream not found'}, status=status.HTTP_404_NOT_FOUND)
+        if not completion_streams.cancel(stream_id):
+            return Response({'error': 'Stream is not running in this process'}, status=status.HTTP_409_CONFLICT)
+        return Response({'stream_id': stream_id, 'cancelled': True}, status=status.HTTP_202_ACCEPTED)
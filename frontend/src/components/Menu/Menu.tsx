@@ -1,6 +1,10 @@
 import React, { useState } from 'react';
 import { Drawer, Box, Button, Divider } from '@mui/material';
-import { ChatRoom, useGetChatroomsQuery } from '../../services/api';
+import {
+    ChatRoom,
+    useGetChatroomsQuery,
+    useLoadMoreChatroomsMutation,
+} from '../../services/api';
 import ChatList from './components/ChatList';
 import DrawerHeader from './components/DrawerHeader';
 import EditDialog from './components/EditDialog';
@@ -23,6 +27,8 @@ const Menu: React.FC<MenuProps> = ({
     handleDrawerToggle,
 }) => {
     const { data: chats, isSuccess } = useGetChatroomsQuery();
+    const [loadMoreChatrooms, { isLoading: isLoadingMore }] =
+        useLoadMoreChatroomsMutation();
     const [isEditModalOpen, setIsEditModalOpen] = useState(false);
     const [editRoom, setEditRoom] = useState<ChatRoom | null>(null);
 
@@ -51,12 +57,23 @@ const Menu: React.FC<MenuProps> = ({
             </Box>
             <Divider />
             <ChatList
-                chats={chats}
+                chats={chats?.results}
                 isSuccess={isSuccess}
                 selectedRoom={room}
                 handleSelectRoom={handleSelectRoom}
                 onEditRoom={handleEditChat}
             />
+            {chats?.next && (
+                <Box sx={{ px: 2, pb: 2 }}>
+                    <Button
+                        fullWidth
+                        size='small'
+                        disabled={isLoadingMore}
+                        onClick={() => chats.next && loadMoreChatrooms(chats.next)}>
+                        Load more
+                    </Button>
+                </Box>
+            )}
         </Box>
     );
 
@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import {
     Box,
+    Button,
     Paper,
     Typography,
     IconButton,
@@ -14,6 +15,7 @@ import {
     useCreateCompletionStreamingMutation,
     useGetChatRoomMessagesQuery,
     useGetChatRoomQuery,
+    useLoadOlderMessagesMutation,
 } from '../../services/api';
 import { Formik } from 'formik';
 import Message from './components/Message';
@@ -34,6 +36,8 @@ const ChatRoom: React.FC<{
     const { data: room, isSuccess, isLoading } = useGetChatRoomQuery(roomId);
     const { data: messages, isSuccess: isMessagesSuccess } =
         useGetChatRoomMessagesQuery(roomId);
+    const [loadOlderMessages, { isLoading: isLoadingOlder }] =
+        useLoadOlderMessagesMutation();
     const [createCompletionStreaming] = useCreateCompletionStreamingMutation();
     const [isStreaming, setIsStreaming] = useState(false);
     const [hasSentInitialMessage, setHasSentInitialMessage] = useState(false);
@@ -47,10 +51,12 @@ const ChatRoom: React.FC<{
         messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
     };
 
-    // ensure the chat scrolls to the bottom when the skeleton appears
+    // ensure the chat scrolls to the bottom when the skeleton appears. Only the last
+    // message counts, loading older messages keeps the scroll position
+    const lastMessage = messages?.results[messages.results.length - 1];
     useEffect(() => {
         scrollToBottom();
-    }, [messages, isStreaming]);
+    }, [lastMessage, isStreaming]);
 
     useEffect(() => {
         // Initiate Streaming
@@ -143,11 +149,27 @@ const ChatRoom: React.FC<{
                             padding: 2,
                             backgroundColor: '#f7f9fc',
                         }}>
+                        {isMessagesSuccess && messages.previous && (
+                            <Box sx={{ display: 'flex', justifyContent: 'center', mb: 2 }}>
+                                <Button
+                                    size='small'
+                                    disabled={isLoadingOlder}
+                                    onClick={() =>
+                                        messages.previous &&
+                                        loadOlderMessages({
+                                            id: roomId,
+                                            previous: messages.previous,
+                                        })
+                                    }>
+                                    Load older messages
+                                </Button>
+                            </Box>
+                        )}
                         {isMessagesSuccess &&
-                            messages.map(
+                            messages.results.map(
                                 (m, idx) =>
                                     m.role !== 'system' && (
-                                        <Message key={idx} message={m} />
+                                        <Message key={m.id ?? `new-${idx}`} message={m} />
                                     )
                             )}
                         {isStreaming && <LoadingMessageSkeleton />}
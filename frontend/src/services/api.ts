@@ -33,6 +33,14 @@ export type Message2 = {
     created_at?: string;
     input_tokens?: number;
     output_tokens?: number;
+    status?: 'streaming' | 'complete' | 'aborted';
+    source?: 'provider' | 'cache' | 'shared';
+};
+
+export type Page<T> = {
+    previous?: string | null;
+    next: string | null;
+    results: T[];
 };
 
 export const api = createApi({
@@ -51,10 +59,31 @@ export const api = createApi({
             query: () => `auth/jwt/create`,
             invalidatesTags: ['user'],
         }),
-        getChatrooms: builder.query<ChatRoom[], void>({
+        getChatrooms: builder.query<Page<ChatRoom>, void>({
             query: () => `chatrooms`,
             providesTags: ['chat-rooms'],
         }),
+        // Follows a chatroom list page's `next` link and appends the page to getChatrooms.
+        // A refetch of getChatrooms starts over from the newest page.
+        loadMoreChatrooms: builder.mutation<Page<ChatRoom>, string>({
+            query: (next) => next,
+            async onQueryStarted(next, { dispatch, queryFulfilled }) {
+                try {
+                    const { data: page } = await queryFulfilled;
+                    dispatch(
+                        api.util.updateQueryData('getChatrooms', undefined, (draft) => {
+                            const ids = new Set(draft.results.map((room) => room.id));
+                            draft.results.push(
+                                ...page.results.filter((room) => !ids.has(room.id))
+                            );
+                            draft.next = page.next;
+                        })
+                    );
+                } catch {
+                    // The list is left as it was
+                }
+            },
+        }),
         getChatRoom: builder.query<ChatRoom, string>({
             query: (id) => `chatrooms/${id}`,
             providesTags: (result, error, id) => [{ type: 'chat-room', id }],
@@ -85,10 +114,38 @@ export const api = createApi({
             }),
             invalidatesTags: ['chat-room', 'messages', 'chat-rooms'],
         }),
-        getChatRoomMessages: builder.query<Message2[], string>({
+        // The newest page of a chatroom's messages, oldest first. Older pages loaded with
+        // loadOlderMessages are kept when this refetches.
+        getChatRoomMessages: builder.query<Page<Message2>, string>({
             query: (id) => `chatrooms/${id}/messages`,
+            merge: (current, page) => {
+                const first = page.results[0];
+                const index = first
+                    ? current.results.findIndex((message) => message.id === first.id)
+                    : -1;
+                if (index <= 0) return page;
+                current.results.splice(index, current.results.length - index, ...page.results);
+                current.next = page.next;
+            },
             providesTags: ['chat-room', 'messages'],
         }),
+        // Follows a message page's `previous` link and prepends the older messages
+        loadOlderMessages: builder.mutation<Page<Message2>, { id: string; previous: string }>({
+            query: ({ previous }) => previous,
+            async onQueryStarted({ id }, { dispatch, queryFulfilled }) {
+                try {
+                    const { data: page } = await queryFulfilled;
+                    dispatch(
+                        api.util.updateQueryData('getChatRoomMessages', id, (draft) => {
+                            draft.results.unshift(...page.results);
+                            draft.previous = page.previous;
+                        })
+                    );
+                } catch {
+                    // The messages are left as they were
+                }
+            },
+        }),
         getProviders: builder.query<Provider[], void>({
             query: () => `providers`,
         }),
@@ -127,7 +184,7 @@ export const api = createApi({
                                 'getChatRoomMessages',
                                 id,
                                 (draft) => {
-                                    draft.push({
+                                    draft.results.push({
                                         role: 'user',
                                         content,
                                         created_at: new Date().toISOString(),
@@ -187,7 +244,9 @@ export const api = createApi({
                                                     id,
                                                     (draft) => {
                                                         const lastMessage =
-                                                            draft[draft.length - 1];
+                                                            draft.results[
+                                                                draft.results.length - 1
+                                                            ];
                                                         if (
                                                             lastMessage?.role ===
                                                             'assistant'
@@ -195,7 +254,7 @@ export const api = createApi({
                                                             lastMessage.content =
                                                                 fullContent;
                                                         } else {
-                                                            draft.push({
+                                                            draft.results.push({
                                                                 role: 'assistant',
                                                                 content: fullContent,
                                                                 created_at:
@@ -257,6 +316,8 @@ export const {
     useGetChatroomsQuery,
     useGetChatRoomQuery,
     useGetChatRoomMessagesQuery,
+    useLoadMoreChatroomsMutation,
+    useLoadOlderMessagesMutation,
     useCreateChatRoomMutation,
     useUpdateChatRoomMutation,
     useDeleteChatRoomMutation,